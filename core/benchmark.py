@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+
+"""
+Copyright (c) 2014-2019 Maltrail developers (https://github.com/stamparm/maltrail/)
+See the file 'LICENSE' for copying permission
+"""
+
+# Offline micro- and macro-benchmarks of core functionality. Each benchmark reports its rate (operations per second,
+# best of BENCHMARK_REPEAT runs), while results are stored as JSON baseline (BENCHMARK_BASELINE_FILE) and compared
+# against it on subsequent runs. Benchmark being slower than baseline by more than BENCHMARK_REGRESSION_THRESHOLD is
+# reported as regression (exit code 1).
+
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import common
+
+from addr import addr_to_int
+from addr import int_to_addr
+from common import bogon_ip
+from common import check_whitelisted
+from common import get_regex
+from common import ipcat_lookup
+from common import load_trails
+from common import worst_asns
+from ignore import ignore_event
+from settings import read_config
+from settings import BENCHMARK_BASELINE_FILE
+from settings import BENCHMARK_REGRESSION_THRESHOLD
+from settings import BENCHMARK_REPEAT
+from settings import IGNORE_EVENTS
+from settings import ROOT_DIR
+from trailsdict import TrailsDict
+
+def _measure(function, operations, repeat=BENCHMARK_REPEAT):
+    """
+    Returns rate (operations per second) of given function (best of repeat runs)
+    """
+
+    best = None
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    return operations / best if best else 0.0
+
+def _addresses(count, seed=0):
+    _ = random.Random(seed)
+    return ["{}.{}.{}.{}".format(_.randint(1, 223), _.randint(0, 255), _.randint(0, 255), _.randint(1, 254)) for i in range(count)]
+
+def bench_addr(options):
+    addresses = _addresses(options.count)
+    integers = [addr_to_int(_) for _ in addresses]
+
+    yield "addr_to_int", _measure(lambda: [addr_to_int(_) for _ in addresses], len(addresses))
+    yield "int_to_addr", _measure(lambda: [int_to_addr(_) for _ in integers], len(integers))
+
+def bench_trailsdict(options):
+    keys = ["malware{}.com".format(i) for i in range(options.count)]
+    values = dict((key, ("malware" if i % 2 else "known attacker", "(static)")) for i, key in enumerate(keys))
+
+    def _set():
+        trails = TrailsDict()
+        for key in keys:
+            trails[key] = values[key]
+
+    trails = TrailsDict()
+    trails.update(values)
+
+    yield "trailsdict_set", _measure(_set, len(keys))
+    yield "trailsdict_get", _measure(lambda: [trails[_] for _ in keys], len(keys))
+    yield "trailsdict_update", _measure(lambda: TrailsDict().update(values), len(keys))
+
+def bench_load_trails(options):
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, "trails.csv")
+    original = common.TRAILS_FILE
+
+    try:
+        with open(path, 'w') as f:
+            for i in range(options.rows):
+                f.write("{},{},(static)\n".format("malware{}.com".format(i) if i % 4 else int_to_addr(0x0a000000 + i), "malware" if i % 2 else "known attacker"))
+
+        common.TRAILS_FILE = path
+        yield "load_trails", _measure(lambda: load_trails(quiet=True), options.rows, 1)
+    finally:
+        common.TRAILS_FILE = original
+        shutil.rmtree(directory)
+
+def bench_checks(options):
+    addresses = _addresses(options.count)
+
+    yield "check_whitelisted", _measure(lambda: [check_whitelisted(_) for _ in addresses], len(addresses))
+    yield "bogon_ip", _measure(lambda: [bogon_ip(_) for _ in addresses], len(addresses))
+    yield "worst_asns", _measure(lambda: [worst_asns(_) for _ in addresses], len(addresses))
+    yield "ipcat_lookup", _measure(lambda: [ipcat_lookup(_) for _ in addresses], len(addresses))
+
+def bench_ignore_event(options):
+    _ = random.Random(0)
+    events = [(0, 0, address, _.randint(1024, 65535), "192.168.0.{}".format(_.randint(1, 254)), _.choice((53, 80, 443)), "TCP", "IP", address, "malware", "(static)") for address in _addresses(options.count)]
+    original = set(IGNORE_EVENTS)
+
+    try:
+        IGNORE_EVENTS.clear()
+        for i in range(20):
+            IGNORE_EVENTS.add(("10.0.0.{}".format(i), '*', '*', '*') if i % 2 else ('*', '*', "192.168.1.{}".format(i), str(80 + i)))
+        yield "ignore_event", _measure(lambda: [ignore_event(_) for _ in events], len(events))
+    finally:
+        IGNORE_EVENTS.clear()
+        IGNORE_EVENTS.update(original)
+
+def bench_get_regex(options):
+    _ = random.Random(0)
+    items = ["{}{}.example.com".format(''.join(_.choice("abcdef") for i in range(_.randint(2, 6))), _.randint(0, 99)) for i in range(1000)]
+
+    yield "get_regex", _measure(lambda: get_regex(items), len(items))
+
+def bench_read_config(options):
+    import settings
+
+    path = os.path.join(ROOT_DIR, "maltrail.conf")
+
+    def _read():
+        with contextlib.redirect_stdout(io.StringIO()):
+            for i in range(100):
+                settings._config_cache.clear()
+                read_config(path)
+
+    yield "read_config", _measure(_read, 100)
+
+def bench_settings_import(options):
+    directory = os.path.dirname(os.path.abspath(__file__))
+
+    def _run(code):
+        start = time.perf_counter()
+        subprocess.check_call([sys.executable, "-W", "ignore", "-c", code], cwd=directory)
+        return time.perf_counter() - start
+
+    elapsed = min(_run("import settings") - _run("pass") for _ in range(BENCHMARK_REPEAT))
+
+    yield "settings_import", 1.0 / max(elapsed, 1e-6)
+
+def bench_decode(options):
+    from decoder import decode
+    from decoder import get_ip_offset
+    from replay import read_pcap
+    from replay import REPLAY_CORPUS_FILE
+
+    if os.path.isfile(REPLAY_CORPUS_FILE):
+        packets = [(datalink, data) for _, _, datalink, data in read_pcap(REPLAY_CORPUS_FILE)]
+        yield "decode", _measure(lambda: [decode(data, get_ip_offset(data, datalink)) for datalink, data in packets], len(packets))
+
+def bench_replay(options):
+    from replay import get_corpus_trails
+    from replay import Replayer
+    from replay import REPLAY_CORPUS_FILE
+
+    if os.path.isfile(REPLAY_CORPUS_FILE):
+        yield "replay", max(Replayer(get_corpus_trails()).run(REPLAY_CORPUS_FILE)["packets_per_second"] for _ in range(BENCHMARK_REPEAT))
+
+BENCHMARKS = (bench_addr, bench_trailsdict, bench_load_trails, bench_checks, bench_ignore_event, bench_get_regex, bench_read_config, bench_settings_import, bench_decode, bench_replay)
+
+def run_benchmarks(options):
+    """
+    Returns dictionary of (name, rate) for all benchmarks (with name matching options.filter)
+    """
+
+    retval = {}
+
+    for benchmark in BENCHMARKS:
+        if options.filter and not re.search(options.filter, benchmark.__name__[len("bench_"):]):
+            continue
+
+        for name, rate in benchmark(options):
+            retval[name] = rate
+            print("[i] {:<20}{:>16,.0f} ops/sec".format(name, rate))
+
+    return retval
+
+def compare(results, baseline, threshold=BENCHMARK_REGRESSION_THRESHOLD):
+    """
+    Returns list of (name, baseline rate, current rate, change) for benchmarks regressed by more than threshold
+    """
+
+    retval = []
+
+    for name, rate in sorted(results.items()):
+        if baseline.get(name):
+            change = rate / baseline[name] - 1.0
+            if change < -threshold:
+                retval.append((name, baseline[name], rate, change))
+
+    return retval
+
+if __name__ == "__main__":
+    import optparse
+
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option("--baseline", dest="baseline", default=BENCHMARK_BASELINE_FILE, help="baseline file (default: {})".format(BENCHMARK_BASELINE_FILE))
+    parser.add_option("--save", dest="save", action="store_true", help="store results as new baseline")
+    parser.add_option("--threshold", dest="threshold", type="float", default=BENCHMARK_REGRESSION_THRESHOLD, help="regression threshold (default: {})".format(BENCHMARK_REGRESSION_THRESHOLD))
+    parser.add_option("--filter", dest="filter", help="regex filtering benchmark groups (e.g. 'addr|checks')")
+    parser.add_option("--count", dest="count", type="int", default=100000, help="number of operations for micro-benchmarks")
+    parser.add_option("--rows", dest="rows", type="int", default=1000000, help="number of rows in generated trails file")
+    options, _ = parser.parse_args()
+
+    print("[i] running benchmarks (Python {}, {})...".format(platform.python_version(), platform.platform()))
+    results = run_benchmarks(options)
+
+    baseline = {}
+    if os.path.isfile(options.baseline):
+        with open(options.baseline, 'r') as f:
+            baseline = json.load(f).get("results", {})
+
+    if baseline:
+        for name, rate in sorted(results.items()):
+            if baseline.get(name):
+                print("[i] {:<20}{:>+15.1f}% (baseline {:,.0f} ops/sec)".format(name, 100.0 * (rate / baseline[name] - 1.0), baseline[name]))
+
+    regressions = compare(results, baseline, options.threshold)
+    for name, before, after, change in regressions:
+        print("[x] regression in '{}': {:,.0f} -> {:,.0f} ops/sec ({:+.1f}%)".format(name, before, after, 100.0 * change))
+
+    if options.save or not baseline:
+        baseline.update(results)
+        directory = os.path.dirname(os.path.abspath(options.baseline))
+        if not os.path.isdir(directory):
+            os.makedirs(directory, 0o755)
+        with open(options.baseline, 'w') as f:
+            json.dump({"time": int(time.time()), "python": platform.python_version(), "platform": platform.platform(), "results": baseline}, f, indent=4, sort_keys=True)
+        print("[i] baseline stored to '{}'".format(options.baseline))
+
+    sys.exit(1 if regressions else 0)
@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+
+"""
+Copyright (c) 2014-2019 Maltrail developers (https://github.com/stamparm/maltrail/)
+See the file 'LICENSE' for copying permission
+"""
+
+# Server-side (asyncio) collector of events pushed by sensors to UDP_ADDRESS:UDP_PORT. On each socket readiness up to
+# COLLECTOR_BATCH_SIZE datagrams are drained (recvmmsg-style), each possibly holding multiple (newline separated)
+# "<sec> <log line>" records. Events with info field matching CONDENSE_ON_INFO_KEYWORDS are passed through (per sensor)
+# EventCondenser, hence repeated ones are written (every CONDENSED_EVENTS_FLUSH_PERIOD) as a single record with
+# number of occurrences appended as an additional (last) field, while the rest is passed to log writer as is.
+# Records with timestamp not representable as local time are counted as invalid, while number of (sender supplied)
+# sensor names having their own condenser is capped to MAX_COLLECTOR_SENSORS (least recently used being flushed).
+
+import asyncio
+import re
+import socket
+import time
+
+from condenser import CONDENSE_ON_INFO_REGEX
+from condenser import EventCondenser
+from log import format_time
+from log import parse_event_line
+from log import safe_value
+from settings import config
+from settings import COLLECTOR_BATCH_SIZE
+from settings import CONDENSED_EVENTS_FLUSH_PERIOD
+from settings import MAX_COLLECTOR_SENSORS
+from settings import MAX_RESULT_CACHE_ENTRIES
+
+_record_regex = re.compile(r"\A\s*(\d+)\s+(.+)")
+
+def get_udp_drops(port):
+    """
+    Returns number of datagrams dropped by kernel for (local) UDP port (Linux only)
+    """
+
+    retval = 0
+
+    for filename in ("/proc/net/udp", "/proc/net/udp6"):
+        try:
+            with open(filename, "r") as f:
+                for line in f.readlines()[1:]:
+                    _ = line.split()
+                    if int(_[1].split(':')[1], 16) == port:
+                        retval += int(_[-1])
+        except (IOError, OSError, IndexError, ValueError):
+            pass
+
+    return retval
+
+class EventCollector(object):
+    def __init__(self, writer, address=None, port=None, dedupe_period=CONDENSED_EVENTS_FLUSH_PERIOD, max_keys=MAX_RESULT_CACHE_ENTRIES, max_sensors=MAX_COLLECTOR_SENSORS):
+        self.writer = writer
+        self.address = address or config.UDP_ADDRESS
+        self.port = port if port is not None else config.UDP_PORT
+        self.dedupe_period = dedupe_period
+        self.max_keys = max_keys
+        self.max_sensors = max_sensors
+        self.datagrams = 0
+        self.events = 0
+        self.duplicates = 0
+        self.invalid = 0
+        self.errors = 0
+        self._condensers = {}   # (Note: insertion ordered, least recently used first)
+        self._handle = None
+        self._socket = None
+
+    def bind(self):
+        family, _, _, _, address = socket.getaddrinfo(self.address, self.port, 0, socket.SOCK_DGRAM)[0]
+        self._socket = socket.socket(family, socket.SOCK_DGRAM)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 16 * 1024 * 1024)
+        self._socket.bind(address)
+        self._socket.setblocking(False)
+        self.port = self._socket.getsockname()[1]
+
+        return self._socket
+
+    def _read(self):
+        batch = []
+
+        for _ in range(COLLECTOR_BATCH_SIZE):
+            try:
+                batch.append(self._socket.recv(65535))
+            except (BlockingIOError, InterruptedError):
+                break
+
+        if batch:
+            self.process(batch)
+
+    def _get_condenser(self, sensor):
+        retval = self._condensers.pop(sensor, None)
+
+        if retval is None:
+            if len(self._condensers) >= self.max_sensors:
+                self._flush_condenser(self._condensers.pop(next(iter(self._condensers))))
+            retval = EventCondenser(lambda record: self._write_condensed(sensor, record), self.dedupe_period, self.max_keys)
+
+        self._condensers[sensor] = retval
+
+        return retval
+
+    def _flush_condenser(self, condenser):
+        try:
+            condenser.flush()
+        except Exception as ex:
+            self.errors += 1
+            print("[x] something went wrong during flushing of condensed events ('{}')".format(ex))
+
+    def _write_condensed(self, sensor, record):
+        sec, usec, count = record[0], record[1], record[11]
+
+        try:
+            localtime, day = format_time(sec)
+        except (OverflowError, ValueError, OSError):
+            self.errors += 1
+            return
+
+        self.duplicates += count - 1
+        self.writer.write_line(day, "{} {} {}{}\n".format(safe_value("{}.{:06d}".format(localtime, usec)), safe_value(sensor), " ".join(safe_value(_) for _ in record[2:11]), " {}".format(count) if count > 1 else ""))
+
+    def flush(self):
+        for condenser in list(self._condensers.values()):
+            self._flush_condenser(condenser)
+
+        self.writer.flush()
+
+    def process(self, datagrams):
+        for data in datagrams:
+            self.datagrams += 1
+
+            for record in data.decode("utf8", "replace").split('\n'):
+                if not record.strip():
+                    continue
+
+                match = _record_regex.search(record)
+                if not match:
+                    self.invalid += 1
+                    continue
+
+                sec, line = int(match.group(1)), match.group(2)
+
+                try:
+                    day = format_time(sec)[1]
+                except (OverflowError, ValueError, OSError):    # e.g. timestamp out of range for platform time_t
+                    self.invalid += 1
+                    continue
+
+                if CONDENSE_ON_INFO_REGEX.search(line):     # (Note: cheap pre-filter, as info field is a part of line)
+                    fields = parse_event_line(line)
+                    if len(fields) > 10 and CONDENSE_ON_INFO_REGEX.search(fields[9]):
+                        usec = fields[0].rpartition('.')[2]
+                        self._get_condenser(fields[1]).process((sec, int(usec) if usec.isdigit() else 0) + tuple(fields[2:11]))
+                        self.events += 1
+                        continue
+
+                self.writer.write_line(day, line + '\n')
+                self.events += 1
+
+    def start(self, loop=None):
+        loop = loop or asyncio.get_event_loop()
+
+        if self._socket is None:
+            self.bind()
+
+        loop.add_reader(self._socket.fileno(), self._read)
+
+        def _():
+            try:
+                self.flush()
+            finally:
+                self._handle = loop.call_later(self.dedupe_period, _)
+
+        self._handle = loop.call_later(self.dedupe_period, _)
+
+    def stop(self, loop=None):
+        (loop or asyncio.get_event_loop()).remove_reader(self._socket.fileno())
+        self._socket.close()
+
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+        self.flush()
+
+    def stats(self):
+        return {"datagrams": self.datagrams, "events": self.events, "duplicates": self.duplicates, "invalid": self.invalid, "errors": self.errors, "sensors": len(self._condensers), "drops": get_udp_drops(self.port)}
+
+if __name__ == "__main__":
+    import multiprocessing
+    import os
+    import shutil
+    import tempfile
+
+    from log import EventLogWriter
+
+    duration = 5
+    senders = max(1, multiprocessing.cpu_count() - 1)
+    records = 20    # per datagram (i.e. sensor side batching)
+    directory = tempfile.mkdtemp()
+
+    def _generate(port, sent, index):
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        line = "\"2019-11-19 12:00:00.000000\" sensor 10.0.0.{} 1024 192.168.0.1 53 UDP DNS evil{}.com malware (static)"
+        end = time.time() + duration
+        count = 0
+
+        while time.time() < end:
+            data = "\n".join("{} {}".format(int(time.time()), line.format(index, (count + i) % 1000)) for i in range(records)).encode("utf8")
+            try:
+                s.sendto(data, ("127.0.0.1", port))
+                count += records
+            except OSError:
+                pass
+            if count % (records * 50) == 0:
+                time.sleep(0.001)
+
+        sent.value = count
+
+    try:
+        # (self-check) out of range timestamp is counted as invalid, not stopping the batch (nor condensed flushing)
+        collector = EventCollector(EventLogWriter(os.path.join(directory, "check"), compress=False), "127.0.0.1", 0, max_sensors=2)
+        line = "\"2019-11-19 12:00:00.000000\" {} 10.0.0.1 1024 192.168.0.1 80 TCP IP 10.0.0.1 {} (static)"
+        collector.process([b"99999999999999999999 " + line.format("sensor", "\"mass scanner\"").encode("utf8") + b"\n1574164800 " + line.format("sensor", "malware").encode("utf8")])
+        collector.process(["1574164800 {}".format(line.format("sensor{}".format(i), "\"mass scanner\"")).encode("utf8") for i in range(10)])
+        collector.flush()
+        assert (collector.events, collector.invalid, collector.errors, len(collector._condensers)) == (11, 1, 0, 2), collector.stats()
+        print("[i] self-check passed (invalid timestamp, capped sensors)")
+
+        collector = EventCollector(EventLogWriter(directory, compress=False), "127.0.0.1", 0)
+        collector.bind()
+        loop = asyncio.new_event_loop()
+        collector.start(loop)
+
+        values = [multiprocessing.Value('Q', 0) for _ in range(senders)]
+        processes = [multiprocessing.Process(target=_generate, args=(collector.port, values[_], _)) for _ in range(senders)]
+        for process in processes:
+            process.start()
+
+        start = time.time()
+        loop.run_until_complete(asyncio.sleep(duration))
+        while True:     # drain backlog (i.e. datagrams still waiting in socket buffer)
+            previous = collector.datagrams
+            loop.run_until_complete(asyncio.sleep(0.5))
+            if collector.datagrams == previous:
+                break
+        elapsed = time.time() - start - 0.5
+        stats = collector.stats()
+        collector.stop(loop)
+        for process in processes:
+            process.join()
+
+        sent = sum(_.value for _ in values)
+        received = collector.events + collector.invalid
+        print("[i] {} sender(s), {} events per datagram: sent {:,}, received {:,} ({:,.0f} events/second, drop rate {:.2f}%, dropped datagrams {:,})".format(senders, records, sent, received, received / elapsed, 100.0 * (sent - received) / max(sent, 1), stats["drops"]))
+        print("[i] collector stats: {}".format(stats))
+    finally:
+        shutil.rmtree(directory)
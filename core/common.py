@@ -18,20 +18,24 @@ from io import StringIO
 
 from addr import addr_to_int
 from addr import int_to_addr
+from lrucache import LRUCache
 from settings import BOGON_RANGES
 from settings import CHECK_CONNECTION_URL
 from settings import CDN_RANGES
 from settings import NAME
 from settings import IPCAT_SQLITE_FILE
+from settings import MAX_RESULT_CACHE_ENTRIES
 from settings import STATIC_IPCAT_LOOKUPS
 from settings import TIMEOUT
+from settings import TRAILS_DELTA_FILE
 from settings import TRAILS_FILE
 from settings import WHITELIST
 from settings import WHITELIST_RANGES
 from settings import WORST_ASNS
 from trailsdict import TrailsDict
 
-_ipcat_cache = {}
+_ipcat_static = {}
+_ipcat_cache = LRUCache(MAX_RESULT_CACHE_ENTRIES)
 
 def retrieve_content(url, data=None, headers=None):
     """
@@ -62,7 +66,7 @@ def ipcat_lookup(address):
     if not address:
         return None
 
-    if not _ipcat_cache:
+    if not _ipcat_static:
         for name in STATIC_IPCAT_LOOKUPS:
             for value in STATIC_IPCAT_LOOKUPS[name]:
                 if "-" in value:
@@ -70,14 +74,16 @@ def ipcat_lookup(address):
                     start_int, end_int = addr_to_int(start), addr_to_int(end)
                     current = start_int
                     while start_int <= current <= end_int:
-                        _ipcat_cache[int_to_addr(current)] = name
+                        _ipcat_static[int_to_addr(current)] = name
                         current += 1
                 else:
-                    _ipcat_cache[value] = name
+                    _ipcat_static[value] = name
     
-    if address in _ipcat_cache:
-        retval = _ipcat_cache[address]
-    else:
+    retval = _ipcat_static.get(address)
+    if retval is None:
+        retval = _ipcat_cache.get(address)
+
+    if retval is None:
         retval = ""
 
         if os.path.isfile(IPCAT_SQLITE_FILE):
@@ -124,6 +130,21 @@ def bogon_ip(address):
 
     return False
 
+# 返回address地址是否属于CDN网络
+def cdn_ip(address):
+    if not address:
+        return False
+
+    try:
+        _ = addr_to_int(address)
+        for prefix, mask in CDN_RANGES.get(address.split('.')[0], {}):
+            if _ & mask == prefix:
+                return True
+    except (IndexError, ValueError):
+        pass
+
+    return False
+
 def check_sudo():
     """
     Checks for sudo/Administrator privileges
@@ -183,7 +204,7 @@ def get_regex(items):
                     previous = _
                 return ("[{}]".format("".join(items))) if len(items) > 1 or '-' in items[0] else "".join(items)
             else:
-                return re.escape(current.keys()[0])
+                return re.escape(next(iter(current)))
         else:
             return ("(?:%s)" if len(current) > 1 else "%s") % ('|'.join("%s%s" % (re.escape(_), process(current[_])) for _ in sorted(current))).replace('|'.join(str(_) for _ in range(10)), r"\d")
 
@@ -217,7 +238,7 @@ def load_trails(quiet=False):
 
     if os.path.isfile(TRAILS_FILE):
         try:
-            with open(TRAILS_FILE, 'rb') as f:
+            with open(TRAILS_FILE, 'r', newline='') as f:
                 reader = csv.reader(f, delimiter=',', quotechar='\"')
                 for row in reader:
                     if row and len(row) == 3:
@@ -226,6 +247,18 @@ def load_trails(quiet=False):
                             retval[trail] = (info, reference)
         except Exception as ex:
             exit("[!] something went wrong during trails file read {} ({})".format(TRAILS_FILE, ex))
+
+        if os.path.isfile(TRAILS_DELTA_FILE):     # (Note: deltas synchronized from UPDATE_SERVER since last full write)
+            try:
+                with open(TRAILS_DELTA_FILE, 'r', newline='') as f:
+                    for row in csv.reader(f, delimiter=',', quotechar='\"'):
+                        if len(row) == 4 and row[0] in ('+', '~'):
+                            if not check_whitelisted(row[1]):
+                                retval[row[1]] = (row[2], row[3])
+                        elif len(row) == 2 and row[0] == '-' and row[1] in retval:
+                            del retval[row[1]]
+            except Exception as ex:
+                exit("[!] something went wrong during trails delta file read {} ({})".format(TRAILS_DELTA_FILE, ex))
         
     if not quiet:
         _ = len(retval)
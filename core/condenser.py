@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+
+"""
+Copyright (c) 2014-2019 Maltrail developers (https://github.com/stamparm/maltrail/)
+See the file 'LICENSE' for copying permission
+"""
+
+# Streaming condensing of (noisy) events having info matching CONDENSE_ON_INFO_KEYWORDS (e.g. mass scanning). Repeated
+# events with same (src_ip, dst_ip, trail, info) are merged into a single counted record, flushed every
+# CONDENSED_EVENTS_FLUSH_PERIOD seconds.
+#
+# Records passed to sink: (sec, usec, src_ip, src_port, dst_ip, dst_port, proto, trail_type, trail, info, reference, count, last_sec)
+# where sec/usec are of first event, while (differing) src_port, dst_port and proto values are joined with ','
+
+import re
+import threading
+import time
+
+from settings import CONDENSE_ON_INFO_KEYWORDS
+from settings import CONDENSED_EVENTS_FLUSH_PERIOD
+from settings import MAX_RESULT_CACHE_ENTRIES
+
+MAX_CONDENSED_VALUES = 100
+CONDENSE_ON_INFO_REGEX = re.compile("|".join(re.escape(_) for _ in CONDENSE_ON_INFO_KEYWORDS))
+
+class EventCondenser(object):
+    def __init__(self, sink, flush_period=CONDENSED_EVENTS_FLUSH_PERIOD, max_records=MAX_RESULT_CACHE_ENTRIES):
+        self.sink = sink
+        self.flush_period = flush_period
+        self.max_records = max_records
+        self.events_in = 0
+        self.records_out = 0
+        self._records = {}
+        self._lock = threading.Lock()
+        self._last_flush = time.time()
+        self._thread = None
+
+    def process(self, event_tuple):
+        sec, usec, src_ip, src_port, dst_ip, dst_port, proto, trail_type, trail, info, reference = event_tuple[:11]
+        self.events_in += 1
+
+        if not CONDENSE_ON_INFO_REGEX.search(info):
+            self.records_out += 1
+            self.sink(tuple(event_tuple[:11]) + (1, sec))
+        else:
+            key = (src_ip, dst_ip, trail, info)
+            overflow = None
+
+            with self._lock:
+                record = self._records.get(key)
+                if record is None:
+                    if len(self._records) >= self.max_records:
+                        overflow = self._swap()
+                    self._records[key] = [event_tuple, 1, sec, set((src_port,)), set((dst_port,)), set((proto,))]
+                else:
+                    record[1] += 1
+                    record[2] = max(record[2], sec)
+                    for i, value in ((3, src_port), (4, dst_port), (5, proto)):
+                        if len(record[i]) < MAX_CONDENSED_VALUES:
+                            record[i].add(value)
+
+            if overflow:
+                self._emit(overflow)
+
+        if time.time() - self._last_flush >= self.flush_period:
+            self.flush()
+
+    def _swap(self):
+        retval, self._records = self._records, {}
+        self._last_flush = time.time()
+        return retval
+
+    def _emit(self, records):
+        for event_tuple, count, last_sec, src_ports, dst_ports, protos in records.values():
+            _ = list(event_tuple[:11])
+            for i, values in ((3, src_ports), (5, dst_ports), (6, protos)):
+                if len(values) > 1:
+                    _[i] = ','.join(str(value) for value in sorted(values, key=str))
+            self.records_out += 1
+            self.sink(tuple(_) + (count, last_sec))
+
+    def flush(self):
+        with self._lock:
+            records = self._swap()
+
+        self._emit(records)
+
+    def start(self):
+        """
+        Starts background thread flushing condensed records (even in quiet periods)
+        """
+
+        def _(self):
+            while True:
+                time.sleep(self.flush_period)
+                self.flush()
+
+        self._thread = threading.Thread(target=_, args=(self,))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stats(self):
+        return {"events_in": self.events_in, "records_out": self.records_out, "pending": len(self._records)}
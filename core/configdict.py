@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+
+"""
+Copyright (c) 2014-2019 Maltrail developers (https://github.com/stamparm/maltrail/)
+See the file 'LICENSE' for copying permission
+"""
+
+class ConfigDict(dict):
+    """
+    Read-only configuration container (options are loaded only through load())
+    """
+
+    def __init__(self, schema=None):
+        dict.__init__(self)
+        object.__setattr__(self, "_schema", schema or {})
+        object.__setattr__(self, "_frozen", False)
+
+    def __getattr__(self, name):
+        if name in self:
+            return self[name]
+        elif name.isupper() and name not in self._schema:
+            raise AttributeError("unknown configuration option '{}'".format(name))
+        else:
+            return None     # known (but unset) options and runtime (lowercase) attributes
+
+    def __setattr__(self, name, value):
+        self[name] = value
+
+    def __setitem__(self, name, value):
+        if self._frozen and name.isupper():
+            raise AttributeError("configuration option '{}' is read-only".format(name))
+        dict.__setitem__(self, name, value)
+
+    def __delitem__(self, name):
+        if self._frozen and name.isupper():
+            raise AttributeError("configuration option '{}' is read-only".format(name))
+        dict.__delitem__(self, name)
+
+    def __reduce__(self):
+        return (_rebuild, (self._schema, dict(self)))
+
+    def clear(self):
+        if self._frozen:
+            raise AttributeError("configuration is read-only")
+        dict.clear(self)
+
+    def pop(self, name, *args):
+        if self._frozen and name.isupper():
+            raise AttributeError("configuration option '{}' is read-only".format(name))
+        return dict.pop(self, name, *args)
+
+    def update(self, *args, **kwargs):
+        for name, value in dict(*args, **kwargs).items():
+            self[name] = value
+
+    def load(self, values):
+        dict.clear(self)
+        dict.update(self, ((name, type(value)(value) if isinstance(value, (list, dict, set)) else value) for name, value in values.items()))     # (Note: copying mutable values, e.g. USERS, so they are not shared with loaded values)
+        object.__setattr__(self, "_frozen", True)
+
+def _rebuild(schema, values):
+    retval = ConfigDict(schema)
+    retval.load(values)
+    return retval
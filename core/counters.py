@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+
+"""
+Copyright (c) 2014-2019 Maltrail developers (https://github.com/stamparm/maltrail/)
+See the file 'LICENSE' for copying permission
+"""
+
+# Heuristic counters shared between worker processes (e.g. for NO_SUCH_NAME_PER_HOUR_THRESHOLD, PORT_SCANNING_THRESHOLD
+# and DNS_EXHAUSTION_THRESHOLD). Table consists of one fixed-size open-addressed hash region per worker, where each worker
+# writes only into its own region (hence, no locking is needed), while totals are summed over all regions.
+#
+# Slot: [key hash (Q)][window (I)][count (I)] (Note: counts of previous windows are considered expired/reusable)
+#
+# Key hash is deterministic (CRC32 and Adler-32 of key) instead of built-in (salted) hash(), as all processes have to
+# agree on it. Increments not fitting into SHARED_COUNTER_PROBES probes are dropped and counted (per worker) behind
+# the regions, hence exposed to all processes through overflows.
+
+import struct
+import time
+import zlib
+
+from multiprocessing import shared_memory
+
+from settings import config
+from settings import CPU_CORES
+from settings import DAILY_SECS
+from settings import SHARED_COUNTER_PROBES
+from settings import SHARED_COUNTER_SLOTS
+
+SLOT = struct.Struct("=QII")
+HOURLY_SECS = 60 * 60
+
+def key_hash(key):
+    """
+    Returns deterministic (non-zero) 64-bit hash of given key (string or tuple)
+    """
+
+    data = ("\x00".join("%s" % _ for _ in key) if isinstance(key, tuple) else "%s" % key).encode("utf8")
+
+    return (zlib.adler32(data) << 32 | zlib.crc32(data)) or 1
+
+class SharedCounters(object):
+    def __init__(self, period=HOURLY_SECS, slots=SHARED_COUNTER_SLOTS, process_count=None):
+        self.period = period
+        self.slots = 1 << (max(slots, 2) - 1).bit_length()   # rounded to power of 2
+        self.process_count = max(1, process_count or config.PROCESS_COUNT or CPU_CORES)
+        self.worker = 0
+        self._region = self.slots * SLOT.size
+        self._memory = shared_memory.SharedMemory(create=True, size=self.process_count * (self._region + 8))
+        self._buffer = self._memory.buf
+        self._overflows = self._buffer[self.process_count * self._region:].cast('Q')     # (Note: per worker, each written only by its owner)
+
+    @property
+    def overflows(self):
+        """
+        Returns number of dropped increments/additions (summed over all workers) due to exhausted probes
+        """
+
+        return sum(self._overflows)
+
+    def _overflow(self):
+        self._overflows[self.worker] += 1
+
+    def bind(self, worker):
+        """
+        Sets index of (current) worker process writing into table
+        """
+
+        self.worker = worker % self.process_count
+
+    def _find(self, region, _hash, window, insert=False):
+        base = region * self._region
+        mask = self.slots - 1
+        index = _hash & mask
+        candidate = None
+
+        for i in range(SHARED_COUNTER_PROBES):
+            offset = base + ((index + i) & mask) * SLOT.size
+            key, _window, count = SLOT.unpack_from(self._buffer, offset)
+            if key == _hash:
+                return offset, (count if _window == window else 0)
+            elif key == 0:
+                return (candidate if candidate is not None else offset, 0) if insert else (None, 0)
+            elif insert and candidate is None and _window != window:
+                candidate = offset
+
+        return candidate, 0
+
+    def _total(self, _hash, window, skip=None):
+        retval = 0
+
+        for region in range(self.process_count):
+            if region != skip:
+                retval += self._find(region, _hash, window)[1]
+
+        return retval
+
+    def count(self, key, now=None):
+        """
+        Returns total count of given key in current window (summed over all workers)
+        """
+
+        return self._total(key_hash(key), int((now or time.time()) // self.period))
+
+    def increment(self, key, value=1, now=None):
+        """
+        Increments count of given key (inside current worker's region) and returns total count
+        """
+
+        _hash = key_hash(key)
+        window = int((now or time.time()) // self.period)
+        offset, count = self._find(self.worker, _hash, window, True)
+
+        if offset is None:
+            self._overflow()
+        else:
+            count += value
+            SLOT.pack_into(self._buffer, offset, _hash, window, min(count, 0xffffffff))
+
+        return count + self._total(_hash, window, self.worker)
+
+    def add(self, key, member, now=None):
+        """
+        Adds member to set identified by given key and returns number of its distinct members
+        """
+
+        _hash = key_hash((key, member))
+        window = int((now or time.time()) // self.period)
+        offset, count = self._find(self.worker, _hash, window, True)
+
+        if offset is None:
+            self._overflow()
+            return self.count(key, now)
+
+        if count == 0 and self._total(_hash, window, self.worker) == 0:     # first sighting (Note: checked before write)
+            SLOT.pack_into(self._buffer, offset, _hash, window, 1)
+            return self.increment(key, 1, now)
+        else:
+            SLOT.pack_into(self._buffer, offset, _hash, window, min(count + 1, 0xffffffff))
+            return self.count(key, now)
+
+    def release(self):
+        """
+        Frees shared memory (to be called from parent process only)
+        """
+
+        self._overflows.release()
+        self._overflows = self._buffer = None
+        self._memory.close()
+        self._memory.unlink()
+
+def create_heuristic_counters(process_count=None):
+    return {
+        "no_such_name": SharedCounters(HOURLY_SECS, process_count=process_count),       # per source against NO_SUCH_NAME_PER_HOUR_THRESHOLD
+        "port_scanning": SharedCounters(HOURLY_SECS, process_count=process_count),      # distinct destination ports per source/destination against PORT_SCANNING_THRESHOLD
+        "dns_exhaustion": SharedCounters(DAILY_SECS, process_count=process_count),      # distinct subdomains per domain against DNS_EXHAUSTION_THRESHOLD
+    }
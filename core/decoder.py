@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+
+"""
+Copyright (c) 2014-2019 Maltrail developers (https://github.com/stamparm/maltrail/)
+See the file 'LICENSE' for copying permission
+"""
+
+# Zero-copy decoding of captured packets (link layer -> IPv4/IPv6 -> TCP/UDP/ICMP). Headers are unpacked with
+# precompiled struct.Struct objects directly from memoryview (e.g. of capture ring buffer), while payload is
+# returned as memoryview slice (i.e. no copying of packet data).
+
+import socket
+import struct
+
+from enums import PROTO
+from lrucache import LRUCache
+from settings import DLT_OFFSETS
+from settings import IPPROTO_LUT
+
+ETH_P_IP = 0x0800
+ETH_P_IPV6 = 0x86dd
+ETH_P_8021Q = 0x8100
+DLT_EN10MB = 1
+DLT_LINUX_SLL = 113
+
+_ETH_TYPE = struct.Struct("!H")
+_IPV4 = struct.Struct("!BxHxxHxB2x4s4s")    # version/IHL, total length, flags/fragment offset, protocol, source, destination
+_IPV6 = struct.Struct("!4xHBx16s16s")       # payload length, next header, source, destination
+_TCP = struct.Struct("!HH8xBB")             # source port, destination port, data offset, flags
+_UDP = struct.Struct("!HH4x")               # source port, destination port
+_ICMP = struct.Struct("!BB")                # type, code
+
+MAX_ADDRESS_CACHE_ENTRIES = 65536
+
+_PROTOS = {socket.IPPROTO_TCP: PROTO.TCP, socket.IPPROTO_UDP: PROTO.UDP, socket.IPPROTO_ICMP: PROTO.ICMP, socket.IPPROTO_ICMPV6: PROTO.ICMP}
+
+class Packet(object):
+    __slots__ = ("sec", "usec", "ip_version", "src_ip", "src_port", "dst_ip", "dst_port", "proto", "flags", "ip_offset", "payload")
+
+    def __init__(self, sec, usec, ip_version, src_ip, src_port, dst_ip, dst_port, proto, flags, ip_offset, payload):
+        self.sec = sec
+        self.usec = usec
+        self.ip_version = ip_version
+        self.src_ip = src_ip
+        self.src_port = src_port
+        self.dst_ip = dst_ip
+        self.dst_port = dst_port
+        self.proto = proto
+        self.flags = flags          # TCP flags (ICMP type in case of ICMP)
+        self.ip_offset = ip_offset
+        self.payload = payload      # memoryview of transport payload
+
+    def __repr__(self):
+        return "<Packet {} {}:{} -> {}:{} ({} bytes)>".format(self.proto, self.src_ip, self.src_port, self.dst_ip, self.dst_port, len(self.payload))
+
+_addresses = LRUCache(MAX_ADDRESS_CACHE_ENTRIES)
+
+def _ntoa(value):
+    """
+    Returns (cached) textual representation of packed IPv4/IPv6 address
+    """
+
+    retval = _addresses.get(value)
+
+    if retval is None:
+        retval = _addresses[value] = socket.inet_ntoa(value) if len(value) == 4 else socket.inet_ntop(socket.AF_INET6, value)
+
+    return retval
+
+def get_ip_offset(packet, datalink):
+    """
+    Returns offset of IP header for a given datalink type (taking care of 802.1Q tagging)
+    """
+
+    retval = DLT_OFFSETS.get(datalink)
+
+    if retval is not None:
+        if datalink == DLT_EN10MB:
+            while len(packet) >= retval and _ETH_TYPE.unpack_from(packet, retval - 2)[0] == ETH_P_8021Q:
+                retval += 4
+        elif datalink == DLT_LINUX_SLL and len(packet) >= retval and _ETH_TYPE.unpack_from(packet, retval - 2)[0] == ETH_P_8021Q:
+            retval += 4
+
+    return retval
+
+def decode(packet, ip_offset, sec=0, usec=0):
+    """
+    Decodes packet (bytes, bytearray or memoryview) having IP header at ip_offset (returns None if not decodable)
+    """
+
+    view = memoryview(packet)
+    length = len(view)
+
+    if length < ip_offset + 20:
+        return None
+
+    version = view[ip_offset] >> 4
+
+    if version == 4:
+        version_ihl, total_length, fragment, protocol, src_ip, dst_ip = _IPV4.unpack_from(view, ip_offset)
+        offset = ip_offset + ((version_ihl & 0xf) << 2)
+        end = min(length, ip_offset + total_length) if total_length else length
+        src_ip, dst_ip = _ntoa(src_ip), _ntoa(dst_ip)
+
+        if fragment & 0x1fff:     # non-first fragment (i.e. no transport header)
+            return Packet(sec, usec, version, src_ip, None, dst_ip, None, IPPROTO_LUT.get(protocol, protocol), None, ip_offset, view[offset:end])
+
+    elif version == 6:
+        if length < ip_offset + 40:
+            return None
+
+        payload_length, protocol, src_ip, dst_ip = _IPV6.unpack_from(view, ip_offset)
+        offset = ip_offset + 40
+        end = min(length, offset + payload_length)
+        src_ip, dst_ip = _ntoa(src_ip), _ntoa(dst_ip)
+
+    else:
+        return None
+
+    proto = _PROTOS.get(protocol)
+
+    if proto is PROTO.TCP and end >= offset + _TCP.size:
+        src_port, dst_port, data_offset, flags = _TCP.unpack_from(view, offset)
+        return Packet(sec, usec, version, src_ip, src_port, dst_ip, dst_port, proto, flags, ip_offset, view[offset + ((data_offset >> 4) << 2):end])
+
+    elif proto is PROTO.UDP and end >= offset + _UDP.size:
+        src_port, dst_port = _UDP.unpack_from(view, offset)
+        return Packet(sec, usec, version, src_ip, src_port, dst_ip, dst_port, proto, None, ip_offset, view[offset + _UDP.size:end])
+
+    elif proto is PROTO.ICMP and end >= offset + _ICMP.size:
+        _type, _ = _ICMP.unpack_from(view, offset)
+        return Packet(sec, usec, version, src_ip, None, dst_ip, None, proto, _type, ip_offset, view[offset + 4:end])
+
+    else:
+        return Packet(sec, usec, version, src_ip, None, dst_ip, None, IPPROTO_LUT.get(protocol, protocol), None, ip_offset, view[offset:end])
+
+def build_packet(src_ip, src_port, dst_ip, dst_port, proto=PROTO.TCP, payload=b"", flags=0x18, vlan=None):
+    """
+    Returns (synthetic) Ethernet frame (used for benchmarks and replay corpora)
+    """
+
+    ipv6 = ':' in src_ip
+    family = socket.AF_INET6 if ipv6 else socket.AF_INET
+
+    if proto == PROTO.TCP:
+        protocol, transport = socket.IPPROTO_TCP, struct.pack("!HHIIBBHHH", src_port, dst_port, 0, 0, 5 << 4, flags, 65535, 0, 0)
+    elif proto == PROTO.UDP:
+        protocol, transport = socket.IPPROTO_UDP, struct.pack("!HHHH", src_port, dst_port, 8 + len(payload), 0)
+    else:
+        protocol, transport = socket.IPPROTO_ICMPV6 if ipv6 else socket.IPPROTO_ICMP, struct.pack("!BBHI", 8, 0, 0, 0)
+
+    transport += payload
+
+    if ipv6:
+        ip = struct.pack("!IHBB16s16s", 6 << 28, len(transport), protocol, 64, socket.inet_pton(family, src_ip), socket.inet_pton(family, dst_ip))
+    else:
+        ip = struct.pack("!BBHHHBBH4s4s", 0x45, 0, 20 + len(transport), 0, 0x4000, 64, protocol, 0, socket.inet_aton(src_ip), socket.inet_aton(dst_ip))
+
+    link = b"\x00\x11\x22\x33\x44\x55\x66\x77\x88\x99\xaa\xbb"
+    if vlan is not None:
+        link += struct.pack("!HH", ETH_P_8021Q, vlan)
+    link += struct.pack("!H", ETH_P_IPV6 if ipv6 else ETH_P_IP)
+
+    return link + ip + transport
+
+if __name__ == "__main__":
+    import os
+    import random
+    import time
+
+    import replay
+
+    from replay import get_corpus_trails
+    from replay import Replayer
+    from replay import REPLAY_CORPUS_FILE
+
+    count = 200000
+    random.seed(0)
+
+    packets = []
+    for i in range(1000):
+        proto = random.choice((PROTO.TCP, PROTO.TCP, PROTO.UDP, PROTO.ICMP))
+        if i % 10 == 0:
+            src_ip, dst_ip = "2001:db8::{:x}".format(i), "2001:db8::1"
+        else:
+            src_ip, dst_ip = "10.0.{}.{}".format(i // 256, i % 256), "192.168.0.{}".format(i % 200)
+        packets.append(build_packet(src_ip, random.randint(1024, 65535), dst_ip, random.choice((53, 80, 443)), proto, b"GET / HTTP/1.1\r\nHost: www.example.com\r\n\r\n" * random.randint(1, 20), vlan=100 if i % 7 == 0 else None))
+
+    def _naive(packet, ip_offset, sec=0, usec=0):    # (Note: bytes slicing, with same result as decode())
+        ip_data = bytes(packet[ip_offset:])
+        if len(ip_data) < 20:
+            return None
+        if ip_data[0] >> 4 == 4:
+            iph_length = (ip_data[0] & 0xf) << 2
+            iph = struct.unpack("!BBHHHBBH4s4s", ip_data[:20])
+            version, src_ip, dst_ip, protocol = 4, socket.inet_ntoa(iph[8]), socket.inet_ntoa(iph[9]), iph[6]
+        elif ip_data[0] >> 4 == 6 and len(ip_data) >= 40:
+            iph_length = 40
+            iph = struct.unpack("!IHBB16s16s", ip_data[:40])
+            version, src_ip, dst_ip, protocol = 6, socket.inet_ntop(socket.AF_INET6, iph[4]), socket.inet_ntop(socket.AF_INET6, iph[5]), iph[2]
+        else:
+            return None
+        if protocol == socket.IPPROTO_TCP:
+            tcph = struct.unpack("!HHLLBBHHH", ip_data[iph_length:iph_length + 20])
+            return Packet(sec, usec, version, src_ip, tcph[0], dst_ip, tcph[1], PROTO.TCP, tcph[5], ip_offset, ip_data[iph_length + ((tcph[4] >> 4) << 2):])
+        elif protocol == socket.IPPROTO_UDP:
+            udph = struct.unpack("!HHHH", ip_data[iph_length:iph_length + 8])
+            return Packet(sec, usec, version, src_ip, udph[0], dst_ip, udph[1], PROTO.UDP, None, ip_offset, ip_data[iph_length + 8:])
+        else:
+            return Packet(sec, usec, version, src_ip, None, dst_ip, None, IPPROTO_LUT.get(protocol, protocol), None, ip_offset, ip_data[iph_length:])
+
+    # packets laid out in (shared) buffer, as in capture ring buffer
+    buffer, offsets = bytearray(), []
+    for packet in packets:
+        offsets.append((len(buffer), len(buffer) + len(packet)))
+        buffer += packet
+    view = memoryview(buffer)
+
+    for name, function in (("naive (bytes slicing)", _naive), ("zero-copy (memoryview)", decode)):
+        best = None
+        for _ in range(5):
+            start = time.perf_counter()
+            for i in range(count):
+                start_, end = offsets[i % len(offsets)]
+                function(view[start_:end], get_ip_offset(view[start_:end], DLT_EN10MB))
+            elapsed = time.perf_counter() - start
+            best = min(best or elapsed, elapsed)
+        print("[i] {}: {:,.0f} packets/second".format(name, count / best))
+
+    if os.path.isfile(REPLAY_CORPUS_FILE):     # (Note: end-to-end, as in benchmark.py's replay)
+        trails = get_corpus_trails()
+        functions = (("naive (bytes slicing)", _naive), ("zero-copy (memoryview)", decode))
+        results = dict((name, []) for name, _ in functions)
+        for _ in range(10):
+            for name, function in functions:
+                replay.decode = function
+                results[name].append(Replayer(trails).run(REPLAY_CORPUS_FILE))
+        for name, runs in results.items():
+            print("[i] replay with {}: {:,.0f} packets/second (decode stage {:,.0f} ns/packet)".format(name, max(_["packets_per_second"] for _ in runs), 1e9 * min(_["timings"]["decode"] / _["packets"] for _ in runs)))
+
+    for packet in packets[:3]:
+        print("[i] {}".format(decode(packet, get_ip_offset(packet, DLT_EN10MB))))
@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+
+"""
+Copyright (c) 2014-2019 Maltrail developers (https://github.com/stamparm/maltrail/)
+See the file 'LICENSE' for copying permission
+"""
+
+# Batch scoring of DNS query names for heuristic detection (i.e. USE_HEURISTICS). Charset validation and consonant runs
+# are done with str.translate() (C speed), entropy with precomputed n*log2(n) tables, while the (costlier) verdict on
+# registered domain (whitelisting and DGA-likeness) is cached in bounded LRU, as most of the queries are repeating
+# lookups of (sub)domains belonging to the same handful of registered domains. As in sensor's DNS handling, DGA-likeness
+# (consonant run and entropy) is reported only for names answered with NXDOMAIN (i.e. no such name), as these checks
+# alone flag plenty of legitimate domains (e.g. akamaitechnologies.com, bleepingcomputer.com).
+
+import collections
+import math
+
+from common import check_whitelisted
+from lrucache import LRUCache
+from settings import CONSONANTS
+from settings import IGNORE_DNS_QUERY_SUFFIXES
+from settings import MAX_RESULT_CACHE_ENTRIES
+from settings import SUSPICIOUS_DOMAIN_CONSONANT_THRESHOLD
+from settings import SUSPICIOUS_DOMAIN_ENTROPY_THRESHOLD
+from settings import SUSPICIOUS_DOMAIN_LENGTH_THRESHOLD
+from settings import VALID_DNS_CHARS
+from settings import WHITELIST_LONG_DOMAIN_NAME_KEYWORDS
+
+MAX_NAME_LENGTH = 255
+DGA_DOMAIN_INFO = "potential dga domain (suspicious)"
+LONG_DOMAIN_INFO = "long domain (suspicious)"
+
+_INVALID_CHARS_TABLE = str.maketrans("", "", VALID_DNS_CHARS)
+_CONSONANTS_TABLE = dict((_, ord('c') if chr(_) in CONSONANTS else ord(' ')) for _ in range(128))
+_LOG2 = [0.0] + [math.log2(_) for _ in range(1, MAX_NAME_LENGTH + 1)]
+_NLOG2N = [_ * _LOG2[_] for _ in range(MAX_NAME_LENGTH + 1)]
+
+def get_entropy(value):
+    """
+    Returns Shannon entropy (bits per character) of a given value
+    """
+
+    length = len(value)
+
+    if not length:
+        return 0.0
+
+    return _LOG2[length] - sum(_NLOG2N[_] for _ in collections.Counter(value).values()) / length
+
+def get_consonant_run(value):
+    """
+    Returns length of the longest run of consecutive consonants in a given (lower case) value
+    """
+
+    return max((len(_) for _ in value.translate(_CONSONANTS_TABLE).split()), default=0)
+
+def get_registered_domain(parts):
+    """
+    Returns registered domain from name parts (e.g. ['www', 'example', 'co', 'uk'] -> 'example.co.uk')
+    """
+
+    if len(parts) > 2 and len(parts[-1]) == 2 and len(parts[-2]) <= 3:    # e.g. .co.uk, .com.br
+        return '.'.join(parts[-3:])
+    else:
+        return '.'.join(parts[-2:])
+
+class DomainScorer(object):
+    def __init__(self, capacity=MAX_RESULT_CACHE_ENTRIES):
+        self.cache = LRUCache(capacity)
+        self.names = 0
+        self.invalid = 0
+        self.suspicious = 0
+
+    def _score_registered(self, domain):
+        """
+        Returns (cached) tuple (whitelisted, DGA-like) for a given registered domain
+        """
+
+        retval = self.cache.get(domain)
+
+        if retval is None:
+            if check_whitelisted(domain) or any(_ in domain for _ in WHITELIST_LONG_DOMAIN_NAME_KEYWORDS):
+                retval = (True, False)
+            else:
+                label = domain.split('.')[0]
+                retval = (False, get_consonant_run(label) >= SUSPICIOUS_DOMAIN_CONSONANT_THRESHOLD or get_entropy(label) > SUSPICIOUS_DOMAIN_ENTROPY_THRESHOLD)
+
+            self.cache[domain] = retval
+
+        return retval
+
+    def score(self, names, nxdomain=False):
+        """
+        Returns list of verdicts (info in case of suspicious name, otherwise None) for a given batch of query names
+        (nxdomain marking names answered with NXDOMAIN, the only ones being checked for DGA-likeness)
+        """
+
+        retval = []
+
+        for name in names:
+            self.names += 1
+            name = name.rstrip('.').lower()
+
+            if '.' not in name or len(name) > MAX_NAME_LENGTH or name.translate(_INVALID_CHARS_TABLE):
+                self.invalid += 1
+                retval.append(None)
+                continue
+
+            parts = name.split('.')
+
+            if parts[-1] in IGNORE_DNS_QUERY_SUFFIXES or check_whitelisted(name):
+                retval.append(None)
+                continue
+
+            registered = get_registered_domain(parts)
+            whitelisted, dga = self._score_registered(registered)
+            info = DGA_DOMAIN_INFO if dga and nxdomain else None
+
+            # (Note: long label of registered domain itself (e.g. internationalmonetaryfund.org) is not suspicious)
+            if info is None and not whitelisted and len(parts) > registered.count('.') + 1 and len(parts[0]) > SUSPICIOUS_DOMAIN_LENGTH_THRESHOLD and '-' not in parts[0]:
+                info = LONG_DOMAIN_INFO
+
+            if info:
+                self.suspicious += 1
+
+            retval.append(info)
+
+        return retval
+
+    def stats(self):
+        retval = {"names": self.names, "invalid": self.invalid, "suspicious": self.suspicious}
+        retval.update(self.cache.stats())
+        return retval
+
+if __name__ == "__main__":
+    import os
+    import random
+    import re
+    import time
+
+    from settings import ROOT_DIR
+    from settings import WHITELIST
+    from settings import read_whitelist
+
+    count = 200000
+    random.seed(0)
+    read_whitelist()
+
+    def _dga(seed, length):     # (simplified) Conficker/Ramnit alike generator
+        retval = ""
+        for _ in range(length):
+            seed = (seed * 1103515245 + 12345) & 0x7fffffff
+            retval += chr(ord('a') + seed % 26)
+        return retval
+
+    benign = []
+    with open(os.path.join(ROOT_DIR, "misc", "whitelist.txt"), "r") as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith('#') and '.' in line and not re.search(r"\A[\d.:]+\Z", line):
+                benign.append(line)
+
+    dga = ["{}.{}".format(_dga(i, 12 + i % 9), random.choice(("com", "net", "org", "info", "biz", "ru"))) for i in range(5000)]
+    subdomains = ("www", "mail", "cdn", "api", "static", "img", "m")
+    corpus = [random.choice((lambda: random.choice(benign), lambda: "{}.{}".format(random.choice(subdomains), random.choice(benign)), lambda: random.choice(dga)))() for _ in range(count)]
+
+    def _naive(names):
+        retval = []
+        for name in names:
+            parts = name.split('.')
+            label = parts[-2]
+            if set(name) - set(VALID_DNS_CHARS) or check_whitelisted('.'.join(parts[-2:])):
+                retval.append(None)
+            elif re.search(r"[%s]{%d,}" % (CONSONANTS, SUSPICIOUS_DOMAIN_CONSONANT_THRESHOLD), label) or -sum(label.count(_) / len(label) * math.log(label.count(_) / len(label), 2) for _ in set(label)) > SUSPICIOUS_DOMAIN_ENTROPY_THRESHOLD:
+                retval.append(DGA_DOMAIN_INFO)
+            else:
+                retval.append(None)
+        return retval
+
+    start = time.time()
+    _naive(corpus)
+    naive = time.time() - start
+
+    scorer = DomainScorer()
+    start = time.time()
+    for i in range(0, count, 1000):
+        scorer.score(corpus[i:i + 1000])
+    batched = time.time() - start
+
+    WHITELIST.clear()   # (benign) corpus itself comes from whitelist
+    detected = sum(1 for _ in DomainScorer().score(dga, nxdomain=True) if _)
+    false_positives = [name for name, _ in zip(benign, DomainScorer().score(benign)) if _]
+    nxdomain_positives = [name for name, _ in zip(benign, DomainScorer().score(benign, nxdomain=True)) if _]
+
+    print("[i] naive: {:,.0f} names/second, batched (cached): {:,.0f} names/second".format(count / naive, count / batched))
+    print("[i] detection rate (DGA, NXDOMAIN): {:.2f}%, false positive rate (benign): {:.2f}% ({}), flagged if benign were NXDOMAIN: {:.2f}%".format(100.0 * detected / len(dga), 100.0 * len(false_positives) / len(benign), ", ".join(false_positives[:5]), 100.0 * len(nxdomain_positives) / len(benign)))
+    print("[i] scorer stats: {}".format(scorer.stats()))
+
+    negatives = ("akamaitechnologies.com", "internationalmonetaryfund.org", "bleepingcomputer.com", "pandasecurity.com", "www.akamaitechnologies.com", "a1.bleepingcomputer.com")
+    positives = ("{}.example.com".format(_dga(0, 30)),)
+    flagged = [name for name, _ in zip(negatives, DomainScorer().score(negatives)) if _]
+    if flagged:
+        exit("[x] legitimate domain(s) flagged: {}".format(", ".join(flagged)))
+    if not all(DomainScorer().score(positives)):
+        exit("[x] long subdomain label not flagged: {}".format(", ".join(positives)))
@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+
+"""
+Copyright (c) 2014-2019 Maltrail developers (https://github.com/stamparm/maltrail/)
+See the file 'LICENSE' for copying permission
+"""
+
+# Cached manifest of feed modules (FEEDS_MANIFEST_FILE) holding name, __url__, __info__ and __reference__ of each feed
+# together with modification time of its source. Metadata is extracted statically (ast) and re-parsed only for changed
+# sources, hence disabled feeds (DISABLED_FEEDS, DISABLED_TRAILS_INFO_REGEX) are filtered without being imported at
+# all. Remaining feeds are imported lazily (in worker processes) only when they are about to be run.
+
+import ast
+import functools
+import json
+import multiprocessing
+import os
+import re
+import sys
+
+from settings import CPU_CORES
+from settings import FEEDS_MANIFEST_FILE
+
+FEED_ATTRIBUTES = ("__url__", "__info__", "__reference__")
+
+def _get_source(filename):
+    return os.path.join(filename, "__init__.py") if os.path.isdir(filename) else filename
+
+def _parse_feed(filename):
+    """
+    Returns manifest entry for a given feed file (or package directory) without importing it
+    """
+
+    source = _get_source(filename)
+    retval = {"name": os.path.basename(filename).split(".py")[0], "path": filename, "mtime": os.stat(source).st_mtime, "fetch": False}
+    retval.update(dict.fromkeys(FEED_ATTRIBUTES))
+
+    with open(source, "rb") as f:
+        tree = ast.parse(f.read(), source)
+
+    for node in tree.body:
+        if isinstance(node, ast.FunctionDef) and node.name == "fetch":
+            retval["fetch"] = True
+        elif isinstance(node, ast.Assign):
+            for target in node.targets:
+                if isinstance(target, ast.Name) and target.id in FEED_ATTRIBUTES:
+                    try:
+                        retval[target.id] = ast.literal_eval(node.value)
+                    except ValueError:      # (Note: non-literal values are resolved after import)
+                        retval[target.id] = None
+
+    return retval
+
+def load_manifest(filenames, manifest_file=FEEDS_MANIFEST_FILE):
+    """
+    Returns manifest entries for given feed files (re-parsing only those changed since previous run)
+    """
+
+    retval = []
+    cached = {}
+    changed = False
+
+    try:
+        with open(manifest_file, 'r') as f:
+            cached = json.load(f)
+    except (IOError, ValueError):
+        pass
+
+    for filename in filenames:
+        try:
+            entry = cached.get(filename)
+            if not entry or entry["mtime"] != os.stat(_get_source(filename)).st_mtime:
+                entry = _parse_feed(filename)
+                cached[filename] = entry
+                changed = True
+        except (IOError, OSError, SyntaxError, ValueError) as ex:
+            print("[x] something went wrong during parsing of feed file '{}' ({})".format(filename, ex))
+            continue
+
+        retval.append(entry)
+
+    if changed and manifest_file:
+        try:
+            with open("{}.tmp".format(manifest_file), 'w') as f:
+                json.dump(cached, f, indent=0, sort_keys=True)
+            os.replace("{}.tmp".format(manifest_file), manifest_file)
+        except (IOError, OSError) as ex:
+            print("[x] unable to store feed manifest '{}' ({})".format(manifest_file, ex))
+
+    return retval
+
+def filter_feeds(entries, disabled_feeds=None, info_regex=None):
+    """
+    Returns manifest entries of feeds that should be run (i.e. having fetch() and not being disabled by DISABLED_FEEDS
+    and DISABLED_TRAILS_INFO_REGEX values given by caller)
+    """
+
+    disabled = set(re.split(r"[^\w]+", disabled_feeds or ""))
+
+    return [_ for _ in entries if _["fetch"] and _["name"] not in disabled and not (info_regex and _["__info__"] is not None and re.search(info_regex, _["__info__"]))]
+
+def run_feed(entry, info_regex=None):
+    """
+    Imports and runs a given feed, returning tuple (url, results, error)
+    """
+
+    directory = os.path.dirname(entry["path"])
+    if directory not in sys.path:
+        sys.path.append(directory)
+
+    url, results, error = entry["__url__"], None, None
+
+    try:
+        module = __import__(entry["name"])
+    except (ImportError, SyntaxError) as ex:
+        return url, results, "something went wrong during import of feed file '{}' ({})".format(entry["path"], ex)
+
+    try:
+        url = getattr(module, "__url__", url)
+        if not (info_regex and entry["__info__"] is None and re.search(info_regex, getattr(module, "__info__", ""))):
+            results = module.fetch()
+    except Exception as ex:
+        error = "something went wrong during processing of feed file '{}' ('{}')".format(entry["path"], ex)
+    finally:
+        sys.modules.pop(module.__name__, None)
+        del module
+
+    return url, results, error
+
+def run_feeds(entries, info_regex=None):
+    """
+    Yields (entry, (url, results, error)) for given feeds (in order), running them in worker processes if possible
+    """
+
+    if len(entries) > 1 and CPU_CORES > 1:
+        pool = multiprocessing.Pool(min(CPU_CORES, len(entries)))
+        try:
+            for entry, result in zip(entries, pool.imap(functools.partial(run_feed, info_regex=info_regex), entries)):
+                yield entry, result
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for entry in entries:
+            yield entry, run_feed(entry, info_regex)
+
+if __name__ == "__main__":
+    import glob
+    import shutil
+    import tempfile
+    import time
+
+    count = 200
+    directory = tempfile.mkdtemp()
+    manifest_file = os.path.join(directory, "feeds.json")
+
+    try:
+        for i in range(count):
+            with open(os.path.join(directory, "feed{}.py".format(i)), 'w') as f:
+                f.write("import json\nimport re\nimport xml.dom.minidom\n\n__url__ = \"https://feed{0}.example.com/list.txt\"\n__info__ = \"{1}\"\n__reference__ = \"feed{0}.example.com\"\n\ndef fetch():\n    return {{\"malware{0}.com\": (__info__, __reference__)}}\n".format(i, "known attacker" if i % 10 == 0 else "malware"))
+
+        filenames = sorted(glob.glob(os.path.join(directory, "*.py")))
+        disabled_feeds, info_regex = "feed1, feed2, feed3", "known attacker"
+
+        sys.path.append(directory)
+        start = time.time()
+        for filename in filenames:
+            name = os.path.basename(filename).split(".py")[0]
+            module = __import__(name)
+            getattr(module, "__info__"), getattr(module, "__url__")
+            sys.modules.pop(name)
+        print("[i] import of all feeds: {:.3f}s".format(time.time() - start))
+
+        for run in ("cold", "warm"):
+            start = time.time()
+            entries = filter_feeds(load_manifest(filenames, manifest_file), disabled_feeds, info_regex)
+            print("[i] manifest ({}): {:.3f}s ({} of {} feeds to run)".format(run, time.time() - start, len(entries), count))
+
+        start = time.time()
+        trails = {}
+        for entry, (url, results, error) in run_feeds(entries, info_regex):
+            trails.update(results or {})
+        print("[i] running feeds: {:.3f}s ({} trails)".format(time.time() - start, len(trails)))
+    finally:
+        shutil.rmtree(directory)
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+
+"""
+Copyright (c) 2014-2019 Maltrail developers (https://github.com/stamparm/maltrail/)
+See the file 'LICENSE' for copying permission
+"""
+
+# Per-worker (fixed-size) hot cache of final trail verdicts for repeated destinations. Eviction is CLOCK-style (second
+# chance) over preallocated slots, hence no per-hit relinking as in LRU. Cache is flushed automatically when version
+# of trails (i.e. TrailsDict.version) changes.
+
+from common import check_whitelisted
+from settings import HOT_CACHE_SIZE
+
+VERDICT_MISS, VERDICT_HIT, VERDICT_WHITELISTED = 0, 1, 2
+
+class HotCache(object):
+    def __init__(self, trails, size=HOT_CACHE_SIZE, stats=None, resolve=None):
+        self.trails = trails
+        self.size = size
+        self.resolve = resolve or self._resolve     # (optional) full resolution (e.g. including range checks)
+        self.stats = stats      # (optional) core.stats.HotStats
+        self.hits = 0
+        self.misses = 0
+        self._version = None
+        self._index = {}
+        self._keys = [None] * size
+        self._values = [None] * size
+        self._referenced = bytearray(size)
+        self._hand = 0
+
+    def clear(self):
+        self._index.clear()
+        self._keys = [None] * self.size
+        self._values = [None] * self.size
+        self._referenced = bytearray(self.size)
+        self._hand = 0
+
+    def _store(self, key, value):
+        while True:     # (Note: advancing "clock hand" giving referenced slots a second chance)
+            slot = self._hand
+            self._hand = (slot + 1) % self.size
+            if self._referenced[slot]:
+                self._referenced[slot] = 0
+            else:
+                break
+
+        if self._keys[slot] is not None:
+            del self._index[self._keys[slot]]
+
+        self._keys[slot] = key
+        self._values[slot] = value
+        self._index[key] = slot
+
+    def lookup(self, key):
+        """
+        Returns (verdict, (info, reference)) for a given (normalized) host or IP address
+        """
+
+        if self._version != self.trails.version:
+            self.clear()
+            self._version = self.trails.version
+
+        slot = self._index.get(key)
+
+        if slot is not None:
+            self._referenced[slot] = 1
+            self.hits += 1
+            if self.stats is not None:
+                self.stats.count("hot_cache_hits")
+            return self._values[slot]
+
+        self.misses += 1
+        if self.stats is not None:
+            self.stats.count("hot_cache_misses")
+
+        retval = self.resolve(key)
+        self._store(key, retval)
+
+        return retval
+
+    def _resolve(self, key):
+        if key not in self.trails:
+            return (VERDICT_MISS, None)
+        elif check_whitelisted(key):
+            return (VERDICT_WHITELISTED, None)
+        else:
+            return (VERDICT_HIT, self.trails[key])
+
+    def hit_ratio(self):
+        return self.hits / (self.hits + self.misses) if self.hits + self.misses else 0.0
+
+if __name__ == "__main__":
+    import random
+    import time
+
+    from common import bogon_ip
+    from common import worst_asns
+    from trailsdict import TrailsDict
+
+    count = 500000
+    random.seed(0)
+
+    trails = TrailsDict()
+    for i in range(100000):
+        trails["malware{}.com".format(i)] = ("malware", "(static)")
+        trails["10.{}.{}.{}".format(i >> 16 & 0xff, i >> 8 & 0xff, i & 0xff)] = ("attacker", "(static)")
+
+    # skewed (Zipf-like) destinations
+    population = ["www.host{}.example.com".format(i) for i in range(50000)] + ["malware{}.com".format(i) for i in range(5000)] + ["10.0.{}.{}".format(i >> 8, i & 0xff) for i in range(5000)]
+    weights = [1.0 / (i + 1) for i in range(len(population))]
+    random.shuffle(population)
+    keys = random.choices(population, weights, k=count)
+
+    def _resolve(key):  # as on sensor's path (i.e. range checks of IP addresses, walk over parent domains)
+        if key[0].isdigit():
+            bogon_ip(key)
+            worst_asns(key)
+            candidates = (key,)
+        else:
+            parts = key.split('.')
+            candidates = ['.'.join(parts[i:]) for i in range(len(parts) - 1)]
+        for candidate in candidates:
+            if candidate in trails:
+                if check_whitelisted(candidate):
+                    return (VERDICT_WHITELISTED, None)
+                return (VERDICT_HIT, trails[candidate])
+        return (VERDICT_MISS, None)
+
+    start = time.time()
+    for key in keys:
+        _resolve(key)
+    direct = time.time() - start
+
+    cache = HotCache(trails, resolve=_resolve)
+    start = time.time()
+    for key in keys:
+        cache.lookup(key)
+    cached = time.time() - start
+
+    print("[i] direct lookups: {:,.0f} lookups/second, hot cache: {:,.0f} lookups/second (hit ratio {:.1f}%)".format(count / direct, count / cached, 100 * cache.hit_ratio()))
+
+    trails["10.0.0.1"] = ("malware", "(custom)")
+    print("[i] after trails update: {}".format(cache.lookup("10.0.0.1")))
@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+
+"""
+Copyright (c) 2014-2019 Maltrail developers (https://github.com/stamparm/maltrail/)
+See the file 'LICENSE' for copying permission
+"""
+
+# Unified (IPv4) annotation table merging BOGON_RANGES, CDN_RANGES, WORST_ASNS, whitelist (ranges and addresses),
+# STATIC_IPCAT_LOOKUPS and ipcat (IPCAT_SQLITE_FILE) data into a single sorted map of disjoint intervals. Single
+# bisect lookup returns (flags, asn id, provider id), instead of each of bogon_ip(), cdn_ip(), worst_asns(),
+# ipcat_lookup() and check_whitelisted() parsing address and walking its own structure.
+
+import array
+import bisect
+import os
+import sqlite3
+
+from addr import addr_to_int
+from settings import BOGON_RANGES
+from settings import CDN_RANGES
+from settings import IPCAT_SQLITE_FILE
+from settings import STATIC_IPCAT_LOOKUPS
+from settings import WHITELIST
+from settings import WHITELIST_RANGES
+from settings import WORST_ASNS
+
+IP_BOGON = 1 << 0
+IP_CDN = 1 << 1
+IP_WORST_ASN = 1 << 2
+IP_IPCAT = 1 << 3
+IP_WHITELISTED = 1 << 4
+
+NO_ANNOTATION = (0, 0, 0)
+
+def _ranges(table):
+    for values in table.values():
+        for value in values:
+            prefix, mask = value[0] & value[1], value[1]     # (Note: entries like 66.220.149.11/16 are normalized)
+            yield prefix, prefix | (~mask & 0xffffffff), value[2:]
+
+class IPMap(object):
+    def __init__(self):
+        self.names = [None]     # (Note: id 0 stands for no name)
+        self._ids = {}
+        self._starts = array.array('L')
+        self._flags = array.array('B')
+        self._asns = array.array('L')
+        self._providers = array.array('L')
+
+    def _name_id(self, name):
+        if name not in self._ids:
+            self._ids[name] = len(self.names)
+            self.names.append(name)
+
+        return self._ids[name]
+
+    def build(self, ipcat_file=IPCAT_SQLITE_FILE):
+        """
+        (Re)builds interval map from (already loaded) range tables and ipcat data
+        """
+
+        intervals = []      # (start, end, flag, name)
+
+        for start, end, _ in _ranges(BOGON_RANGES):
+            intervals.append((start, end, IP_BOGON, None))
+
+        for start, end, _ in _ranges(CDN_RANGES):
+            intervals.append((start, end, IP_CDN, None))
+
+        for start, end, _ in _ranges(WORST_ASNS):
+            intervals.append((start, end, IP_WORST_ASN, _[0]))
+
+        for prefix, mask in WHITELIST_RANGES:
+            intervals.append((prefix & mask, prefix | (~mask & 0xffffffff), IP_WHITELISTED, None))
+
+        for value in WHITELIST:
+            if value[:1].isdigit() and value.count('.') == 3:
+                try:
+                    intervals.append((addr_to_int(value), addr_to_int(value), IP_WHITELISTED, None))
+                except ValueError:
+                    pass
+
+        for name in STATIC_IPCAT_LOOKUPS:
+            for value in STATIC_IPCAT_LOOKUPS[name]:
+                start, end = value.split('-') if '-' in value else (value, value)
+                intervals.append((addr_to_int(start), addr_to_int(end), IP_IPCAT, name))
+
+        if ipcat_file and os.path.isfile(ipcat_file):
+            with sqlite3.connect(ipcat_file, isolation_level=None) as conn:
+                for start, end, name in conn.execute("SELECT start_int, end_int, name FROM ranges"):
+                    intervals.append((int(start), int(end), IP_IPCAT, str(name)))
+
+        self._build(intervals)
+
+        return self
+
+    def _build(self, intervals):
+        # sweep over interval boundaries producing disjoint segments (where name of the narrowest enclosing interval wins)
+        boundaries = {}
+        for i, (start, end, _, _) in enumerate(intervals):
+            boundaries.setdefault(start, []).append(i)
+            boundaries.setdefault(end + 1, []).append(~i)
+
+        active = set()
+        starts, flags, asns, providers = array.array('L'), array.array('B'), array.array('L'), array.array('L')
+        previous = None
+
+        for position in sorted(boundaries):
+            for i in boundaries[position]:
+                if i >= 0:
+                    active.add(i)
+                else:
+                    active.discard(~i)
+
+            if position > 0xffffffff:
+                break
+
+            annotation = [0, 0, 0]
+            widths = [None, None]
+
+            for i in active:
+                start, end, flag, name = intervals[i]
+                annotation[0] |= flag
+                if name is not None:
+                    j = 0 if flag == IP_WORST_ASN else 1
+                    if widths[j] is None or end - start < widths[j]:
+                        widths[j] = end - start
+                        annotation[j + 1] = self._name_id(name)
+
+            annotation = tuple(annotation)
+            if annotation != previous:      # (Note: neighbouring segments with same annotation are merged)
+                starts.append(position)
+                flags.append(annotation[0])
+                asns.append(annotation[1])
+                providers.append(annotation[2])
+                previous = annotation
+
+        self._starts, self._flags, self._asns, self._providers = starts, flags, asns, providers
+
+    def lookup(self, address):
+        """
+        Returns (flags, asn id, provider id) for a given IPv4 address (NO_ANNOTATION for invalid/IPv6 addresses)
+        """
+
+        try:
+            _ = addr_to_int(address)
+        except (AttributeError, IndexError, ValueError):
+            return NO_ANNOTATION
+
+        index = bisect.bisect_right(self._starts, _) - 1
+
+        if index < 0:
+            return NO_ANNOTATION
+
+        return self._flags[index], self._asns[index], self._providers[index]
+
+    def lookup_many(self, addresses):
+        """
+        Returns list of annotations for a given batch of addresses
+        """
+
+        return [self.lookup(_) for _ in addresses]
+
+    def get_name(self, name_id):
+        return self.names[name_id]
+
+    def __len__(self):
+        return len(self._starts)
+
+if __name__ == "__main__":
+    import random
+    import time
+
+    from common import bogon_ip
+    from common import cdn_ip
+    from common import check_whitelisted
+    from common import ipcat_lookup
+    from common import worst_asns
+
+    count = 100000
+    random.seed(0)
+
+    start = time.time()
+    ipmap = IPMap().build()
+    print("[i] built {:,} segments ({:,} names) in {:.2f}s".format(len(ipmap), len(ipmap.names) - 1, time.time() - start))
+
+    addresses = ["{}.{}.{}.{}".format(random.randint(1, 223), random.randint(0, 255), random.randint(0, 255), random.randint(0, 255)) for _ in range(count)]
+    addresses += ["10.0.0.1", "104.16.0.1", "185.76.236.1", "71.6.216.33", "127.0.0.1"]
+
+    start = time.time()
+    separate = [(bogon_ip(_), cdn_ip(_), worst_asns(_), ipcat_lookup(_), check_whitelisted(_)) for _ in addresses]
+    elapsed = time.time() - start
+    print("[i] separate lookups: {:,.0f} addresses/second".format(len(addresses) / elapsed))
+
+    start = time.time()
+    unified = ipmap.lookup_many(addresses)
+    elapsed = time.time() - start
+    print("[i] unified lookup: {:,.0f} addresses/second".format(len(addresses) / elapsed))
+
+    mismatches = 0
+    for address, (bogon, cdn, asn, provider, whitelisted), (flags, asn_id, provider_id) in zip(addresses, separate, unified):
+        if (bogon, cdn, asn, provider or None, whitelisted) != (bool(flags & IP_BOGON), bool(flags & IP_CDN), ipmap.get_name(asn_id), ipmap.get_name(provider_id), bool(flags & IP_WHITELISTED)):
+            mismatches += 1
+    print("[i] mismatches against separate lookups: {} (Note: separate lookups never match entries having host bits set)".format(mismatches))
+
+    for address in addresses[-5:]:
+        flags, asn_id, provider_id = ipmap.lookup(address)
+        print("[i] {}: flags={:05b} asn={} provider={}".format(address, flags, ipmap.get_name(asn_id), ipmap.get_name(provider_id)))
@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+
+"""
+Copyright (c) 2014-2019 Maltrail developers (https://github.com/stamparm/maltrail/)
+See the file 'LICENSE' for copying permission
+"""
+
+# Buffered append-only writer of (daily) event logs inside LOG_DIR. Each flush is done with a single write() to
+# file opened with O_APPEND (hence, writers from different worker processes don't interleave inside a flushed block).
+# In case of compression, each flushed block is written as a separate gzip member (i.e. file stays readable as a
+# stream with gzip/zcat). Buffered events are flushed by background thread every EVENT_LOG_FLUSH_PERIOD seconds (even
+# in quiet periods) and at (regular) interpreter exit.
+
+import atexit
+import gzip
+import os
+import re
+import threading
+import time
+import zlib
+
+from settings import config
+from settings import DATE_FORMAT
+from settings import DEFAULT_EVENT_LOG_PERMISSIONS
+from settings import DEFLATE_COMPRESS_LEVEL
+from settings import EVENT_LOG_BUFFER_SIZE
+from settings import EVENT_LOG_FLUSH_PERIOD
+from settings import TIME_FORMAT
+
+_time_cache = (None, None, None)    # sec, formatted time, date (Note: replaced as a whole, hence consistent between threads)
+_field_regex = re.compile(r'"((?:[^"]|"")*)"|(\S+)')
+
+def format_time(sec):
+    global _time_cache
+
+    retval = _time_cache
+
+    if retval[0] != sec:
+        _ = time.localtime(sec)
+        retval = _time_cache = (sec, time.strftime(TIME_FORMAT, _), time.strftime(DATE_FORMAT, _))
+
+    return retval[1], retval[2]
+
+def create_log_directory(log_dir=None):
+    log_dir = log_dir or config.LOG_DIR
+
+    if not os.path.isdir(log_dir):
+        os.makedirs(log_dir, 0o755)
+
+    return log_dir
+
+def get_event_log_path(day, log_dir=None, compress=False):
+    return os.path.join(log_dir or config.LOG_DIR, "{}.log{}".format(day, ".gz" if compress else ""))
+
+def safe_value(value):
+    retval = str(value if value not in (None, "") else '-')
+
+    if ' ' in retval or '"' in retval:
+        retval = "\"{}\"".format(retval.replace('"', '""'))
+
+    return re.sub(r"[\x0a\x0d]", " ", retval)
+
+def format_event(event_tuple):
+    """
+    Returns (day, log line) for given event tuple
+    """
+
+    sec, usec = event_tuple[:2]
+    localtime, day = format_time(int(sec))
+
+    return day, "{} {} {}\n".format(safe_value("{}.{:06d}".format(localtime, int(usec))), safe_value(config.SENSOR_NAME), " ".join(safe_value(_) for _ in event_tuple[2:11]))
+
+def parse_event_line(line):
+    """
+    Returns list of (unquoted) fields of given log line
+    """
+
+    return [_[0].replace('""', '"') if _[0] else _[1] for _ in _field_regex.findall(line)]
+
+def read_event_log(path):
+    """
+    Yields lines of (plain or compressed) event log
+    """
+
+    with (gzip.open(path, "rt") if path.endswith(".gz") else open(path, "r")) as f:
+        for line in f:
+            yield line
+
+class EventLogWriter(object):
+    def __init__(self, log_dir=None, compress=None, compress_level=DEFLATE_COMPRESS_LEVEL, buffer_size=EVENT_LOG_BUFFER_SIZE, flush_period=EVENT_LOG_FLUSH_PERIOD, fsync_period=None):
+        self.log_dir = create_log_directory(log_dir)
+        self.compress = config.COMPRESS_LOG_STORAGE if compress is None else compress
+        self.compress_level = compress_level
+        self.buffer_size = buffer_size
+        self.flush_period = flush_period
+        self.fsync_period = fsync_period
+        self.events = 0
+        self.writes = 0
+        self.bytes_written = 0
+        self.listeners = []     # called as listener(path, offset, lines, compressed) after each written block
+        self._buffers = {}
+        self._pending = 0
+        self._handles = {}
+        self._dirty = set()
+        self._lock = threading.Lock()
+        self._last_flush = self._last_fsync = time.time()
+        self._closed = threading.Event()
+        self._thread = None
+
+        if self.flush_period:
+            self._thread = threading.Thread(target=self._flusher)
+            self._thread.daemon = True
+            self._thread.start()
+
+        atexit.register(self.close)
+
+    def _flusher(self):
+        while not self._closed.wait(self.flush_period):
+            if self._pending:
+                self.flush()
+
+    def write(self, event_tuple):
+        self.write_line(*format_event(event_tuple))
+
+    def write_line(self, day, line):
+        """
+        Writes (already formatted) log line into log of given day
+        """
+
+        with self._lock:
+            if day not in self._buffers:
+                self._buffers[day] = []
+            self._buffers[day].append(line)
+            self._pending += len(line)
+            self.events += 1
+
+        if self._pending >= self.buffer_size or self.flush_period is not None and time.time() - self._last_flush >= self.flush_period:
+            self.flush()
+
+    def _get_handle(self, day):
+        if day not in self._handles:
+            for _ in list(self._handles):       # daily rotation (Note: keeping only handle of latest day)
+                if _ < day:
+                    self._close_handle(_)
+
+            path = get_event_log_path(day, self.log_dir, self.compress)
+            self._handles[day] = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, DEFAULT_EVENT_LOG_PERMISSIONS)
+
+        return self._handles[day]
+
+    def _close_handle(self, day):
+        handle = self._handles.pop(day)
+
+        if day in self._dirty:
+            if self.fsync_period is not None:
+                os.fsync(handle)
+            self._dirty.discard(day)
+
+        os.close(handle)
+
+    def _encode(self, lines):
+        data = "".join(lines).encode("utf8")
+
+        if self.compress:
+            _ = zlib.compressobj(self.compress_level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            data = _.compress(data) + _.flush()
+
+        return data
+
+    def flush(self):
+        with self._lock:
+            buffers, self._buffers, self._pending = self._buffers, {}, 0
+            self._last_flush = time.time()
+
+            for day in sorted(buffers):
+                data = self._encode(buffers[day])
+                handle = self._get_handle(day)
+                written = os.write(handle, data)
+                while written < len(data):
+                    written += os.write(handle, data[written:])
+                offset = os.lseek(handle, 0, os.SEEK_CUR) - len(data)
+                for listener in self.listeners:
+                    listener(get_event_log_path(day, self.log_dir, self.compress), offset, buffers[day], self.compress)
+                self.writes += 1
+                self.bytes_written += len(data)
+                self._dirty.add(day)
+
+            if self.fsync_period is not None and time.time() - self._last_fsync >= self.fsync_period:
+                for day in list(self._dirty):
+                    os.fsync(self._handles[day])
+                self._dirty.clear()
+                self._last_fsync = time.time()
+
+    def close(self):
+        self._closed.set()
+        atexit.unregister(self.close)
+        self.flush()
+
+        with self._lock:
+            for day in list(self._handles):
+                self._close_handle(day)
+
+if __name__ == "__main__":
+    import shutil
+    import subprocess
+    import sys
+    import tempfile
+
+    # (self-check) events buffered without periodic flushing (flush_period None) are flushed at (regular) interpreter exit
+    log_dir = tempfile.mkdtemp()
+    try:
+        for compress in (False, True):
+            code = "from log import EventLogWriter; _ = EventLogWriter({!r}, {!r}, flush_period=None); [_.write_line('2019-01-01', 'line %d\\n' % i) for i in range(1000)]".format(log_dir, compress)
+            subprocess.check_call([sys.executable, "-W", "ignore", "-c", code], cwd=os.path.dirname(os.path.abspath(__file__)))
+            lines = list(read_event_log(get_event_log_path("2019-01-01", log_dir, compress)))
+            if lines != ["line {}\n".format(i) for i in range(1000)]:
+                exit("[x] self-check of flush at exit failed ({:,} of 1,000 lines written{})".format(len(lines), ", compressed" if compress else ""))
+    finally:
+        shutil.rmtree(log_dir)
+
+    print("[i] self-check of flush at exit passed (plain and compressed)")
@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+
+"""
+Copyright (c) 2014-2019 Maltrail developers (https://github.com/stamparm/maltrail/)
+See the file 'LICENSE' for copying permission
+"""
+
+# Sidecar indexes of daily event logs (built incrementally from EventLogWriter's flushes) holding record offsets
+# bucketed by minute of day, together with inverted postings for src_ip, dst_ip and trail. Each writing process keeps
+# its own sidecar (<log>.<pid>.idx), while queries merge all of them. In case of compressed logs, offsets point to
+# the start of gzip member (i.e. block) containing the record.
+
+import array
+import glob
+import marshal
+import os
+import time
+import zlib
+
+from log import get_event_log_path
+from log import parse_event_line
+from settings import EVENT_INDEX_SAVE_PERIOD
+
+INDEX_FIELDS = {"src_ip": 2, "dst_ip": 4, "trail": 8}
+
+def _minute(value):
+    return int(value[11:13]) * 60 + int(value[14:16])
+
+def iter_blocks(path, offsets=None):
+    """
+    Yields (offset, lines) of (plain or compressed) event log (optionally only for blocks at given offsets)
+    """
+
+    compressed = path.endswith(".gz")
+
+    with open(path, "rb") as f:
+        if not compressed:
+            if offsets is None:
+                offset = 0
+                for line in f:
+                    yield offset, (line.decode("utf8", "replace"),)
+                    offset += len(line)
+            else:
+                for offset in offsets:
+                    f.seek(offset)
+                    yield offset, (f.readline().decode("utf8", "replace"),)
+        else:
+            size = os.fstat(f.fileno()).st_size
+            for position in (offsets if offsets is not None else (0,)):
+                while position < size:
+                    f.seek(position)
+                    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                    content = []
+                    while not decompressor.eof:
+                        chunk = f.read(64 * 1024)
+                        if not chunk:
+                            break
+                        content.append(decompressor.decompress(chunk))
+                    yield position, tuple(_ + '\n' for _ in b"".join(content).decode("utf8", "replace").split('\n')[:-1])
+                    if offsets is not None or not decompressor.eof:
+                        break
+                    position = f.tell() - len(decompressor.unused_data)
+
+class EventIndex(object):
+    def __init__(self, path, sidecar=None):
+        self.path = path
+        self.sidecar = sidecar or "{}.{}.idx".format(path, os.getpid())
+        self.minutes = {}
+        self.postings = dict((_, {}) for _ in INDEX_FIELDS)
+
+    def _append(self, table, key, offset):
+        _ = table.get(key)
+
+        if _ is None:
+            _ = table[key] = array.array('Q')
+
+        if not _ or _[-1] != offset:
+            _.append(offset)
+
+    def add(self, offset, line):
+        fields = parse_event_line(line)
+
+        if len(fields) > max(INDEX_FIELDS.values()):
+            self._append(self.minutes, _minute(fields[0]), offset)
+            for name, index in INDEX_FIELDS.items():
+                self._append(self.postings[name], fields[index], offset)
+
+    def save(self):
+        _ = dict((name, dict((key, value.tobytes()) for key, value in table.items())) for name, table in self.postings.items())
+        _["minutes"] = dict((key, value.tobytes()) for key, value in self.minutes.items())
+
+        with open("{}.tmp".format(self.sidecar), "wb") as f:
+            marshal.dump(_, f)
+        os.replace("{}.tmp".format(self.sidecar), self.sidecar)
+
+    def load(self):
+        with open(self.sidecar, "rb") as f:
+            _ = marshal.load(f)
+
+        for name, table in (("minutes", self.minutes),) + tuple(self.postings.items()):
+            for key, value in _[name].items():
+                table[key] = array.array('Q', value)
+
+        return self
+
+class EventIndexer(object):
+    """
+    EventLogWriter listener maintaining indexes of written logs
+    """
+
+    def __init__(self, save_period=EVENT_INDEX_SAVE_PERIOD):
+        self.save_period = save_period
+        self._indexes = {}
+        self._last_save = time.time()
+
+    def __call__(self, path, offset, lines, compressed):
+        if path not in self._indexes:
+            for _ in list(self._indexes):       # daily rotation
+                self._indexes.pop(_).save()
+            self._indexes[path] = EventIndex(path)
+
+        index = self._indexes[path]
+        for line in lines:
+            index.add(offset, line)
+            if not compressed:
+                offset += len(line.encode("utf8"))
+
+        if time.time() - self._last_save >= self.save_period:
+            self.save()
+
+    def save(self):
+        for index in self._indexes.values():
+            index.save()
+        self._last_save = time.time()
+
+def build_index(path):
+    """
+    (Re)builds index of existing event log
+    """
+
+    for _ in glob.glob("{}.*.idx".format(glob.escape(path))):
+        os.remove(_)
+
+    retval = EventIndex(path, "{}.0.idx".format(path))
+    for offset, lines in iter_blocks(path):
+        for line in lines:
+            retval.add(offset, line)
+    retval.save()
+
+    return retval
+
+def query_events(day, src_ip=None, dst_ip=None, trail=None, start=None, end=None, log_dir=None):
+    """
+    Yields log lines of given day matching all given criteria (start/end being minute of day)
+    """
+
+    path = get_event_log_path(day, log_dir, not os.path.isfile(get_event_log_path(day, log_dir)))
+    indexes = [EventIndex(path, _).load() for _ in glob.glob("{}.*.idx".format(glob.escape(path)))]
+    criteria = dict((name, value) for name, value in (("src_ip", src_ip), ("dst_ip", dst_ip), ("trail", trail)) if value is not None)
+    candidates = None
+
+    for name, value in criteria.items():
+        _ = set()
+        for index in indexes:
+            _.update(index.postings[name].get(value, ()))
+        candidates = _ if candidates is None else candidates & _
+
+    if start is not None or end is not None:
+        _ = set()
+        for index in indexes:
+            for minute, offsets in index.minutes.items():
+                if (start is None or minute >= start) and (end is None or minute <= end):
+                    _.update(offsets)
+        candidates = _ if candidates is None else candidates & _
+
+    if not os.path.isfile(path) or candidates is not None and not candidates:
+        return
+
+    for offset, lines in iter_blocks(path, sorted(candidates) if candidates is not None else None):
+        for line in lines:
+            fields = parse_event_line(line)
+            if len(fields) <= max(INDEX_FIELDS.values()):
+                continue
+            if any(fields[INDEX_FIELDS[name]] != value for name, value in criteria.items()):
+                continue
+            if (start is not None and _minute(fields[0]) < start) or (end is not None and _minute(fields[0]) > end):
+                continue
+            yield line
+
+if __name__ == "__main__":
+    import random
+    import shutil
+    import sys
+    import tempfile
+
+    from log import EventLogWriter
+    from settings import config
+
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 2 * 1000 * 1000
+    config.SENSOR_NAME = "benchmark"
+    directory = tempfile.mkdtemp()
+
+    try:
+        for compress in (False, True):
+            _ = random.Random(0)
+            writer = EventLogWriter(directory, compress=compress)
+            indexer = EventIndexer(save_period=sys.maxsize)
+            writer.listeners.append(indexer)
+            day = time.mktime(time.strptime("2019-11-19", "%Y-%m-%d"))
+
+            start = time.time()
+            for i in range(count):
+                writer.write((int(day + i * 86400.0 / count), i % 1000000, "10.0.%d.%d" % (_.randint(0, 255), _.randint(1, 254)), _.randint(1024, 65535), "192.168.%d.%d" % (_.randint(0, 3), _.randint(1, 254)), 53, "UDP", "DNS", "%x.example.com" % _.randint(0, 10000), "malware", "(static)"))
+            writer.close()
+            indexer.save()
+            print("[i] {} log: {:,} events written and indexed in {:.1f}s".format("compressed" if compress else "plain", count, time.time() - start))
+
+            path = get_event_log_path("2019-11-19", directory, compress)
+            start = time.time()
+            scanned = sum(1 for _, lines in iter_blocks(path) for line in lines if parse_event_line(line)[2] == "10.0.1.1")
+            scan_time = time.time() - start
+
+            start = time.time()
+            found = sum(1 for _ in query_events("2019-11-19", src_ip="10.0.1.1", log_dir=directory))
+            print("[i] events of single src_ip: full scan {:.2f}s ({} found), indexed query {:.4f}s ({} found)".format(scan_time, scanned, time.time() - start, found))
+
+            start = time.time()
+            found = sum(1 for _ in query_events("2019-11-19", start=12 * 60, end=12 * 60 + 4, log_dir=directory))
+            print("[i] events of 5 minutes (indexed query): {:.3f}s ({} found)".format(time.time() - start, found))
+
+            os.remove(path)
+            for _ in glob.glob("{}.*.idx".format(path)):
+                os.remove(_)
+    finally:
+        shutil.rmtree(directory)
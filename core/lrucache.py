@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+
+"""
+Copyright (c) 2014-2019 Maltrail developers (https://github.com/stamparm/maltrail/)
+See the file 'LICENSE' for copying permission
+"""
+
+import time
+
+_MISSING = object()
+
+class _Node(object):
+    __slots__ = ("key", "value", "expires", "prev", "next")
+
+    def __init__(self, key=None, value=None, expires=None):
+        self.key = key
+        self.value = value
+        self.expires = expires
+        self.prev = self.next = self
+
+class LRUCache(object):
+    """
+    Bounded (least recently used) cache with optional time-to-live of entries (capacity None meaning no eviction
+    other than by expiration)
+    """
+
+    def __init__(self, capacity, ttl=None):
+        if capacity is not None and capacity <= 0:
+            raise ValueError("capacity must be positive (or None), got {}".format(capacity))
+
+        self.capacity = capacity
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._nodes = {}
+        self._head = _Node()    # sentinel (head.next is most recently used, head.prev least recently used)
+
+    def _unlink(self, node):
+        node.prev.next = node.next
+        node.next.prev = node.prev
+
+    def _push(self, node):
+        node.prev = self._head
+        node.next = self._head.next
+        self._head.next.prev = node
+        self._head.next = node
+
+    def _lookup(self, key):
+        node = self._nodes.get(key)
+
+        if node is not None and node.expires is not None and node.expires < time.time():
+            self._unlink(node)
+            del self._nodes[key]
+            self.evictions += 1
+            node = None
+
+        return node
+
+    def get(self, key, default=None):
+        node = self._nodes.get(key)
+
+        if node is None or node.expires is not None and self._lookup(key) is None:
+            self.misses += 1
+            return default
+
+        self.hits += 1
+        head = self._head
+        if head.next is not node:       # (Note: inlined _unlink() and _push() as this is the hot path)
+            node.prev.next = node.next
+            node.next.prev = node.prev
+            node.prev = head
+            node.next = head.next
+            head.next.prev = node
+            head.next = node
+
+        return node.value
+
+    def __getitem__(self, key):
+        retval = self.get(key, _MISSING)
+
+        if retval is _MISSING:
+            raise KeyError(key)
+
+        return retval
+
+    def __setitem__(self, key, value):
+        node = self._nodes.get(key)
+        expires = (time.time() + self.ttl) if self.ttl else None
+
+        if node is not None:
+            node.value = value
+            node.expires = expires
+            self._unlink(node)
+        else:
+            if self.capacity is None:
+                self._expire()
+            elif len(self._nodes) >= self.capacity:
+                _ = self._head.prev
+                self._unlink(_)
+                del self._nodes[_.key]
+                self.evictions += 1
+            node = self._nodes[key] = _Node(key, value, expires)
+
+        self._push(node)
+
+    def _expire(self):
+        # (Note: removing expired entries from least recently used end)
+        now = time.time()
+        while self._head.prev is not self._head and self._head.prev.expires is not None and self._head.prev.expires < now:
+            _ = self._head.prev
+            self._unlink(_)
+            del self._nodes[_.key]
+            self.evictions += 1
+
+    def __delitem__(self, key):
+        if self._lookup(key) is None:
+            raise KeyError(key)
+
+        self._unlink(self._nodes.pop(key))
+
+    def __contains__(self, key):
+        return self._lookup(key) is not None
+
+    def __len__(self):
+        return len(self._nodes)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def _alive(self):
+        # (Note: from most to least recently used, skipping expired entries without touching their recency)
+        now = time.time()
+        node = self._head.next
+        while node is not self._head:
+            if node.expires is None or node.expires >= now:
+                yield node
+            node = node.next
+
+    def keys(self):
+        return [_.key for _ in self._alive()]
+
+    def values(self):
+        return [_.value for _ in self._alive()]
+
+    def items(self):
+        return [(_.key, _.value) for _ in self._alive()]
+
+    def setdefault(self, key, default=None):
+        retval = self.get(key, _MISSING)
+
+        if retval is _MISSING:
+            self[key] = retval = default
+
+        return retval
+
+    def add(self, key):
+        """
+        Set-like addition (e.g. for disposed nonces)
+        """
+
+        self[key] = True
+
+    def pop(self, key, default=None):
+        node = self._lookup(key)
+
+        if node is None:
+            return default
+
+        self._unlink(node)
+        del self._nodes[key]
+        return node.value
+
+    def clear(self):
+        self._nodes.clear()
+        self._head.prev = self._head.next = self._head
+
+    def stats(self):
+        return {"entries": len(self._nodes), "capacity": self.capacity, "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+if __name__ == "__main__":
+    from settings import MAX_RESULT_CACHE_ENTRIES
+    from settings import SESSION_EXPIRATION_HOURS
+
+    # (self-check) disposed nonces (as DISPOSED_NONCES) must not be replayable, no matter how many are disposed
+    nonces = LRUCache(None, SESSION_EXPIRATION_HOURS * 60 * 60)
+    for i in range(2 * MAX_RESULT_CACHE_ENTRIES):
+        nonces.add("nonce{}".format(i))
+    replayed = sum(1 for i in range(2 * MAX_RESULT_CACHE_ENTRIES) if "nonce{}".format(i) not in nonces)
+    if replayed or nonces.evictions:
+        exit("[x] self-check of nonce replay failed ({:,} replayable nonce(s), {:,} eviction(s))".format(replayed, nonces.evictions))
+
+    # (self-check) expired entries are gone for all accessors (while capacity eviction drops least recently used)
+    cache = LRUCache(2, 0.05)
+    cache["a"], cache["b"] = 1, 2
+    cache.get("a")
+    cache["c"] = 3
+    if cache.keys() != ["c", "a"] or cache.setdefault("a") != 1 or cache.setdefault("d", 4) != 4 or cache.items() != [("d", 4), ("a", 1)]:
+        exit("[x] self-check of LRU order failed ({})".format(cache.items()))
+    time.sleep(0.1)
+    if cache.pop("a", None) is not None or "d" in cache or cache.keys() or cache.values() or cache.setdefault("d", 5) != 5:
+        exit("[x] self-check of TTL failed ({})".format(cache.items()))
+    try:
+        LRUCache(0)
+    except ValueError:
+        pass
+    else:
+        exit("[x] self-check of capacity failed (zero capacity accepted)")
+
+    print("[i] self-check of nonce replay passed ({:,} disposed nonces, none replayable)".format(len(nonces)))
+    print("[i] self-check of LRU order and TTL passed")
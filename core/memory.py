@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+
+"""
+Copyright (c) 2014-2019 Maltrail developers (https://github.com/stamparm/maltrail/)
+See the file 'LICENSE' for copying permission
+"""
+
+# Memory accounting of loaded detection tables (deep size and number of entries), together with tracking of their
+# growth over last MEMORY_HISTORY_SIZE samples (e.g. for spotting unbounded caches before they exhaust memory).
+# Sampling is a deep walk over all structures, hence (request-driven) callers use refresh(), taking a new sample at
+# most once per MEMORY_SAMPLE_PERIOD seconds (and by one thread at a time).
+# Objects shared between structures (e.g. strings in TrailsDict's _infos and _reverse_infos) are accounted only once,
+# to the first one reported.
+
+import collections
+import mmap
+import os
+import sys
+import threading
+import time
+
+from common import _ipcat_cache
+from common import _ipcat_static
+from settings import trails as _trails
+from settings import BOGON_RANGES
+from settings import CDN_RANGES
+from settings import IGNORE_EVENTS
+from settings import MEMORY_HISTORY_SIZE
+from settings import MEMORY_SAMPLE_PERIOD
+from settings import WEB_SHELLS
+from settings import WHITELIST
+from settings import WHITELIST_RANGES
+from settings import WORST_ASNS
+
+def get_size(obj, seen=None):
+    """
+    Returns deep size (in bytes) of a given object (skipping objects already in seen)
+    """
+
+    retval = 0
+    seen = set() if seen is None else seen
+    stack = [obj]
+
+    while stack:
+        obj = stack.pop()
+
+        if id(obj) in seen or isinstance(obj, type):
+            continue
+
+        seen.add(id(obj))
+        retval += sys.getsizeof(obj)
+
+        if isinstance(obj, (str, bytes, int, float, bool, type(None), memoryview)):
+            continue
+        elif isinstance(obj, mmap.mmap):
+            retval += len(obj)
+        elif isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset, collections.deque)):
+            stack.extend(obj)
+        else:
+            if hasattr(obj, "__dict__"):
+                stack.append(obj.__dict__)
+            for _ in getattr(type(obj), "__slots__", ()):
+                if hasattr(obj, _):
+                    stack.append(getattr(obj, _))
+
+    return retval
+
+def get_rss():
+    """
+    Returns resident set size (in bytes) of current process
+    """
+
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (IOError, OSError, ValueError, IndexError):
+        try:
+            import resource
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+        except ImportError:
+            return None
+
+def _count(table):
+    return sum(len(_) for _ in table.values())
+
+def get_footprint(trails=None, ring=None, extra=None):
+    """
+    Returns list of (name, entries, bytes) for loaded structures
+    """
+
+    retval = []
+    seen = set()
+    trails = _trails if trails is None else trails
+
+    structures = [
+        ("trails (keys)", len(trails._trails), trails._trails),
+        ("trails (_infos)", len(trails._infos), trails._infos),
+        ("trails (_references)", len(trails._references), trails._references),
+        ("trails (_reverse_infos)", len(trails._reverse_infos), trails._reverse_infos),
+        ("trails (_reverse_references)", len(trails._reverse_references), trails._reverse_references),
+        ("WHITELIST", len(WHITELIST), WHITELIST),
+        ("WHITELIST_RANGES", len(WHITELIST_RANGES), WHITELIST_RANGES),
+        ("WORST_ASNS", _count(WORST_ASNS), WORST_ASNS),
+        ("BOGON_RANGES", _count(BOGON_RANGES), BOGON_RANGES),
+        ("CDN_RANGES", _count(CDN_RANGES), CDN_RANGES),
+        ("WEB_SHELLS", len(WEB_SHELLS), WEB_SHELLS),
+        ("IGNORE_EVENTS", len(IGNORE_EVENTS), IGNORE_EVENTS),
+        ("ipcat (static)", len(_ipcat_static), _ipcat_static),
+        ("ipcat (cache)", len(_ipcat_cache), _ipcat_cache),
+    ]
+
+    if ring is not None:
+        structures.append(("capture ring", len(ring), ring))
+
+    for name, obj in (extra or {}).items():
+        structures.append((name, len(obj) if hasattr(obj, "__len__") else 1, obj))
+
+    for name, entries, obj in structures:
+        retval.append((name, entries, get_size(obj, seen)))
+
+    return retval
+
+class MemoryTracker(object):
+    def __init__(self, trails=None, ring=None, extra=None, history=MEMORY_HISTORY_SIZE, period=MEMORY_SAMPLE_PERIOD):
+        self.trails = trails
+        self.ring = ring
+        self.extra = extra      # (optional) dictionary of additional structures (e.g. {"hot cache": cache})
+        self.history = collections.deque(maxlen=history)
+        self.period = period
+        self._lock = threading.Lock()
+
+    def sample(self):
+        """
+        Takes (and returns) new sample of memory footprint
+        """
+
+        retval = {"time": time.time(), "rss": get_rss(), "structures": get_footprint(self.trails, self.ring, self.extra)}
+        self.history.append(retval)
+
+        return retval
+
+    def refresh(self):
+        """
+        Returns latest sample, taking new one only if it is older than period (or if there is none)
+        """
+
+        if self.history and time.time() - self.history[-1]["time"] < self.period:
+            return self.history[-1]
+
+        if not self._lock.acquire(not self.history):    # (Note: sample already being taken by other thread)
+            return self.history[-1]
+
+        try:
+            if self.history and time.time() - self.history[-1]["time"] < self.period:
+                return self.history[-1]
+            return self.sample()
+        finally:
+            self._lock.release()
+
+    def growth(self):
+        """
+        Returns dictionary of (name, bytes per hour) for structures grown over tracked history
+        """
+
+        retval = {}
+
+        if len(self.history) > 1:
+            first, last = self.history[0], self.history[-1]
+            hours = max(last["time"] - first["time"], 1e-6) / 3600.0
+            before = dict((name, size) for name, _, size in first["structures"])
+            for name, _, size in last["structures"]:
+                if name in before and size > before[name]:
+                    retval[name] = (size - before[name]) / hours
+
+        return retval
+
+    def growing(self):
+        """
+        Returns names of structures which have been growing in each of (at least 3) tracked samples
+        """
+
+        retval = []
+
+        if len(self.history) > 2:
+            sizes = [dict((name, size) for name, _, size in sample["structures"]) for sample in self.history]
+            for name in sizes[-1]:
+                if all(name in previous and name in current and current[name] > previous[name] for previous, current in zip(sizes, sizes[1:])):
+                    retval.append(name)
+
+        return retval
+
+    def report(self):
+        """
+        Returns (JSON serializable) report of latest sample
+        """
+
+        sample = self.history[-1] if self.history else self.sample()
+
+        return {"time": int(sample["time"]), "rss": sample["rss"], "structures": dict((name, {"entries": entries, "bytes": size}) for name, entries, size in sample["structures"]), "growth": self.growth(), "growing": self.growing()}
+
+    def format(self):
+        """
+        Returns (plain) text report of latest sample
+        """
+
+        retval = []
+        sample = self.history[-1] if self.history else self.sample()
+        growth = self.growth()
+
+        retval.append("{:<30}{:>12}{:>16}{:>16}".format("structure", "entries", "bytes", "growth/h"))
+        for name, entries, size in sample["structures"]:
+            retval.append("{:<30}{:>12,}{:>16,}{:>16}".format(name, entries, size, "{:,.0f}".format(growth[name]) if name in growth else '-'))
+        retval.append("{:<30}{:>12}{:>16,}".format("total", "", sum(_[2] for _ in sample["structures"])))
+        if sample["rss"]:
+            retval.append("{:<30}{:>12}{:>16,}".format("rss", "", sample["rss"]))
+        for name in self.growing():
+            retval.append("[!] '{}' has been growing over last {} samples".format(name, len(self.history)))
+
+        return "\n".join(retval) + "\n"
+
+if __name__ == "__main__":
+    import optparse
+
+    from common import ipcat_lookup
+    from common import load_trails
+
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option("--samples", dest="samples", type="int", default=1, help="number of samples to take")
+    parser.add_option("--period", dest="period", type="float", default=1.0, help="period (in seconds) between samples")
+    parser.add_option("--lookups", dest="lookups", type="int", default=0, help="number of ipcat lookups between samples (growth demo)")
+    options, _ = parser.parse_args()
+
+    _trails.update(load_trails(quiet=True))
+
+    tracker = MemoryTracker()
+    for i in range(options.samples):
+        if i:
+            time.sleep(options.period)
+        for j in range(options.lookups):
+            ipcat_lookup("10.{}.{}.{}".format(i & 0xff, j >> 8 & 0xff, j & 0xff))
+        tracker.sample()
+
+    print(tracker.format(), end="")
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+
+"""
+Copyright (c) 2014-2019 Maltrail developers (https://github.com/stamparm/maltrail/)
+See the file 'LICENSE' for copying permission
+"""
+
+# Adaptive load shedding for workers falling behind capture. Each worker periodically (every OVERLOAD_CHECK_INTERVAL
+# packets) checks depth of its ring buffer partition and lag of processed packets, moving between levels (with
+# hysteresis):
+#
+#   LOAD_NORMAL         full inspection
+#   LOAD_SHED           expensive heuristics (USE_HEURISTICS, HTTP regexes, domain entropy) are skipped
+#   LOAD_SAMPLE         (additionally) only 1 in OVERLOAD_SAMPLE_RATE of non-DNS/non-SYN payloads is inspected
+#
+# Exact trail lookups are always done. Shed counts are kept in shared memory (per worker) for reporting.
+
+import ctypes
+import multiprocessing
+import time
+
+from enums import PROTO
+from settings import config
+from settings import CPU_CORES
+from settings import OVERLOAD_CHECK_INTERVAL
+from settings import OVERLOAD_HIGH_WATERMARK
+from settings import OVERLOAD_LOW_WATERMARK
+from settings import OVERLOAD_MAX_LAG
+from settings import OVERLOAD_SAMPLE_RATE
+from settings import OVERLOAD_SAMPLING_WATERMARK
+
+LOAD_NORMAL, LOAD_SHED, LOAD_SAMPLE = 0, 1, 2
+LOAD_LEVELS = ("normal", "shed", "sample")
+SHED_KINDS = ("heuristics", "payloads", "escalations")
+
+TCP_SYN = 0x02
+
+class OverloadController(object):
+    def __init__(self, ring=None, process_count=None, sample_rate=OVERLOAD_SAMPLE_RATE):
+        self.ring = ring
+        self.process_count = max(1, process_count or config.PROCESS_COUNT or CPU_CORES)
+        self.sample_rate = sample_rate
+        self.worker = 0
+        self.level = LOAD_NORMAL
+        self._packets = 0
+        self._sampled = 0
+        self._levels = multiprocessing.RawArray(ctypes.c_ubyte, self.process_count)
+        self._counts = multiprocessing.RawArray(ctypes.c_ulonglong, self.process_count * len(SHED_KINDS))
+
+    def bind(self, worker):
+        """
+        Sets index of (current) worker process (and its ring buffer partition)
+        """
+
+        self.worker = worker % self.process_count
+
+    def _count(self, kind):
+        self._counts[self.worker * len(SHED_KINDS) + SHED_KINDS.index(kind)] += 1
+
+    def update(self, sec=None, usage=None, now=None):
+        """
+        Re-evaluates load level from partition usage (0.0-1.0) and lag of packet captured at sec (called per packet)
+        """
+
+        self._packets += 1
+
+        if self._packets % OVERLOAD_CHECK_INTERVAL:
+            return self.level
+
+        if usage is None:
+            usage = self.ring.usage(self.worker) if self.ring is not None else 0.0
+
+        lag = (now or time.time()) - sec if sec else 0.0
+
+        if usage >= OVERLOAD_SAMPLING_WATERMARK or lag >= 2 * OVERLOAD_MAX_LAG:
+            level = LOAD_SAMPLE
+        elif usage >= OVERLOAD_HIGH_WATERMARK or lag >= OVERLOAD_MAX_LAG:
+            level = max(LOAD_SHED, self.level)
+        elif usage <= OVERLOAD_LOW_WATERMARK and lag < OVERLOAD_MAX_LAG / 2:
+            level = LOAD_NORMAL
+        else:
+            level = min(LOAD_SHED, self.level)      # (Note: hysteresis between watermarks)
+
+        if level > self.level:
+            self._count("escalations")
+            if config.SHOW_DEBUG:
+                print("[!] worker #{} overloaded (usage: {:.0f}%, lag: {:.2f}s), switching to '{}' mode".format(self.worker, 100 * usage, lag, LOAD_LEVELS[level]))
+
+        self.level = self._levels[self.worker] = level
+
+        return level
+
+    def check_heuristics(self):
+        """
+        Returns True if expensive heuristics should be run
+        """
+
+        if self.level == LOAD_NORMAL:
+            return True
+
+        self._count("heuristics")
+
+        return False
+
+    def check_payload(self, proto, dst_port=None, flags=None):
+        """
+        Returns True if payload of a given packet should be inspected (DNS and TCP SYN are never sampled out)
+        """
+
+        if self.level < LOAD_SAMPLE or dst_port == 53 or (proto == PROTO.TCP and flags is not None and flags & TCP_SYN):
+            return True
+
+        self._sampled += 1
+
+        if self._sampled % self.sample_rate == 0:
+            return True
+
+        self._count("payloads")
+
+        return False
+
+    def stats(self):
+        """
+        Returns load levels and shed counts aggregated over all workers
+        """
+
+        retval = {"levels": [LOAD_LEVELS[_] for _ in self._levels]}
+
+        for i, kind in enumerate(SHED_KINDS):
+            retval[kind] = sum(self._counts[worker * len(SHED_KINDS) + i] for worker in range(self.process_count))
+
+        return retval
+
+if __name__ == "__main__":
+    import random
+
+    random.seed(0)
+    controller = OverloadController(process_count=1)
+    usage = 0.0
+    timeline = []
+
+    # simulated burst: partition fills up over 2M packets, then drains
+    for i in range(4000000):
+        usage = min(1.0, max(0.0, usage + (0.0000006 if i < 2000000 else -0.0000008)))
+        level = controller.update(time.time(), usage)
+        if not timeline or timeline[-1][1] != level:
+            timeline.append((i, level, usage))
+
+        proto, dst_port, flags = random.choice(((PROTO.UDP, 53, None), (PROTO.TCP, 80, TCP_SYN), (PROTO.TCP, 80, 0x18), (PROTO.TCP, 443, 0x10)))
+        if controller.check_payload(proto, dst_port, flags):
+            controller.check_heuristics()
+
+    for i, level, usage in timeline:
+        print("[i] packet #{:,}: '{}' mode (usage {:.0f}%)".format(i, LOAD_LEVELS[level], 100 * usage))
+    print("[i] stats: {}".format(controller.stats()))
@@ -0,0 +1,357 @@
+#!/usr/bin/env python3
+
+"""
+Copyright (c) 2014-2019 Maltrail developers (https://github.com/stamparm/maltrail/)
+See the file 'LICENSE' for copying permission
+"""
+
+# Offline replay of pcap/pcapng captures through detection path (decoding, trail lookups, whitelisting, bogon/ASN/ipcat
+# lookups and ignore rules) at maximum speed, reporting packets/second, per-stage time and detected events. Synthetic
+# (deterministic) corpus is generated with generate_corpus() and checked in as misc/replay.pcap.gz.
+#
+# (Note: as in sensor, bogon, worst_asns and ipcat stages are done only for IP addresses hitting a trail, hence their
+# timings scale with number of hits rather than with number of packets)
+
+import gzip
+import mmap
+import os
+import random
+import struct
+import time
+
+from common import bogon_ip
+from common import check_whitelisted
+from common import ipcat_lookup
+from common import worst_asns
+from decoder import build_packet
+from decoder import decode
+from decoder import get_ip_offset
+from decoder import DLT_EN10MB
+from enums import PROTO
+from enums import TRAIL
+from ignore import ignore_event
+from settings import ROOT_DIR
+from trailsdict import TrailsDict
+
+REPLAY_CORPUS_FILE = os.path.join(ROOT_DIR, "misc", "replay.pcap.gz")
+REPLAY_STAGES = ("decode", "trails", "whitelist", "bogon", "worst_asns", "ipcat", "ignore")
+
+PCAP_MAGIC = 0xa1b2c3d4
+PCAP_NSEC_MAGIC = 0xa1b23c4d
+PCAPNG_SHB = 0x0a0d0d0a
+PCAPNG_IDB = 0x00000001
+PCAPNG_SPB = 0x00000003
+PCAPNG_EPB = 0x00000006
+
+_DNS_HEADER = struct.Struct("!HHHHHH")
+
+def _open_capture(path):
+    if path.endswith(".gz"):
+        with gzip.open(path, "rb") as f:
+            return memoryview(f.read())
+    elif os.path.getsize(path) == 0:     # (Note: empty file can't be mapped)
+        return memoryview(b"")
+    else:
+        with open(path, "rb") as f:
+            return memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+def read_pcap(path, errors=None):
+    """
+    Yields (sec, usec, datalink, packet) from pcap or pcapng file (packet being memoryview slice of mapped file), while
+    skipped (malformed) blocks/records are described inside (optional) list errors
+    """
+
+    errors = errors if errors is not None else []
+    view = _open_capture(path)
+
+    if len(view) < 24:
+        if len(view):
+            errors.append("truncated file header ({} bytes)".format(len(view)))
+        return
+
+    magic = struct.unpack_from("<I", view)[0]
+
+    if magic == PCAPNG_SHB:
+        for _ in _read_pcapng(view, errors):
+            yield _
+        return
+
+    for endian in ('<', '>'):
+        magic = struct.unpack_from("{}I".format(endian), view)[0]
+        if magic in (PCAP_MAGIC, PCAP_NSEC_MAGIC):
+            break
+    else:
+        raise ValueError("unsupported capture file format ('{}')".format(path))
+
+    nsec = magic == PCAP_NSEC_MAGIC
+    datalink = struct.unpack_from("{}I".format(endian), view, 20)[0]
+    header = struct.Struct("{}IIII".format(endian))
+    offset = 24
+
+    while offset + header.size <= len(view):
+        sec, usec, caplen, _ = header.unpack_from(view, offset)
+        offset += header.size
+        if offset + caplen > len(view):
+            errors.append("truncated record at offset {} ({} of {} bytes)".format(offset - header.size, len(view) - offset, caplen))
+            break
+        yield sec, usec // 1000 if nsec else usec, datalink, view[offset:offset + caplen]
+        offset += caplen
+
+def _read_pcapng(view, errors):
+    endian = '<'
+    interfaces = []
+    offset = 0
+
+    while offset + 12 <= len(view):
+        block_type = struct.unpack_from("{}I".format(endian), view, offset)[0]
+
+        if block_type == PCAPNG_SHB:
+            endian = '<' if struct.unpack_from("<I", view, offset + 8)[0] == 0x1a2b3c4d else '>'
+            interfaces = []
+
+        block_length = struct.unpack_from("{}I".format(endian), view, offset + 4)[0]
+
+        if block_length < 12 or offset + block_length > len(view):
+            errors.append("invalid length of block at offset {} ({} bytes)".format(offset, block_length))
+            break
+
+        if block_type == PCAPNG_IDB:
+            datalink = struct.unpack_from("{}H".format(endian), view, offset + 8)[0]
+            resolution = 1000000
+            _ = offset + 16
+            while _ + 4 <= offset + block_length - 4:      # options (looking for if_tsresol)
+                code, length = struct.unpack_from("{}HH".format(endian), view, _)
+                if code == 0:
+                    break
+                elif code == 9:
+                    value = view[_ + 4]
+                    resolution = 2 ** (value & 0x7f) if value & 0x80 else 10 ** value
+                _ += 4 + ((length + 3) & ~3)
+            interfaces.append((datalink, resolution))
+
+        elif block_type == PCAPNG_EPB:
+            if block_length < 32:
+                errors.append("invalid length of enhanced packet block at offset {} ({} bytes)".format(offset, block_length))
+            else:
+                interface, high, low, caplen = struct.unpack_from("{}IIII".format(endian), view, offset + 8)
+                if interface >= len(interfaces):
+                    errors.append("unknown interface #{} of enhanced packet block at offset {}".format(interface, offset))
+                elif caplen > block_length - 32:
+                    errors.append("invalid captured length of enhanced packet block at offset {} ({} bytes)".format(offset, caplen))
+                else:
+                    datalink, resolution = interfaces[interface]
+                    timestamp = (high << 32) | low
+                    yield timestamp // resolution, (timestamp % resolution) * 1000000 // resolution, datalink, view[offset + 28:offset + 28 + caplen]
+
+        elif block_type == PCAPNG_SPB:
+            if not interfaces or block_length < 16:
+                errors.append("invalid simple packet block at offset {}".format(offset))
+            else:
+                length = struct.unpack_from("{}I".format(endian), view, offset + 8)[0]
+                yield 0, 0, interfaces[0][0], view[offset + 12:offset + 12 + min(length, block_length - 16)]
+
+        offset += block_length
+
+def write_pcap(path, packets, datalink=DLT_EN10MB):
+    """
+    Writes (sec, usec, packet) records into (optionally gzip compressed) pcap file
+    """
+
+    with (gzip.GzipFile(path, "wb", mtime=0) if path.endswith(".gz") else open(path, "wb")) as f:     # (Note: mtime=0 for reproducible output)
+        f.write(struct.pack("<IHHiIII", PCAP_MAGIC, 2, 4, 0, 0, 65535, datalink))
+        for sec, usec, packet in packets:
+            f.write(struct.pack("<IIII", sec, usec, len(packet), len(packet)))
+            f.write(packet)
+
+def build_dns_query(name, identifier=0):
+    return _DNS_HEADER.pack(identifier, 0x0100, 1, 0, 0, 0) + b"".join(struct.pack("B", len(_)) + _.encode("ascii") for _ in name.split('.')) + b"\x00\x00\x01\x00\x01"
+
+def parse_dns_query(payload):
+    """
+    Returns query name from DNS request payload (None if not a standard query)
+    """
+
+    if len(payload) <= _DNS_HEADER.size or payload[2] & 0xf8:      # QR (response) or non-zero opcode
+        return None
+
+    labels = []
+    offset = _DNS_HEADER.size
+
+    while offset < len(payload):
+        length = payload[offset]
+        if length == 0:
+            return '.'.join(labels).lower() if labels else None
+        elif length & 0xc0:
+            return None
+        labels.append(bytes(payload[offset + 1:offset + 1 + length]).decode("ascii", "replace"))
+        offset += 1 + length
+
+    return None
+
+def get_corpus_trails():
+    """
+    Returns (synthetic) trails matching those used by generate_corpus()
+    """
+
+    retval = TrailsDict()
+
+    for i in range(256):
+        retval["198.51.100.{}".format(i)] = ("malware", "(replay)")                 # TEST-NET-2 (bogon)
+        retval["45.{}.{}.{}".format(i % 7 + 1, i // 7, i % 250 + 1)] = ("attacker", "(replay)")
+        retval["replay-malware-{}.com".format(i)] = ("malware", "(replay)")
+        retval["c2-{}.replay.net".format(i)] = ("c2 server", "(replay)")
+
+    return retval
+
+def generate_corpus(path=REPLAY_CORPUS_FILE, count=10000, seed=0):
+    """
+    Generates deterministic (synthetic) capture mixing benign traffic with traffic hitting get_corpus_trails()
+    """
+
+    rnd = random.Random(seed)
+    trails = get_corpus_trails()
+    ips = [_ for _ in trails if _[0].isdigit()]
+    domains = [_ for _ in trails if not _[0].isdigit()]
+    benign_domains = ("www.google.com", "example.com", "cdn.jsdelivr.net", "api.github.com", "www.wikipedia.org", "update.microsoft.com")
+    packets = []
+    sec = 1546300800
+
+    for i in range(count):
+        src_ip = "192.168.{}.{}".format(rnd.randint(0, 3), rnd.randint(2, 254))
+        src_port = rnd.randint(1024, 65535)
+        choice = rnd.random()
+
+        if choice < 0.3:
+            domain = rnd.choice(domains) if rnd.random() < 0.1 else rnd.choice(benign_domains)
+            packet = build_packet(src_ip, src_port, "8.8.8.8", 53, PROTO.UDP, build_dns_query(domain, i & 0xffff))
+        elif choice < 0.6:
+            host = rnd.choice(domains) if rnd.random() < 0.1 else rnd.choice(benign_domains)
+            packet = build_packet(src_ip, src_port, "93.184.216.{}".format(rnd.randint(1, 254)), 80, PROTO.TCP, "GET /index.html HTTP/1.1\r\nHost: {}\r\nUser-Agent: Mozilla/5.0\r\n\r\n".format(host).encode("ascii"))
+        elif choice < 0.7:
+            packet = build_packet(src_ip, src_port, rnd.choice(ips), rnd.choice((80, 443, 8080)), PROTO.TCP, flags=0x02)
+        elif choice < 0.75:
+            packet = build_packet(rnd.choice(ips), rnd.randint(1024, 65535), src_ip, rnd.choice((22, 23, 445)), PROTO.TCP, flags=0x02)
+        elif choice < 0.8:
+            packet = build_packet("2001:db8::{:x}".format(rnd.randint(1, 0xffff)), src_port, "2001:db8::1", 443, PROTO.TCP, b"\x16\x03\x01" + b"\x00" * rnd.randint(0, 200))
+        else:
+            packet = build_packet(src_ip, src_port, "{}.{}.{}.{}".format(rnd.randint(1, 223), rnd.randint(0, 255), rnd.randint(0, 255), rnd.randint(1, 254)), 443, PROTO.TCP, b"\x17\x03\x03" + b"\x00" * rnd.randint(0, 1200))
+
+        sec += rnd.random() < 0.01
+        packets.append((sec, (i * 997) % 1000000, packet))
+
+    write_pcap(path, packets)
+
+    return path
+
+def _timed(stats, stage, function, *args):
+    start = time.perf_counter()
+    retval = function(*args)
+    stats[stage] += time.perf_counter() - start
+    return retval
+
+class Replayer(object):
+    def __init__(self, trails):
+        self.trails = trails
+        self.packets = 0
+        self.errors = []        # skipped (malformed) blocks/records of capture
+        self.events = {}
+        self.timings = dict((_, 0.0) for _ in REPLAY_STAGES)
+
+    def _event(self, packet, trail_type, trail):
+        info, reference = self.trails[trail]
+        event_tuple = (packet.sec, packet.usec, packet.src_ip, packet.src_port, packet.dst_ip, packet.dst_port, packet.proto, trail_type, trail, info, reference)
+
+        if not _timed(self.timings, "ignore", ignore_event, event_tuple):
+            key = (trail_type, info)
+            self.events[key] = self.events.get(key, 0) + 1
+
+    def _lookup_domain(self, name):
+        while name and '.' in name:
+            if name in self.trails:
+                return name
+            name = name.split('.', 1)[1]
+
+    def process(self, sec, usec, datalink, data):
+        timings = self.timings
+        self.packets += 1
+
+        start = time.perf_counter()
+        ip_offset = get_ip_offset(data, datalink)
+        packet = decode(data, ip_offset, sec, usec) if ip_offset is not None else None
+        timings["decode"] += time.perf_counter() - start
+
+        if packet is None:
+            return
+
+        for ip in (packet.src_ip, packet.dst_ip):
+            if _timed(timings, "trails", self.trails.__contains__, ip):
+                if _timed(timings, "whitelist", check_whitelisted, ip):
+                    continue
+                _timed(timings, "bogon", bogon_ip, ip)
+                _timed(timings, "worst_asns", worst_asns, ip)
+                _timed(timings, "ipcat", ipcat_lookup, ip)
+                self._event(packet, TRAIL.IP, ip)
+
+        if packet.payload:
+            name = None
+            if packet.proto is PROTO.UDP and packet.dst_port == 53:
+                name = parse_dns_query(packet.payload)
+            elif packet.proto is PROTO.TCP and packet.payload[:4] == b"GET ":
+                payload = bytes(packet.payload[:1024])
+                index = payload.find(b"\r\nHost: ")
+                if index > 0:
+                    name = payload[index + 8:payload.find(b"\r\n", index + 8)].decode("ascii", "replace").split(':')[0].lower()
+
+            if name:
+                trail = _timed(timings, "trails", self._lookup_domain, name)
+                if trail and not _timed(timings, "whitelist", check_whitelisted, trail):
+                    self._event(packet, TRAIL.DNS if packet.dst_port == 53 else TRAIL.HTTP, trail)
+
+    def run(self, path):
+        start = time.perf_counter()
+
+        for sec, usec, datalink, data in read_pcap(path, self.errors):
+            self.process(sec, usec, datalink, data)
+
+        return self.stats(time.perf_counter() - start)
+
+    def stats(self, elapsed):
+        return {"packets": self.packets, "malformed": len(self.errors), "elapsed": elapsed, "packets_per_second": self.packets / elapsed if elapsed else 0, "timings": dict(self.timings), "events": dict(("{} {}".format(*_), count) for _, count in self.events.items())}
+
+if __name__ == "__main__":
+    import optparse
+
+    from common import load_trails
+    from settings import read_bogon_ranges
+    from settings import read_ignorelist
+    from settings import read_whitelist
+    from settings import read_worst_asn
+
+    parser = optparse.OptionParser(usage="%prog [options] [capture...]")
+    parser.add_option("--generate", dest="generate", action="store_true", help="(re)generate synthetic corpus ({})".format(os.path.relpath(REPLAY_CORPUS_FILE, ROOT_DIR)))
+    parser.add_option("--count", dest="count", type="int", default=10000, help="number of packets in generated corpus")
+    parser.add_option("--trails", dest="trails", action="store_true", help="use (local) trails instead of synthetic ones")
+    options, args = parser.parse_args()
+
+    if options.generate or not os.path.isfile(REPLAY_CORPUS_FILE):
+        print("[i] generated corpus '{}'".format(generate_corpus(count=options.count)))
+
+    read_whitelist()
+    read_ignorelist()
+    read_bogon_ranges()
+    read_worst_asn()
+
+    trails = load_trails(quiet=True) if options.trails else get_corpus_trails()
+
+    for path in args or [REPLAY_CORPUS_FILE]:
+        replayer = Replayer(trails)
+        stats = replayer.run(path)
+        print("[i] '{}': {:,} packets in {:.2f}s ({:,.0f} packets/second)".format(path, stats["packets"], stats["elapsed"], stats["packets_per_second"]))
+        for error in replayer.errors[:10]:
+            print("[x]  skipped {}".format(error))
+        if stats["malformed"] > 10:
+            print("[x]  ... and {:,} more malformed block(s)".format(stats["malformed"] - 10))
+        for stage in REPLAY_STAGES:
+            print("[i]  {:<12}{:.3f}s".format(stage, stats["timings"][stage]))
+        for event, count in sorted(stats["events"].items()):
+            print("[i]  {:<36}{:,}".format(event, count))
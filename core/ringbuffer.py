@@ -0,0 +1,349 @@
+#!/usr/bin/env python3
+
+"""
+Copyright (c) 2014-2019 Maltrail developers (https://github.com/stamparm/maltrail/)
+See the file 'LICENSE' for copying permission
+"""
+
+# Capture ring buffer (anonymous shared memory, inherited by forked workers) with variable-length records.
+# Buffer is split into one partition per worker, each being a lock-free single-producer/single-consumer ring
+# (i.e. capture process is the only writer, while each worker consumes only its own partition). Record becomes
+# visible to consumer only by (subsequent) update of write position, hence there is no per-record locking, while
+# each side re-reads position of the other one only when its cached copy says the ring is full (or empty). Packet
+# not fitting into its (full) partition is spilled into the least used other one (e.g. in case of a single slow
+# worker), hence it's dropped only if all partitions are full (Note: spilled packets lose flow affinity of sharding).
+#
+# Partition:  [write position (Q)][read position (Q)][closed (Q)][records...]
+# Record:     [marker (B)][packet size (H)][sec (I)][usec (I)][IP offset (I)][packet] (padded to RECORD_ALIGNMENT)
+#
+# (Note: marker is BLOCK_MARKER.END in case of unused space at the end of partition, otherwise BLOCK_MARKER.NOP)
+# (Note: positions are accessed through native 'Q' view of (aligned) header, as struct's standard-size packing
+# is done byte by byte, hence other process could observe torn position)
+
+import mmap
+import struct
+
+from enums import BLOCK_MARKER
+from settings import BLOCK_LENGTH
+from settings import END_BLOCK
+from settings import MMAP_ZFILL_CHUNK_LENGTH
+from settings import NO_BLOCK
+from settings import SNAP_LEN
+
+PARTITION_HEADER = struct.Struct("=QQQ")
+RECORD_HEADER = struct.Struct("=BHIII")
+RECORD_ALIGNMENT = 8
+
+_NOP, _END = (ord(_) for _ in (BLOCK_MARKER.NOP, BLOCK_MARKER.END))
+
+def record_size(length):
+    return (RECORD_HEADER.size + min(length, SNAP_LEN) + RECORD_ALIGNMENT - 1) & ~(RECORD_ALIGNMENT - 1)
+
+def plan_layout(capture_buffer, process_count):
+    """
+    Returns (offset, length) of each worker's partition inside capture buffer
+    """
+
+    process_count = max(1, process_count or 1)
+    length = int(capture_buffer) // process_count // mmap.PAGESIZE * mmap.PAGESIZE
+
+    if length < PARTITION_HEADER.size + 2 * BLOCK_LENGTH:
+        exit("[!] capture buffer of {} bytes is too small for {} process(es)".format(capture_buffer, process_count))
+
+    return [(i * length, length) for i in range(process_count)]
+
+class RingBuffer(object):
+    def __init__(self, capture_buffer, process_count=1, spill=True):
+        self.layout = plan_layout(capture_buffer, process_count)
+        self.size = sum(_[1] for _ in self.layout)
+        self.spill = spill and len(self.layout) > 1
+        self.dropped = 0
+        self.spilled = 0
+
+        self._buffer = mmap.mmap(-1, self.size)
+        for i in range(0, self.size, MMAP_ZFILL_CHUNK_LENGTH):     # pre-fault pages (avoiding page faults in capture loop)
+            self._buffer[i:i + MMAP_ZFILL_CHUNK_LENGTH] = b"\x00" * min(MMAP_ZFILL_CHUNK_LENGTH, self.size - i)
+
+        self._view = memoryview(self._buffer)
+        self._positions = self._view.cast('Q')
+        self._partitions = [(base // 8, length - PARTITION_HEADER.size, base + PARTITION_HEADER.size) for base, length in self.layout]    # (header index, capacity, data)
+        self._write_positions = [0] * len(self.layout)
+        self._read_positions = [0] * len(self.layout)
+        self._known_writes = [0] * len(self.layout)     # (cached) write positions as last seen by consumer
+        self._known_reads = [0] * len(self.layout)      # (cached) read positions as last seen by producer
+
+    def __len__(self):
+        return len(self.layout)
+
+    def write(self, partition, sec, usec, ip_offset, packet, spill=True):
+        """
+        Appends packet to given partition (called only by capture process), returning False if it had to be dropped
+        """
+
+        header, capacity, data = self._partitions[partition]
+        length = len(packet)
+        if length > SNAP_LEN:
+            packet, length = packet[:SNAP_LEN], SNAP_LEN
+        size = (RECORD_HEADER.size + length + RECORD_ALIGNMENT - 1) & ~(RECORD_ALIGNMENT - 1)
+        position = self._write_positions[partition]
+        offset = position % capacity
+        skip = capacity - offset if offset + size > capacity else 0
+
+        if position + skip + size - self._known_reads[partition] > capacity:
+            self._known_reads[partition] = self._positions[header + 1]
+            if position + skip + size - self._known_reads[partition] > capacity:
+                if spill and self.spill:
+                    return self._spill(partition, sec, usec, ip_offset, packet)
+                self.dropped += 1
+                return False
+
+        if skip:
+            self._buffer[data + offset] = _END
+            position += skip
+            offset = 0
+
+        start = data + offset
+        RECORD_HEADER.pack_into(self._buffer, start, _NOP, length, sec, usec, ip_offset)
+        self._view[start + RECORD_HEADER.size:start + RECORD_HEADER.size + length] = packet
+
+        position += size
+        self._write_positions[partition] = position
+        self._positions[header] = position      # (Note: publishing record)
+
+        return True
+
+    def _spill(self, partition, sec, usec, ip_offset, packet):
+        other = min((_ for _ in range(len(self.layout)) if _ != partition), key=lambda _: self._write_positions[_] - self._known_reads[_])     # (Note: producer's cached view, avoiding shared memory reads)
+
+        if self.write(other, sec, usec, ip_offset, packet, False):
+            self.spilled += 1
+            return True
+
+        return False
+
+    def read(self, partition):
+        """
+        Returns (sec, usec, IP offset, packet) from given partition (called only by its worker), NO_BLOCK if
+        there is nothing to read or END_BLOCK if ring has been closed and drained
+        """
+
+        header, capacity, data = self._partitions[partition]
+        position = self._read_positions[partition]
+
+        if position == self._known_writes[partition]:
+            closed = self._positions[header + 2]        # (Note: before write position, as records precede closing)
+            written = self._positions[header]
+            if position == written:
+                return END_BLOCK if closed else NO_BLOCK
+            self._known_writes[partition] = written
+
+        offset = position % capacity
+        if self._buffer[data + offset] == _END:
+            position += capacity - offset
+            offset = 0
+
+        start = data + offset
+        _, size, sec, usec, ip_offset = RECORD_HEADER.unpack_from(self._buffer, start)
+        packet = self._buffer[start + RECORD_HEADER.size:start + RECORD_HEADER.size + size]
+
+        position += (RECORD_HEADER.size + size + RECORD_ALIGNMENT - 1) & ~(RECORD_ALIGNMENT - 1)
+        self._read_positions[partition] = position
+        self._positions[header + 1] = position
+
+        return sec, usec, ip_offset, packet
+
+    def usage(self, partition):
+        """
+        Returns fill ratio (0.0-1.0) of given partition
+        """
+
+        header, capacity, _ = self._partitions[partition]
+
+        return (self._positions[header] - self._positions[header + 1]) / capacity
+
+    def close(self):
+        for header, _, _ in self._partitions:
+            self._positions[header + 2] = 1
+
+if __name__ == "__main__":
+    import multiprocessing
+    import random
+    import time
+
+    _READ, _WRITE = (ord(_) for _ in (BLOCK_MARKER.READ, BLOCK_MARKER.WRITE))
+
+    # synthetic traffic mix: DNS (60-120B), TCP SYN/ACK (54-74B), HTTP/other (200-1514B)
+    def _packet_sizes(count):
+        _ = random.Random(0)
+        for i in range(count):
+            choice = _.random()
+            yield _.randint(60, 120) if choice < 0.5 else (_.randint(54, 74) if choice < 0.8 else _.randint(200, 1514))
+
+    count = 200000
+    workers = 4
+    capture_buffer = 64 * 1024 * 1024
+    sizes = list(_packet_sizes(count))
+    packets = dict((_, b"\xaa" * _) for _ in set(sizes))
+    payload = sum(sizes)
+
+    class _FixedSlots(object):     # (Note: reference ring with fixed BLOCK_LENGTH slots, otherwise same as RingBuffer)
+        def __init__(self, capture_buffer):
+            self.slots = (capture_buffer - PARTITION_HEADER.size) // BLOCK_LENGTH
+            self._buffer = mmap.mmap(-1, capture_buffer)
+            self._view = memoryview(self._buffer)
+            self._positions = self._view.cast('Q')
+            self._write_position = self._read_position = self._known_write = self._known_read = 0
+
+        def write(self, partition, sec, usec, ip_offset, packet):
+            packet = packet[:SNAP_LEN]
+            position = self._write_position
+            if position - self._known_read >= self.slots:
+                self._known_read = self._positions[1]
+                if position - self._known_read >= self.slots:
+                    return False
+            start = PARTITION_HEADER.size + position % self.slots * BLOCK_LENGTH
+            RECORD_HEADER.pack_into(self._buffer, start, _NOP, len(packet), sec, usec, ip_offset)
+            self._view[start + RECORD_HEADER.size:start + RECORD_HEADER.size + len(packet)] = packet
+            self._write_position = position + 1
+            self._positions[0] = position + 1
+            return True
+
+        def read(self, partition):
+            position = self._read_position
+            if position == self._known_write:
+                self._known_write = self._positions[0]
+                if position == self._known_write:
+                    return NO_BLOCK
+            start = PARTITION_HEADER.size + position % self.slots * BLOCK_LENGTH
+            _, size, sec, usec, ip_offset = RECORD_HEADER.unpack_from(self._buffer, start)
+            packet = self._buffer[start + RECORD_HEADER.size:start + RECORD_HEADER.size + size]
+            self._read_position = position + 1
+            self._positions[1] = position + 1
+            return sec, usec, ip_offset, packet
+
+    class _SharedRing(object):     # (Note: reference ring shared by all workers, records being claimed with BLOCK_MARKER protocol)
+        def __init__(self, capture_buffer, process_count=1):
+            self.capacity = capture_buffer - PARTITION_HEADER.size
+            self.dropped = 0
+            self._buffer = mmap.mmap(-1, capture_buffer)
+            self._view = memoryview(self._buffer)
+            self._positions = self._view.cast('Q')
+            self._lock = multiprocessing.Lock()    # (Note: Python has no atomic compare-and-swap for claiming of markers)
+            self._write_position = self._known_read = 0
+
+        def write(self, partition, sec, usec, ip_offset, packet):
+            packet = packet[:SNAP_LEN]
+            size = record_size(len(packet))
+            position = self._write_position
+            offset = position % self.capacity
+            skip = self.capacity - offset if offset + size > self.capacity else 0
+            if position + skip + size - self._known_read > self.capacity:
+                self._known_read = self._positions[1]
+                if position + skip + size - self._known_read > self.capacity:
+                    self.dropped += 1
+                    return False
+            if skip:
+                self._buffer[PARTITION_HEADER.size + offset] = _END
+                position += skip
+                offset = 0
+            start = PARTITION_HEADER.size + offset
+            RECORD_HEADER.pack_into(self._buffer, start, _WRITE, len(packet), sec, usec, ip_offset)
+            self._view[start + RECORD_HEADER.size:start + RECORD_HEADER.size + len(packet)] = packet
+            self._buffer[start] = _NOP
+            self._write_position = position + size
+            self._positions[0] = position + size
+            return True
+
+        def read(self, partition):
+            with self._lock:
+                written, position = self._positions[0], self._positions[1]
+                if position == written:
+                    return NO_BLOCK
+                offset = position % self.capacity
+                if self._buffer[PARTITION_HEADER.size + offset] == _END:
+                    position += self.capacity - offset
+                    offset = 0
+                start = PARTITION_HEADER.size + offset
+                if self._buffer[start] == _WRITE:
+                    return NO_BLOCK
+                self._buffer[start] = _READ
+                _, size, sec, usec, ip_offset = RECORD_HEADER.unpack_from(self._buffer, start)
+                packet = self._buffer[start + RECORD_HEADER.size:start + RECORD_HEADER.size + size]
+                self._buffer[start] = _NOP
+                self._positions[1] = position + record_size(size)
+            return sec, usec, ip_offset, packet
+
+    def _consume(ring, partition, results):
+        _ = random.Random(partition)
+        expected = 0
+        while True:
+            record = ring.read(partition)
+            if record is NO_BLOCK:
+                time.sleep(0)
+                continue
+            if record is END_BLOCK:
+                break
+            sec, _, _, packet = record
+            if sec != expected or len(packet) != min(sizes[sec % count] + 4, SNAP_LEN) or bytes(packet[:4]) != struct.pack("=I", sec):
+                results[1] += 1
+            expected = sec + 1
+            results[0] += 1
+
+    # (self-check) wrap-around and full ring with concurrent consumer (records must come in order and intact)
+    ring = RingBuffer(64 * 1024, 1)
+    results = multiprocessing.RawArray('Q', 2)
+    process = multiprocessing.Process(target=_consume, args=(ring, 0, results))
+    process.start()
+    written, start = 0, time.time()
+    while time.time() - start < 2:
+        if ring.write(0, written, 0, 14, struct.pack("=I", written) + packets[sizes[written % count]]):
+            written += 1
+    ring.close()
+    process.join()
+    if results[1] or results[0] != written or not ring.dropped:
+        exit("[x] self-check of wrap-around failed (written {:,}, read {:,}, corrupted {:,}, dropped {:,})".format(written, results[0], results[1], ring.dropped))
+    print("[i] self-check of wrap-around passed ({:,} records through 64KB ring, {:,} dropped on full ring)".format(written, ring.dropped))
+
+    # (self-check) packets for full partition are spilled into other one, while dropped only when all are full
+    ring = RingBuffer(2 * 64 * 1024, 2)
+    written = 0
+    while ring.write(0, written, 0, 14, b"\xaa" * 1000):
+        written += 1
+    if not ring.spilled or ring.dropped != 1 or ring.usage(1) < 0.9 or sum(1 for partition in (0, 1) for _ in iter(lambda: ring.read(partition), NO_BLOCK)) != written:
+        exit("[x] self-check of spilling failed (written {:,}, spilled {:,}, dropped {:,})".format(written, ring.spilled, ring.dropped))
+    print("[i] self-check of spilling passed ({:,} of {:,} records spilled into other partition)".format(ring.spilled, written))
+
+    print("[i] memory efficiency (payload/used): fixed slots {:.1f}%, variable records {:.1f}%".format(100.0 * payload / (count * BLOCK_LENGTH), 100.0 * payload / sum(record_size(_) for _ in sizes)))
+    print("[i] packets fitting into {}MB buffer: fixed slots {:,}, variable records ~{:,}".format(capture_buffer // 1024 // 1024, capture_buffer // BLOCK_LENGTH, count * capture_buffer // sum(record_size(_) for _ in sizes)))
+
+    def _run(ring, partitions=1):
+        start = time.perf_counter()
+        for i in range(0, count, 1000):
+            for j in range(i, i + 1000):
+                ring.write(j % partitions, 0, 0, 14, packets[sizes[j]])
+            for partition in range(partitions):
+                while ring.read(partition) != NO_BLOCK:
+                    pass
+        return count / (time.perf_counter() - start)
+
+    results = {}
+    for _ in range(5):
+        for name, ring, partitions in (("variable records", RingBuffer(capture_buffer, 1), 1), ("fixed slots", _FixedSlots(capture_buffer), 1), ("partitioned ({} workers)".format(workers), RingBuffer(capture_buffer, workers), workers), ("shared, claimed ({} workers)".format(workers), _SharedRing(capture_buffer), workers)):
+            results[name] = max(results.get(name, 0), _run(ring, partitions))
+
+    for name, rate in results.items():
+        print("[i] {}: {:,.0f} packets/second (write + read)".format(name, rate))
+
+    # skewed load: worker #0 consuming only 30 packets per round (others 150), while 400 packets are captured per round
+    for name, ring in (("partitioned (no spill)", RingBuffer(4 * 1024 * 1024, workers, False)), ("partitioned (spill)", RingBuffer(4 * 1024 * 1024, workers)), ("shared, claimed", _SharedRing(4 * 1024 * 1024))):
+        start, consumed, total = time.perf_counter(), 0, 0
+        for i in range(1000):
+            for j in range(400):
+                ring.write(j % workers, 0, 0, 14, packets[sizes[total % count]])
+                total += 1
+            for partition in range(workers):
+                for _ in range(30 if partition == 0 else 150):
+                    if ring.read(partition) is NO_BLOCK:
+                        break
+                    consumed += 1
+        print("[i] skewed load, {}: {:,.0f} packets/second, dropped {:.1f}%".format(name, total / (time.perf_counter() - start), 100.0 * ring.dropped / total))
@@ -0,0 +1,350 @@
+#!/usr/bin/env python3
+
+"""
+Copyright (c) 2014-2019 Maltrail developers (https://github.com/stamparm/maltrail/)
+See the file 'LICENSE' for copying permission
+"""
+
+# Precomputed (per-hour) aggregates of daily event logs, maintained incrementally from EventLogWriter's flushes.
+# Counts are kept by trail, info, severity, src_ip, dst_ip and sensor (i.e. SENSOR_NAME), each writing process
+# having its own sidecar (<log>.<pid>.rollup), while summary served to the web UI merges all of them. Summary is
+# deflated only once per change of underlying sidecars (identified by ETag). Days logged without rollups are backfilled
+# (either by server or by first RollupBuilder of that day) up to recorded log offset ("covered"), while builders skip
+# their records below the highest covered offset (hence, no event is counted twice). Per-hour counts of each dimension
+# are pruned to top ROLLUP_HOUR_ENTRIES keys once they grow twice as large (i.e. memory is bounded even for e.g. spoofed
+# src_ip floods, at the expense of tail counts), while summaries are cached only for ROLLUP_CACHE_DAYS (recent) days.
+
+import contextlib
+import glob
+import json
+import marshal
+import os
+import time
+import zlib
+
+try:
+    import fcntl
+except ImportError:     # (Note: no locking on Windows)
+    fcntl = None
+
+from log import get_event_log_path
+from log import parse_event_line
+from logindex import iter_blocks
+from lrucache import LRUCache
+from settings import DEFLATE_COMPRESS_LEVEL
+from settings import HIGH_PRIORITY_INFO_KEYWORDS
+from settings import HIGH_PRIORITY_REFERENCES
+from settings import HTTP_TIME_FORMAT
+from settings import LOW_PRIORITY_INFO_KEYWORDS
+from settings import ROLLUP_CACHE_DAYS
+from settings import ROLLUP_HOUR_ENTRIES
+from settings import ROLLUP_SAVE_PERIOD
+from settings import ROLLUP_TOP_ENTRIES
+
+ROLLUP_FIELDS = {"sensor": 1, "src_ip": 2, "dst_ip": 4, "trail": 8, "info": 9}
+ROLLUP_DIMENSIONS = tuple(sorted(ROLLUP_FIELDS)) + ("severity",)
+
+_response_cache = LRUCache(ROLLUP_CACHE_DAYS)
+
+@contextlib.contextmanager
+def _locked(path):
+    with open("{}.rollup.lock".format(path), 'a') as f:
+        if fcntl:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+def get_severity(info, reference):
+    if any(_ in info for _ in HIGH_PRIORITY_INFO_KEYWORDS) or reference in HIGH_PRIORITY_REFERENCES:
+        return "high"
+    elif any(_ in info for _ in LOW_PRIORITY_INFO_KEYWORDS):
+        return "low"
+    else:
+        return "medium"
+
+def _merge(target, source):
+    for key, value in source.items():
+        target[key] = target.get(key, 0) + value
+
+def _top(counts, limit=ROLLUP_TOP_ENTRIES):
+    return dict(sorted(counts.items(), key=lambda _: (-_[1], _[0]))[:limit])
+
+class Rollup(object):
+    def __init__(self, path, sidecar=None):
+        self.path = path
+        self.sidecar = sidecar or "{}.{}.rollup".format(path, os.getpid())
+        self.hours = {}     # hour -> {"events": count, <dimension>: {key: count}}
+        self.covered = 0    # log offset up to which records have been backfilled
+
+    def add(self, line):
+        fields = parse_event_line(line)
+
+        if len(fields) > max(ROLLUP_FIELDS.values()) + 1:
+            hour = int(fields[0][11:13])
+            _ = self.hours.get(hour)
+            if _ is None:
+                _ = self.hours[hour] = dict((dimension, {}) for dimension in ROLLUP_DIMENSIONS)
+                _["events"] = 0
+            _["events"] += 1
+            for dimension, index in ROLLUP_FIELDS.items():
+                counts = _[dimension]
+                counts[fields[index]] = counts.get(fields[index], 0) + 1
+                if len(counts) > 2 * ROLLUP_HOUR_ENTRIES:
+                    _[dimension] = _top(counts, ROLLUP_HOUR_ENTRIES)
+            severity = get_severity(fields[9], fields[10])
+            _["severity"][severity] = _["severity"].get(severity, 0) + 1
+
+    def merge(self, other):
+        for hour, values in other.hours.items():
+            if hour not in self.hours:
+                self.hours[hour] = dict((dimension, {}) for dimension in ROLLUP_DIMENSIONS)
+                self.hours[hour]["events"] = 0
+            self.hours[hour]["events"] += values["events"]
+            for dimension in ROLLUP_DIMENSIONS:
+                _merge(self.hours[hour][dimension], values[dimension])
+
+        return self
+
+    def save(self):
+        with open("{}.tmp".format(self.sidecar), "wb") as f:
+            marshal.dump({"hours": self.hours, "covered": self.covered}, f)
+        os.replace("{}.tmp".format(self.sidecar), self.sidecar)
+
+    def load(self):
+        with open(self.sidecar, "rb") as f:
+            _ = marshal.load(f)
+            self.hours, self.covered = _["hours"], _["covered"]
+
+        return self
+
+    def backfill(self, end):
+        """
+        Adds records of (already written) log before offset end
+        """
+
+        if os.path.isfile(self.path):
+            for offset, lines in iter_blocks(self.path):
+                if offset >= end:
+                    break
+                for line in lines:
+                    self.add(line)
+
+        self.covered = max(self.covered, end)
+
+        return self
+
+    def summary(self, limit=ROLLUP_TOP_ENTRIES):
+        """
+        Returns compact summary (top entries per dimension for whole day and for each hour)
+        """
+
+        retval = {"events": 0, "hours": {}}
+        totals = dict((dimension, {}) for dimension in ROLLUP_DIMENSIONS)
+
+        for hour, values in sorted(self.hours.items()):
+            retval["events"] += values["events"]
+            retval["hours"][hour] = {"events": values["events"]}
+            for dimension in ROLLUP_DIMENSIONS:
+                _merge(totals[dimension], values[dimension])
+                retval["hours"][hour][dimension] = _top(values[dimension], limit // 10 or 1)
+
+        for dimension in ROLLUP_DIMENSIONS:
+            retval[dimension] = _top(totals[dimension], limit)
+
+        return retval
+
+class RollupBuilder(object):
+    """
+    EventLogWriter listener maintaining rollups of written logs
+    """
+
+    def __init__(self, save_period=ROLLUP_SAVE_PERIOD):
+        self.save_period = save_period
+        self._rollups = {}
+        self._skip = {}
+        self._last_save = time.time()
+
+    def _register(self, path, offset):
+        retval = Rollup(path)
+
+        with _locked(path):
+            sidecars = [Rollup(path, _).load() for _ in glob.glob("{}.*.rollup".format(glob.escape(path)))]
+            if os.path.isfile(retval.sidecar):     # (Note: continuing own sidecar, e.g. in case of reused PID)
+                retval.load()
+            if sidecars:
+                self._skip[path] = max(_.covered for _ in sidecars)
+            else:
+                self._skip[path] = retval.backfill(offset).covered
+            retval.save()   # (Note: announcing live writer, hence server doesn't backfill this day anymore)
+
+        return retval
+
+    def __call__(self, path, offset, lines, compressed):
+        if path not in self._rollups:
+            for _ in list(self._rollups):       # daily rotation
+                self._rollups.pop(_).save()
+                self._skip.pop(_, None)
+            self._rollups[path] = self._register(path, offset)
+
+        rollup, skip = self._rollups[path], self._skip[path]
+        for line in lines:
+            if offset >= skip:
+                rollup.add(line)
+            if not compressed:
+                offset += len(line.encode("utf8"))
+
+        if time.time() - self._last_save >= self.save_period:
+            self.save()
+
+    def save(self):
+        for rollup in self._rollups.values():
+            rollup.save()
+        self._last_save = time.time()
+
+def build_rollup(path):
+    """
+    (Re)builds rollup of existing event log (Note: not to be used on logs still being written)
+    """
+
+    with _locked(path):
+        for _ in glob.glob("{}.*.rollup".format(glob.escape(path))):
+            os.remove(_)
+
+        retval = Rollup(path, "{}.0.rollup".format(path)).backfill(os.path.getsize(path))
+        retval.save()
+
+    return retval
+
+def _backfill_rollup(path):
+    """
+    Backfills rollup of given event log only if there is no (live) writer's sidecar
+    """
+
+    with _locked(path):
+        if not glob.glob("{}.*.rollup".format(glob.escape(path))):
+            Rollup(path, "{}.0.rollup".format(path)).backfill(os.path.getsize(path)).save()
+
+def get_rollup_response(day, etag=None, log_dir=None):
+    """
+    Returns (HTTP) status code, headers and (deflated) body of rollup summary for given day (If-None-Match being etag)
+    """
+
+    path = get_event_log_path(day, log_dir, not os.path.isfile(get_event_log_path(day, log_dir)))
+    sidecars = sorted(glob.glob("{}.*.rollup".format(glob.escape(path))))
+
+    if not sidecars:
+        if not os.path.isfile(path):
+            return 404, {}, b""
+        _backfill_rollup(path)
+        sidecars = sorted(glob.glob("{}.*.rollup".format(glob.escape(path))))
+
+    stats = [(_, os.stat(_)) for _ in sidecars]
+    current = "\"{:08x}\"".format(zlib.crc32(repr([(_, stat.st_mtime_ns, stat.st_size) for _, stat in stats]).encode("utf8")))
+    last_modified = time.strftime(HTTP_TIME_FORMAT, time.gmtime(max(stat.st_mtime for _, stat in stats)))
+
+    if _response_cache.get(day, (None,))[0] != current:
+        rollup = Rollup(path)
+        for _ in sidecars:
+            rollup.merge(Rollup(path, _).load())
+        _ = rollup.summary()
+        _["day"] = day
+        _response_cache[day] = (current, zlib.compress(json.dumps(_, sort_keys=True).encode("utf8"), DEFLATE_COMPRESS_LEVEL))
+
+    headers = {"ETag": current, "Last-Modified": last_modified, "Content-Type": "application/json", "Content-Encoding": "deflate", "Cache-Control": "no-cache"}
+
+    if etag == current:
+        return 304, headers, b""
+
+    return 200, headers, _response_cache[day][1]
+
+if __name__ == "__main__":
+    import random
+    import shutil
+    import sys
+    import tempfile
+
+    from log import EventLogWriter
+    from settings import config
+
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000 * 1000
+    config.SENSOR_NAME = "benchmark"
+    directory = tempfile.mkdtemp()
+
+    def _write(directory, start, count, builder=None):
+        writer = EventLogWriter(directory, compress=False, buffer_size=1024)
+        if builder is not None:
+            writer.listeners.append(builder)
+        for i in range(start, start + count):
+            writer.write((int(time.mktime(time.strptime("2019-11-18", "%Y-%m-%d"))) + i, 0, "10.0.0.%d" % (i % 250 + 1), 1024, "192.168.0.1", 53, "UDP", "DNS", "%d.example.com" % i, "malware", "(static)"))
+        writer.close()
+        if builder is not None:
+            builder.save()
+
+    # (self-check) no event is counted twice (nor missed) by mix of unrolled log (backfilled), live builders of
+    # different processes (each with own sidecar) and server's response
+    try:
+        import multiprocessing
+
+        _write(directory, 0, 1000)
+        _write(directory, 1000, 1000, RollupBuilder(save_period=0))
+        process = multiprocessing.get_context("fork").Process(target=_write, args=(directory, 2000, 1000, RollupBuilder(save_period=0)))
+        process.start()
+        process.join()
+        _write(directory, 3000, 1000, RollupBuilder(save_period=0))
+
+        code, _, body = get_rollup_response("2019-11-18", log_dir=directory)
+        events = json.loads(zlib.decompress(body))["events"] if code == 200 else None
+        lines = sum(1 for _ in open(get_event_log_path("2019-11-18", directory)))
+        if events != lines or lines != 4000:
+            exit("[x] self-check of rollup double counting failed ({} events in rollup, {:,} in log)".format(events, lines))
+        print("[i] self-check of rollup double counting passed ({:,} events from backfill and {} sidecars)".format(events, len(glob.glob("{}.*.rollup".format(get_event_log_path("2019-11-18", directory))))))
+    finally:
+        shutil.rmtree(directory)
+
+    directory = tempfile.mkdtemp()
+
+    try:
+        _ = random.Random(0)
+        writer = EventLogWriter(directory, compress=False)
+        builder = RollupBuilder(save_period=sys.maxsize)
+        writer.listeners.append(builder)
+        day = time.mktime(time.strptime("2019-11-19", "%Y-%m-%d"))
+        infos = (("malware", "(static)"), ("known attacker", "alienvault.com"), ("mass scanner", "(static)"), ("suspicious dynamic domain", "(static)"))
+
+        start = time.time()
+        for i in range(count):
+            info, reference = infos[_.randint(0, len(infos) - 1)]
+            writer.write((int(day + i * 86400.0 / count), i % 1000000, "10.0.%d.%d" % (_.randint(0, 255), _.randint(1, 254)), _.randint(1024, 65535), "192.168.%d.%d" % (_.randint(0, 3), _.randint(1, 254)), 53, "UDP", "DNS", "%x.example.com" % _.randint(0, 10000), info, reference))
+        writer.close()
+        builder.save()
+        print("[i] {:,} events written and rolled up in {:.1f}s".format(count, time.time() - start))
+
+        path = get_event_log_path("2019-11-19", directory)
+        start = time.time()
+        content = open(path, "rb").read()
+        deflated = zlib.compress(content, DEFLATE_COMPRESS_LEVEL)
+        counts = {}
+        for line in content.decode("utf8").split('\n')[:-1]:
+            fields = parse_event_line(line)
+            counts[fields[8]] = counts.get(fields[8], 0) + 1
+        print("[i] raw day: {:,} bytes ({:,} deflated), client-side aggregation in {:.2f}s".format(len(content), len(deflated), time.time() - start))
+
+        start = time.time()
+        code, headers, body = get_rollup_response("2019-11-19", log_dir=directory)
+        print("[i] rollup (first request): {:,} bytes (deflated) in {:.3f}s".format(len(body), time.time() - start))
+
+        start = time.time()
+        code, headers, body = get_rollup_response("2019-11-19", log_dir=directory)
+        print("[i] rollup (cached): {} in {:.6f}s".format(code, time.time() - start))
+
+        start = time.time()
+        code, _, _ = get_rollup_response("2019-11-19", etag=headers["ETag"], log_dir=directory)
+        print("[i] rollup (If-None-Match {}): {} in {:.6f}s".format(headers["ETag"], code, time.time() - start))
+
+        summary = json.loads(zlib.decompress(body))
+        print("[i] events: {:,}, severity: {}, top trail matches: {}".format(summary["events"], summary["severity"], max(summary["trail"].values()) == max(counts.values())))
+    finally:
+        shutil.rmtree(directory)
@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+
+"""
+Copyright (c) 2014-2019 Maltrail developers (https://github.com/stamparm/maltrail/)
+See the file 'LICENSE' for copying permission
+"""
+
+# Pool of PROCESS_COUNT (forked) worker processes pinned to CPU cores (leaving the first available core to
+# the capture process), with flow hash sharding of work and automatic restart of crashed workers
+
+import ctypes
+import multiprocessing
+import os
+import subprocess
+import time
+import zlib
+
+from settings import config
+from settings import CPU_CORES
+from settings import NAME
+
+def flow_hash(src_ip, src_port, dst_ip, dst_port, proto):
+    """
+    Returns direction-independent hash of given flow (i.e. same for both sides of connection)
+    """
+
+    if (src_ip, src_port) > (dst_ip, dst_port):
+        src_ip, src_port, dst_ip, dst_port = dst_ip, dst_port, src_ip, src_port
+
+    # (Note: CRC32 instead of built-in (salted) hash(), hence sharding is the same in each (spawned) process and run)
+    return zlib.crc32(("%s %s %s %s %s" % (src_ip, src_port, dst_ip, dst_port, proto)).encode("utf8"))
+
+def get_available_cpus():
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    else:
+        return list(range(CPU_CORES))
+
+def plan_affinity(process_count, cpus=None):
+    """
+    Returns (capture CPU, list of CPUs for each worker)
+    """
+
+    cpus = cpus or get_available_cpus()
+    capture, rest = cpus[0], (cpus[1:] or cpus)
+
+    return capture, [rest[i % len(rest)] for i in range(process_count)]
+
+def set_affinity(cpu, pid=0):
+    if config.DISABLE_CPU_AFFINITY or not hasattr(os, "sched_setaffinity"):
+        return False
+
+    try:
+        os.sched_setaffinity(pid, {cpu})
+    except OSError as ex:
+        print("[x] unable to set CPU affinity of process {} to core {} ({})".format(pid or os.getpid(), cpu, ex))
+        return False
+
+    return True
+
+class WorkerPool(object):
+    def __init__(self, target, process_count=None, args=()):
+        self.target = target
+        self.args = args
+        self.process_count = max(1, process_count or config.PROCESS_COUNT or CPU_CORES)
+        self.capture_cpu, self.cpus = plan_affinity(self.process_count)
+        self.counters = multiprocessing.RawArray(ctypes.c_ulonglong, self.process_count)
+        self.workers = [None] * self.process_count
+        self.restarts = [0] * self.process_count
+        self._context = multiprocessing.get_context("fork" if not subprocess._mswindows else "spawn")
+        self._last = (time.time(), [0] * self.process_count)
+
+    def _run(self, index):
+        set_affinity(self.cpus[index])
+        self.target(index, self.counters, *self.args)
+
+    def _spawn(self, index):
+        process = self._context.Process(target=self._run, args=(index,), name="{}-worker-{}".format(NAME.lower(), index))
+        process.daemon = True
+        process.start()
+        self.workers[index] = process
+
+    def start(self):
+        for index in range(self.process_count):
+            self._spawn(index)
+
+        if len(get_available_cpus()) > 1:
+            set_affinity(self.capture_cpu)
+
+    def shard(self, src_ip, src_port, dst_ip, dst_port, proto):
+        """
+        Returns index of worker responsible for given flow
+        """
+
+        return flow_hash(src_ip, src_port, dst_ip, dst_port, proto) % self.process_count
+
+    def supervise(self):
+        """
+        Restarts crashed workers (to be called periodically from main process)
+        """
+
+        for index, process in enumerate(self.workers):
+            if process is not None and not process.is_alive() and process.exitcode != 0:
+                print("[x] worker #{} crashed (exit code {}). Restarting...".format(index, process.exitcode))
+                self.restarts[index] += 1
+                self._spawn(index)
+
+    def throughput(self):
+        """
+        Returns per-worker processed items per second (since previous call)
+        """
+
+        now, counts = time.time(), list(self.counters)
+        last, previous = self._last
+        self._last = (now, counts)
+
+        return [(counts[i] - previous[i]) / max(now - last, 1e-6) for i in range(self.process_count)]
+
+    def imbalance(self, throughput=None):
+        """
+        Returns ratio between busiest and average worker (1.0 being perfect balance)
+        """
+
+        throughput = throughput or self.throughput()
+        average = sum(throughput) / len(throughput)
+
+        return max(throughput) / average if average else 1.0
+
+    def stop(self, timeout=None):
+        for process in self.workers:
+            if process is not None and process.is_alive():
+                process.terminate()
+
+        for process in self.workers:
+            if process is not None:
+                process.join(timeout)
+
+if __name__ == "__main__":
+    import random
+    import sys
+
+    # (self-check) flow hash has to be direction-independent and the same regardless of PYTHONHASHSEED
+    flow = ("10.0.0.1", 1234, "192.168.0.1", 80, "TCP")
+    code = "from scheduler import flow_hash; print(flow_hash{!r})".format(flow)
+    hashes = set(int(subprocess.check_output([sys.executable, "-W", "ignore", "-c", code], cwd=os.path.dirname(os.path.abspath(__file__)), env=dict(os.environ, PYTHONHASHSEED=str(_)))) for _ in (1, 2))
+    if hashes != {flow_hash(*flow)} or flow_hash(*flow) != flow_hash(flow[2], flow[3], flow[0], flow[1], flow[4]):
+        exit("[x] self-check of flow hash failed ({})".format(hashes))
+    print("[i] self-check of flow hash passed (deterministic and direction-independent)")
+
+    def _worker(index, counters):
+        while True:
+            counters[index] += 1
+            if index == 0 and counters[index] == 100000:
+                os._exit(1)
+
+    pool = WorkerPool(_worker, CPU_CORES)
+    print("[i] capture core: {}, worker cores: {}".format(pool.capture_cpu, pool.cpus))
+
+    flows = [("10.0.0.%d" % random.randint(1, 254), random.randint(1024, 65535), "192.168.1.%d" % random.randint(1, 254), random.choice((53, 80, 443)), "TCP") for _ in range(100000)]
+    shards = [0] * pool.process_count
+    for flow in flows:
+        shards[pool.shard(*flow)] += 1
+    print("[i] flow distribution over workers: {}".format(shards))
+
+    pool.start()
+    pool.throughput()
+    for _ in range(3):
+        time.sleep(1)
+        pool.supervise()
+        throughput = pool.throughput()
+        print("[i] throughput: {} (imbalance {:.2f}, restarts {})".format(", ".join("{:,.0f}/s".format(_) for _ in throughput), pool.imbalance(throughput), sum(pool.restarts)))
+    pool.stop()
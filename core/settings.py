@@ -5,6 +5,7 @@ Copyright (c) 2014-2019 Maltrail developers (https://github.com/stamparm/maltrai
 See the file 'LICENSE' for copying permission
 """
 
+import hashlib
 import os
 import re
 import socket
@@ -12,18 +13,20 @@ import stat
 import string
 import subprocess
 import sys
-import urllib
+import urllib.parse
+import urllib.request
 
 #from core.addr import addr_to_int
 #from core.addr import make_mask
-#from core.attribdict import AttribDict
+#from core.configdict import ConfigDict
+#from core.lrucache import LRUCache
 #from core.trailsdict import TrailsDict
 from addr import addr_to_int
 from addr import make_mask
-from attribdict import AttribDict
+from configdict import ConfigDict
+from lrucache import LRUCache
 from trailsdict import TrailsDict
 
-config = AttribDict()
 trails = TrailsDict()
 
 NAME = "Maltrail"
@@ -35,6 +38,13 @@ TIMEOUT = 30
 FRESH_IPCAT_DELTA_DAYS = 10
 USERS_DIR = os.path.join(os.path.expanduser("~"), ".{}".format(NAME.lower()))
 TRAILS_FILE = os.path.join(USERS_DIR, "trails.csv")
+TRAILS_VERSION_FILE = os.path.join(USERS_DIR, "trails.version")
+TRAILS_SNAPSHOT_DIR = os.path.join(USERS_DIR, "snapshots")
+TRAILS_SNAPSHOT_HISTORY = 10
+TRAILS_SNAPSHOT_VERSION_FILE = os.path.join(TRAILS_SNAPSHOT_DIR, "version")
+TRAILS_DELTA_FILE = os.path.join(USERS_DIR, "trails.delta")
+TRAILS_DELTA_COMPACT_RATIO = 0.25
+FEEDS_MANIFEST_FILE = os.path.join(USERS_DIR, "feeds.json")
 IPCAT_CSV_FILE = os.path.join(USERS_DIR, "ipcat.csv")
 IPCAT_SQLITE_FILE = os.path.join(USERS_DIR, "ipcat.sqlite")
 IPCAT_URL = "https://raw.githubusercontent.com/client9/ipcat/master/datacenters.csv"    # 文件里面是IP地址段和对应的数据中心
@@ -50,6 +60,21 @@ SNAP_LEN = 2000
 BLOCK_LENGTH = 1 + 2 + 4 + 4 + 4 + SNAP_LEN  # primitive mutex + short for packet size + int for sec + int for usec + int for IP offset + max packet size
 SHORT_SENSOR_SLEEP_TIME = 0.00001
 REGULAR_SENSOR_SLEEP_TIME = 0.001
+WAKEUP_SPIN_COUNT = 0
+WAKEUP_BACKOFF_COUNT = 0
+WAKEUP_TIMEOUT = 0.1
+OVERLOAD_CHECK_INTERVAL = 1024
+OVERLOAD_LOW_WATERMARK = 0.3
+OVERLOAD_HIGH_WATERMARK = 0.7
+OVERLOAD_SAMPLING_WATERMARK = 0.9
+OVERLOAD_MAX_LAG = 1.0
+OVERLOAD_SAMPLE_RATE = 16
+HOT_CACHE_SIZE = 4096
+MEMORY_HISTORY_SIZE = 60
+MEMORY_SAMPLE_PERIOD = 60
+BENCHMARK_BASELINE_FILE = os.path.join(USERS_DIR, "benchmark.json")
+BENCHMARK_REGRESSION_THRESHOLD = 0.2
+BENCHMARK_REPEAT = 3
 LOAD_TRAILS_RETRY_SLEEP_TIME = 60
 UNAUTHORIZED_SLEEP_TIME = 5
 NO_SUCH_NAME_PER_HOUR_THRESHOLD = 20
@@ -58,7 +83,6 @@ NO_BLOCK = -1
 END_BLOCK = -2
 ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
 HTML_DIR = os.path.join(ROOT_DIR, "html")
-DISPOSED_NONCES = set()
 PING_RESPONSE = "pong"
 MAX_NOFILE = 65000
 CAPTURE_TIMEOUT = 100  # ms
@@ -112,17 +136,34 @@ CDN_RANGES = {}
 WHITELIST_HTTP_REQUEST_PATHS = ("fql", "yql", "ads", "../images/", "../themes/", "../design/", "../scripts/", "../assets/", "../core/", "../js/", "/gwx/")
 WHITELIST_UA_KEYWORDS = ("AntiVir-NGUpd", "TMSPS", "AVGSETUP", "SDDS", "Sophos", "Symantec", "internal dummy connection")
 WHITELIST_LONG_DOMAIN_NAME_KEYWORDS = ("blogspot",)
-SESSIONS = {}
-NO_SUCH_NAME_COUNTERS = {}  # this won't be (expensive) shared in multiprocessing run (hence, the threshold will effectively be n-times higher)
 SESSION_ID_LENGTH = 16
 SESSION_EXPIRATION_HOURS = 24
 IPPROTO_LUT = dict(((getattr(socket, _), _.replace("IPPROTO_", "")) for _ in dir(socket) if _.startswith("IPPROTO_")))
 DEFLATE_COMPRESS_LEVEL = 9
+EVENT_LOG_BUFFER_SIZE = 1024 * 1024
+EVENT_LOG_FLUSH_PERIOD = 1
+EVENT_INDEX_SAVE_PERIOD = 60
+ROLLUP_SAVE_PERIOD = 60
+ROLLUP_TOP_ENTRIES = 100
+ROLLUP_HOUR_ENTRIES = 10000
+ROLLUP_CACHE_DAYS = 31
+REMOTE_QUEUE_SIZE = 100000
+REMOTE_BATCH_SIZE = 8192
+REMOTE_FLUSH_PERIOD = 0.1
+COLLECTOR_BATCH_SIZE = 256
+MAX_COLLECTOR_SENSORS = 1000
+STATS_SAMPLE_RATE = 64
+STATS_HISTOGRAM_BUCKETS = 32
 PORT_SCANNING_THRESHOLD = 10
 MAX_RESULT_CACHE_ENTRIES = 10000
+SESSIONS = LRUCache(MAX_RESULT_CACHE_ENTRIES, SESSION_EXPIRATION_HOURS * 60 * 60)
+DISPOSED_NONCES = LRUCache(None, SESSION_EXPIRATION_HOURS * 60 * 60)    # (Note: no capacity based eviction, as evicted nonce could be replayed)
+NO_SUCH_NAME_COUNTERS = LRUCache(MAX_RESULT_CACHE_ENTRIES)  # this won't be shared in multiprocessing run (Note: core/counters.py provides exact counters shared between workers)
 MMAP_ZFILL_CHUNK_LENGTH = 1024 * 1024
 DAILY_SECS = 24 * 60 * 60
 DNS_EXHAUSTION_THRESHOLD = 1000
+SHARED_COUNTER_SLOTS = 64 * 1024
+SHARED_COUNTER_PROBES = 32
 SUSPICIOUS_DOMAIN_LENGTH_THRESHOLD = 24
 SUSPICIOUS_DOMAIN_CONSONANT_THRESHOLD = 7
 SUSPICIOUS_DOMAIN_ENTROPY_THRESHOLD = 3.5
@@ -146,6 +187,20 @@ STATIC_IPCAT_LOOKUPS = {"shadowserver.org": ("184.105.139.66-184.105.139.126", "
                         "comsys.rwth-aachen.de": ("137.226.113.0-137.226.113.63",), 
                         "sba-research.org": ("98.189.26.18",)}
 
+# Known configuration options with their value types (Note: accessing an unknown option on config raises AttributeError)
+CONFIG_OPTIONS = {"HTTP_ADDRESS": str, "HTTP_PORT": int, "USE_SSL": bool, "SSL_PEM": str, "USERS": list, "UDP_ADDRESS": str, "UDP_PORT": int,
+                  "USE_SERVER_UPDATE_TRAILS": bool, "IP_ALIASES": list, "PROCESS_COUNT": int, "DISABLE_CPU_AFFINITY": bool, "USE_FEED_UPDATES": bool,
+                  "DISABLED_FEEDS": str, "DISABLED_TRAILS_INFO_REGEX": str, "UPDATE_PERIOD": int, "CUSTOM_TRAILS_URL": str, "CUSTOM_TRAILS_DIR": str,
+                  "CAPTURE_BUFFER": str, "MONITOR_INTERFACE": str, "CAPTURE_FILTER": str, "SENSOR_NAME": str, "LOG_SERVER": str, "SYSLOG_SERVER": str,
+                  "DISABLE_LOCAL_LOG_STORAGE": bool, "UPDATE_SERVER": str, "USE_HEURISTICS": bool, "CHECK_MISSING_HOST": bool, "CHECK_HOST_DOMAINS": bool,
+                  "USER_WHITELIST": str, "USER_IGNORELIST": str, "SHOW_DEBUG": bool, "LOG_DIR": str, "COMPRESS_LOG_STORAGE": bool, "PROXY_ADDRESS": str, "DISABLE_CHECK_SUDO": bool,
+                  "USE_MULTIPROCESSING": bool, "ENABLE_STATS": bool}
+BOOLEAN_CONFIG_PREFIXES = ("USE_", "SET_", "CHECK_", "ENABLE_", "SHOW_", "DISABLE_")
+CONFIG_VARIABLE_REGEX = re.compile(r"\$([A-Z0-9_]+)")
+
+config = ConfigDict(CONFIG_OPTIONS)
+_config_cache = {}
+
 # Reference: https://gist.github.com/ryanwitt/588678
 DLT_OFFSETS = { 0: 4, 1: 14, 6: 22, 7: 6, 8: 16, 9: 4, 10: 21, 117: 48, 18: 4, 12 if sys.platform.find('openbsd') != -1 else 108: 4, 14 if sys.platform.find('openbsd') != -1 else 12: 0, 113: 16 }
 
@@ -234,144 +289,176 @@ def check_memory():
     except MemoryError:
         exit("[!] not enough memory")
 
-def read_config(config_file):
-    global config
+def _convert_value(name, value):
+    _type = CONFIG_OPTIONS.get(name)
 
-    if not os.path.isfile(config_file):
-        exit("[!] missing configuration file {}".format(config_file))
-    else:
-        print("[i] using configuration file {}".format(config_file))
+    if _type is list:
+        return value
 
-    config.clear()
+    if _type is bool or (_type is None and any(name.startswith(_) for _ in BOOLEAN_CONFIG_PREFIXES)):
+        return value.lower() in ("1", "true")
 
-    try:
-        array = None
-        content = open(config_file, 'r').read()
-
-        for line in content.split("\n"):
-            line = line.strip('\r')
-            line = re.sub(r"\s*#.*", "", line)  # 去掉注释部分
-            if not line.strip():                # 如果本行为注释，则处理完后line为空，这时跳转到下一行
-                continue
-
-            if line.count(' ') == 0:            # 只有USERS, IP_ALIASES, USER_WHITELIST这三个配置语句中没有空格
-                if re.search(r"[^\w]", line):   # 匹配到配置内容，如USERS的内容和IP_ALIASES的内容
-                    if array == "USERS":
-                        exit("[!] invalid USERS entry {}\n[?] (hint: add whitespace at start of line)".format(line))
-                    else:
-                        exit("[!] invalid configuration (line: {})".format(line))
-                array = line.upper()
-                config[array] = []
-                continue
-
-            if array and line.startswith(' '):  # 将IP_ALIASES和USERS的配置内容存放到列表中
-                config[array].append(line.strip())
-                continue
-            else:                               # 处理USERS, IP_ALIASES, USER_WHITELIST这三个配置以外的配置，解析出配置名name和配置的值value
-                array = None
-                try:
-                    name, value = line.strip().split(' ', 1)
-                except ValueError:
-                    name = line
-                    value = ""
-                finally:
-                    name = name.strip().upper()
-                    value = value.strip("'\"").strip()
-            
-            _ = os.environ.get("{}_{}".format(NAME.upper(), name))
-            if _:
-                value = _
-            
-            if any(name.startswith(_) for _ in ("USE_", "SET_", "CHECK_", "ENABLE_", "SHOW_", "DISABLE_")):
-                value = value.lower() in ("1", "true")
-            elif value.isdigit():
-                value = int(value)
-            else:                               # 处理系统命令
-                for match in re.finditer(r"\$([A-Z0-9_]+)", value):
-                    if match.group(1) in globals():
-                        value = value.replace(match.group(0), str(globals()[match.group(1)]))
-                    else:
-                        value = value.replace(match.group(0), os.environ.get(match.group(1), match.group(0)))
-                if name.endswith("_DIR"):
-                    value = os.path.realpath(os.path.join(ROOT_DIR, os.path.expanduser(value)))
-            
-            config[name] = value
+    for match in CONFIG_VARIABLE_REGEX.finditer(value):         # 处理系统命令
+        if match.group(1) in globals():
+            value = value.replace(match.group(0), str(globals()[match.group(1)]))
+        else:
+            value = value.replace(match.group(0), os.environ.get(match.group(1), match.group(0)))
+
+    if name.endswith("_DIR"):
+        value = os.path.realpath(os.path.join(ROOT_DIR, os.path.expanduser(value)))
+    elif _type is int or (_type is None and value.isdigit()):
+        if not value:               # (Note: empty value means unset option)
+            return None
+        elif not value.isdigit():
+            exit("[!] invalid configuration value for '{}' ('{}')".format(name, value))
+        value = int(value)
+
+    return value
+
+def _parse_config(content):
+    retval = ConfigDict(CONFIG_OPTIONS)
+    array = None
+
+    for line in content.split("\n"):
+        line = line.strip('\r')
+        line = re.sub(r"\s*#.*", "", line)  # 去掉注释部分
+        if not line.strip():                # 如果本行为注释，则处理完后line为空，这时跳转到下一行
+            continue
+
+        if line.count(' ') == 0:            # 只有USERS, IP_ALIASES, USER_WHITELIST这三个配置语句中没有空格
+            if re.search(r"[^\w]", line):   # 匹配到配置内容，如USERS的内容和IP_ALIASES的内容
+                if array == "USERS":
+                    exit("[!] invalid USERS entry {}\n[?] (hint: add whitespace at start of line)".format(line))
+                else:
+                    exit("[!] invalid configuration (line: {})".format(line))
+            array = line.upper()
+            retval[array] = []
+            continue
+
+        if array and line.startswith(' '):  # 将IP_ALIASES和USERS的配置内容存放到列表中
+            retval[array].append(line.strip())
+            continue
+        else:                               # 处理USERS, IP_ALIASES, USER_WHITELIST这三个配置以外的配置，解析出配置名name和配置的值value
+            array = None
+            try:
+                name, value = line.strip().split(' ', 1)
+            except ValueError:
+                name = line
+                value = ""
+            finally:
+                name = name.strip().upper()
+                value = value.strip("'\"").strip()
+
+        _ = os.environ.get("{}_{}".format(NAME.upper(), name))
+        if _:
+            value = _
+
+        retval[name] = _convert_value(name, value)
 
-    except (IOError, OSError):
-        pass
-    # 以上将配置文件的内容读取到config结构中，接下来处理配置文件
+    return retval
 
+def _validate_config(values, config_file):
     for option in ("MONITOR_INTERFACE", "CAPTURE_BUFFER", "LOG_DIR"):
-        if not option in config:
+        if not option in values:
             exit("[!] missing mandatory option {} in configuration file {}".format(option, config_file))
-    
-    for entry in (config.USERS or []):
+
+    for entry in (values.USERS or []):
         if len(entry.split(":")) != 4:
             exit("[!] invalid USERS entry {}".format(entry))
         if re.search(r"\$\d+\$", entry):
             exit("[!] invalid USERS entry {}\n[?] (hint: please  update PBKDF2 hashes to SHA256 in your configuration file)".format(entry))
 
-    if config.SSL_PEM:
-        config.SSL_PEM = config.SSL_PEM.replace('/', os.sep)
+    if values.SSL_PEM:
+        values.SSL_PEM = values.SSL_PEM.replace('/', os.sep)
 
-    if config.USER_WHITELIST:
-        if ',' in config.USER_WHITELIST:
+    if values.USER_WHITELIST:
+        if ',' in values.USER_WHITELIST:
             print("[x] configuration value 'USER_WHITELIST' has been changed. Please use it to set location of whitelist file")
-        elif not os.path.isfile(config.USER_WHITELIST):
-            exit("[!] missing 'USER_WHITELIST' file '%s'" % config.USER_WHITELIST)
-        else:
-            read_whitelist()
+        elif not os.path.isfile(values.USER_WHITELIST):
+            exit("[!] missing 'USER_WHITELIST' file '%s'" % values.USER_WHITELIST)
 
-    if config.USER_IGNORELIST:
-        if not os.path.isfile(config.USER_IGNORELIST):
-            exit("[!] missing 'USER_IGNORELIST' file '%s'" % config.USER_IGNORELIST)
-        else:
-            read_ignorelist()
+    if values.USER_IGNORELIST:
+        if not os.path.isfile(values.USER_IGNORELIST):
+            exit("[!] missing 'USER_IGNORELIST' file '%s'" % values.USER_IGNORELIST)
 
-    config.PROCESS_COUNT = int(config.PROCESS_COUNT or CPU_CORES)
+    values.PROCESS_COUNT = int(values.PROCESS_COUNT or CPU_CORES)
 
-    if config.USE_MULTIPROCESSING:
+    if values.USE_MULTIPROCESSING:
         print("[x] configuration switch 'USE_MULTIPROCESSING' is deprecated. Please use 'PROCESS_COUNT' instead")
 
-    if config.DISABLE_LOCAL_LOG_STORAGE and not any((config.LOG_SERVER, config.SYSLOG_SERVER)):
+    if values.DISABLE_LOCAL_LOG_STORAGE and not any((values.LOG_SERVER, values.SYSLOG_SERVER)):
         print("[x] configuration switch 'DISABLE_LOCAL_LOG_STORAGE' turned on and neither option 'LOG_SERVER' nor 'SYSLOG_SERVER' are set. Falling back to console output of event data")
 
-    if config.UDP_ADDRESS is not None and config.UDP_PORT is None:
+    if values.UDP_ADDRESS is not None and values.UDP_PORT is None:
         exit("[!] usage of configuration value 'UDP_ADDRESS' requires also usage of 'UDP_PORT'")
 
-    if config.UDP_ADDRESS is None and config.UDP_PORT is not None:
+    if values.UDP_ADDRESS is None and values.UDP_PORT is not None:
         exit("[!] usage of configuration value 'UDP_PORT' requires also usage of 'UDP_ADDRESS'")
 
-    if not str(config.HTTP_PORT or "").isdigit():
-        exit("[!] invalid configuration value for 'HTTP_PORT' ('%s')" % config.HTTP_PORT)
+    if not str(values.HTTP_PORT or "").isdigit():
+        exit("[!] invalid configuration value for 'HTTP_PORT' ('%s')" % values.HTTP_PORT)
 
-    if config.PROCESS_COUNT and subprocess._mswindows:
-        print "[x] multiprocessing is currently not supported on Windows OS"
-        config.PROCESS_COUNT = 1
+    if values.PROCESS_COUNT and subprocess._mswindows:
+        print("[x] multiprocessing is currently not supported on Windows OS")
+        values.PROCESS_COUNT = 1
 
-    if config.CAPTURE_BUFFER:
-        if str(config.CAPTURE_BUFFER or "").isdigit():
-            config.CAPTURE_BUFFER = int(config.CAPTURE_BUFFER)
-        elif re.search(r"\d+\s*[kKmMgG]B", config.CAPTURE_BUFFER):
-            match = re.search(r"(\d+)\s*([kKmMgG])B", config.CAPTURE_BUFFER)
-            config.CAPTURE_BUFFER = int(match.group(1)) * {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}[match.group(2).upper()]
-        elif re.search(r"\d+%", config.CAPTURE_BUFFER):
+    if values.CAPTURE_BUFFER:
+        if str(values.CAPTURE_BUFFER or "").isdigit():
+            values.CAPTURE_BUFFER = int(values.CAPTURE_BUFFER)
+        elif re.search(r"\d+\s*[kKmMgG]B", values.CAPTURE_BUFFER):
+            match = re.search(r"(\d+)\s*([kKmMgG])B", values.CAPTURE_BUFFER)
+            values.CAPTURE_BUFFER = int(match.group(1)) * {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}[match.group(2).upper()]
+        elif re.search(r"\d+%", values.CAPTURE_BUFFER):
             physmem = _get_total_physmem()
 
             if physmem:
-                config.CAPTURE_BUFFER = physmem * int(re.search(r"(\d+)%", config.CAPTURE_BUFFER).group(1)) / 100
+                values.CAPTURE_BUFFER = physmem * int(re.search(r"(\d+)%", values.CAPTURE_BUFFER).group(1)) // 100
             else:
                 exit("[!] unable to determine total physical memory. Please use absolute value for 'CAPTURE_BUFFER'")
         else:
-            exit("[!] invalid configuration value for 'CAPTURE_BUFFER' ('%s')" % config.CAPTURE_BUFFER)
+            exit("[!] invalid configuration value for 'CAPTURE_BUFFER' ('%s')" % values.CAPTURE_BUFFER)
+
+        values.CAPTURE_BUFFER = values.CAPTURE_BUFFER // BLOCK_LENGTH * BLOCK_LENGTH
 
-        config.CAPTURE_BUFFER = config.CAPTURE_BUFFER / BLOCK_LENGTH * BLOCK_LENGTH
+    return values
+
+def read_config(config_file):
+    """
+    Reads (validated) configuration into (read-only) config object, reusing
+    already parsed result while file content and environment stay the same
+    """
+
+    if not os.path.isfile(config_file):
+        exit("[!] missing configuration file {}".format(config_file))
+    else:
+        print("[i] using configuration file {}".format(config_file))
+
+    try:
+        with open(config_file, 'rb') as f:
+            content = f.read()
+        key = (os.path.realpath(config_file), os.stat(config_file).st_mtime, hashlib.sha1(content).hexdigest(), tuple(sorted((_, os.environ[_]) for _ in os.environ if _.startswith("{}_".format(NAME.upper())))))
+    except (IOError, OSError):
+        content, key = b"", None
+
+    if key not in _config_cache:
+        _config_cache.clear()
+        _config_cache[key] = dict(_validate_config(_parse_config(content.decode("utf8", "ignore")), config_file))
+
+    config.load(_config_cache[key])
+
+    if config.USER_WHITELIST and os.path.isfile(config.USER_WHITELIST):
+        read_whitelist()
+
+    if config.USER_IGNORELIST and os.path.isfile(config.USER_IGNORELIST):
+        read_ignorelist()
 
     if config.PROXY_ADDRESS:
         PROXIES.update({"http": config.PROXY_ADDRESS, "https": config.PROXY_ADDRESS})
         opener = urllib.request.build_opener(urllib.request.ProxyHandler(PROXIES))
         urllib.request.install_opener(opener)
 
+    return config
+
 def read_whitelist():
     WHITELIST.clear()
     WHITELIST_RANGES.clear()
@@ -463,6 +550,8 @@ def read_web_shells():
 
 # 从worst_asns.txt中读取网络前缀、掩码和名称，存放在WORST_ASNS字典中，字典的键是IP地址的前8字节，值是网络前缀、掩码和名称组成的元组
 def read_worst_asn():
+    WORST_ASNS.clear()
+
     _ = os.path.abspath(os.path.join(ROOT_DIR, "misc", "worst_asns.txt"))
     if os.path.isfile(_):
         with open(_, "r") as f:
@@ -478,6 +567,8 @@ def read_worst_asn():
                     WORST_ASNS[key].append((addr_to_int(prefix), make_mask(int(mask)), name))
 
 def read_cdn_ranges():
+    CDN_RANGES.clear()
+
     _ = os.path.abspath(os.path.join(ROOT_DIR, "misc", "cdn_ranges.txt"))
     if os.path.isfile(_):
         with open(_, "r") as f:
@@ -494,6 +585,8 @@ def read_cdn_ranges():
 
 # 从bogon_ranges.txt中读取网络前缀、掩码，存放在BOGON_RANGES字典中，字典的键是IP地址的前8字节，值是网络前缀、掩码组成的元组
 def read_bogon_ranges():
+    BOGON_RANGES.clear()
+
     _ = os.path.abspath(os.path.join(ROOT_DIR, "misc", "bogon_ranges.txt"))
     if os.path.isfile(_):
         with open(_, "r") as f:
@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+
+"""
+Copyright (c) 2014-2019 Maltrail developers (https://github.com/stamparm/maltrail/)
+See the file 'LICENSE' for copying permission
+"""
+
+# Asynchronous (background thread) shipping of events to LOG_SERVER (raw log lines) and/or SYSLOG_SERVER (CEF records)
+# through bounded queue. Multiple (newline separated) records are batched into a single datagram (UDP) or send() call
+# (TCP, in case of address prefixed with "tcp://"). If queue is full, events are dropped (and accounted) instead of
+# blocking worker processes on network I/O.
+
+import os
+import queue
+import re
+import socket
+import threading
+import time
+
+from log import format_event
+from settings import config
+from settings import CEF_FORMAT
+from settings import HOSTNAME
+from settings import NAME
+from settings import REMOTE_BATCH_SIZE
+from settings import REMOTE_FLUSH_PERIOD
+from settings import REMOTE_QUEUE_SIZE
+from settings import TRAILS_FILE
+from settings import VERSION
+
+_syslog_time_cache = [None, None]
+
+def _syslog_time(sec):
+    if _syslog_time_cache[0] != sec:
+        _syslog_time_cache[:] = sec, time.strftime("%b %d %H:%M:%S", time.localtime(sec))
+
+    return _syslog_time_cache[1]
+
+def parse_address(value):
+    """
+    Returns (protocol, host, port) from address like "192.168.2.107:8337", "[fe80::1%eno1]:8337" or "tcp://host:514"
+    """
+
+    match = re.search(r"\A(?:(udp|tcp)://)?(?:\[([^\]]+)\]|([^:]+)):(\d+)\Z", (value or "").strip(), re.I)
+
+    if not match:
+        raise ValueError("invalid remote address '{}'".format(value))
+
+    return (match.group(1) or "udp").lower(), match.group(2) or match.group(3), int(match.group(4))
+
+def format_remote(event_tuple):
+    return "{} {}".format(int(event_tuple[0]), format_event(event_tuple)[1].rstrip('\n'))
+
+def format_cef(event_tuple, signature_id):
+    sec, usec, src_ip, src_port, dst_ip, dst_port, proto, trail_type, trail, info, reference = event_tuple[:11]
+    extension = "src={} spt={} dst={} dpt={} trail={} ref={}".format(src_ip, src_port, dst_ip, dst_port, trail, reference)
+
+    return CEF_FORMAT.format(syslog_time=_syslog_time(int(sec)), host=HOSTNAME, device_vendor=NAME, device_product="sensor", device_version=VERSION, signature_id=signature_id, name=info, severity=0, extension=extension)
+
+class _Target(object):
+    def __init__(self, address, formatter):
+        self.protocol, self.host, self.port = parse_address(address)
+        self.formatter = formatter
+        self.socket = None
+
+    def _connect(self):
+        family, _, _, _, address = socket.getaddrinfo(self.host, self.port, 0, socket.SOCK_DGRAM if self.protocol == "udp" else socket.SOCK_STREAM)[0]
+        self.socket = socket.socket(family, socket.SOCK_DGRAM if self.protocol == "udp" else socket.SOCK_STREAM)
+        if self.protocol == "tcp":
+            self.socket.settimeout(REMOTE_FLUSH_PERIOD * 10)
+            self.socket.connect(address)
+        self.address = address
+
+    def send(self, data):
+        try:
+            if self.socket is None:
+                self._connect()
+            if self.protocol == "udp":
+                self.socket.sendto(data, self.address)
+            else:
+                self.socket.sendall(data)
+        except (socket.error, OSError):
+            if self.socket is not None:
+                self.socket.close()
+            self.socket = None
+            raise
+
+class LogShipper(object):
+    def __init__(self, log_server=None, syslog_server=None, queue_size=REMOTE_QUEUE_SIZE, batch_size=REMOTE_BATCH_SIZE, flush_period=REMOTE_FLUSH_PERIOD, timeout=0):
+        self.targets = []
+        self.batch_size = batch_size
+        self.flush_period = flush_period
+        self.timeout = timeout      # (optional) backpressure (i.e. max seconds to wait for free queue slot)
+        self.queued = 0
+        self.dropped = 0
+        self.failed = 0
+        self.records = 0
+        self.batches = 0
+        self._queue = queue.Queue(queue_size)
+        self._signature = (None, None)
+        self._thread = None
+
+        if log_server or config.LOG_SERVER:
+            self.targets.append(_Target(log_server or config.LOG_SERVER, lambda event_tuple: format_remote(event_tuple)))
+
+        if syslog_server or config.SYSLOG_SERVER:
+            self.targets.append(_Target(syslog_server or config.SYSLOG_SERVER, lambda event_tuple: format_cef(event_tuple, self._signature_id())))
+
+    def _signature_id(self):
+        now = int(time.time()) // 60
+
+        if self._signature[0] != now:
+            try:
+                self._signature = now, time.strftime("%Y-%m-%d", time.localtime(os.path.getctime(TRAILS_FILE)))
+            except OSError:
+                self._signature = now, "-"
+
+        return self._signature[1]
+
+    def ship(self, event_tuple):
+        if not self.targets:
+            return False
+
+        try:
+            if self.timeout:
+                self._queue.put(event_tuple, True, self.timeout)
+            else:
+                self._queue.put_nowait(event_tuple)
+        except queue.Full:
+            self.dropped += 1
+            return False
+
+        self.queued += 1
+        return True
+
+    def _drain(self, block=True):
+        retval = []
+
+        try:
+            retval.append(self._queue.get(block, self.flush_period))
+            while len(retval) < self._queue.maxsize:
+                retval.append(self._queue.get_nowait())
+        except queue.Empty:
+            pass
+
+        return retval
+
+    def _send(self, events):
+        for target in self.targets:
+            batch, size = [], 0
+
+            for event_tuple in events:
+                record = (target.formatter(event_tuple) + '\n').encode("utf8")
+                if batch and size + len(record) > self.batch_size:
+                    self._send_batch(target, batch)
+                    batch, size = [], 0
+                batch.append(record)
+                size += len(record)
+
+            if batch:
+                self._send_batch(target, batch)
+
+    def _send_batch(self, target, batch):
+        try:
+            target.send(b"".join(batch))
+            self.records += len(batch)
+            self.batches += 1
+        except (socket.error, OSError) as ex:
+            self.failed += len(batch)
+            if config.SHOW_DEBUG:
+                print("[x] unable to send {} record(s) to {}:{} ({})".format(len(batch), target.host, target.port, ex))
+
+    def flush(self):
+        """
+        Sends all queued events (in calling thread)
+        """
+
+        while not self._queue.empty():
+            self._send(self._drain(False))
+
+    def start(self):
+        def _(self):
+            while True:
+                events = self._drain()
+                if events:
+                    self._send(events)
+
+        self._thread = threading.Thread(target=_, args=(self,))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stats(self):
+        return {"queued": self.queued, "dropped": self.dropped, "failed": self.failed, "records": self.records, "batches": self.batches, "pending": self._queue.qsize()}
+
+if __name__ == "__main__":
+    count = 100000
+    config.SENSOR_NAME = "test"
+    received = {"udp": 0, "tcp": 0}
+
+    udp_server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    udp_server.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 8 * 1024 * 1024)
+    udp_server.bind(("127.0.0.1", 0))
+    tcp_server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    tcp_server.bind(("127.0.0.1", 0))
+    tcp_server.listen(1)
+
+    def _udp_listener():
+        while True:
+            received["udp"] += udp_server.recv(65536).count(b'\n')
+
+    def _tcp_listener():
+        connection, _ = tcp_server.accept()
+        while True:
+            data = connection.recv(65536)
+            if not data:
+                break
+            received["tcp"] += data.count(b'\n')
+
+    for _ in (_udp_listener, _tcp_listener):
+        _ = threading.Thread(target=_)
+        _.daemon = True
+        _.start()
+
+    shipper = LogShipper("127.0.0.1:{}".format(udp_server.getsockname()[1]), "tcp://127.0.0.1:{}".format(tcp_server.getsockname()[1]))
+    shipper.start()
+
+    start = time.time()
+    for i in range(count):
+        shipper.ship((time.time(), i % 1000000, "10.0.0.1", 1024 + i % 1000, "192.168.0.1", 53, "UDP", "DNS", "evil.com", "malware", "(static)"))
+    enqueue_time = time.time() - start
+
+    while shipper.records + shipper.failed < count * len(shipper.targets) and time.time() - start < 60:
+        time.sleep(0.1)
+    ship_time = time.time() - start
+    time.sleep(0.5)
+
+    print("[i] enqueued {:,} events in {:.2f}s ({:,.0f} events/second in worker)".format(count, enqueue_time, count / enqueue_time))
+    print("[i] shipped in {:.2f}s ({:,.0f} events/second), stats: {}".format(ship_time, count / ship_time, shipper.stats()))
+    print("[i] received: {:,} (UDP log server), {:,} (TCP syslog server)".format(received["udp"], received["tcp"]))
@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+
+"""
+Copyright (c) 2014-2019 Maltrail developers (https://github.com/stamparm/maltrail/)
+See the file 'LICENSE' for copying permission
+"""
+
+# Low-overhead hot-path instrumentation (ENABLE_STATS). Each stage has call counter and (sampled, every
+# STATS_SAMPLE_RATE-th call) latency histogram with power-of-2 microsecond buckets. Values are kept in shared memory
+# with one region per worker (i.e. no locking), while snapshot() aggregates over all workers.
+#
+# Stage (inside worker's region): [calls (Q)][sampled (Q)][sampled time in ns (Q)][buckets (Q * STATS_HISTOGRAM_BUCKETS)]
+# Worker's region: [stages...][counters (Q * len(STATS_COUNTERS))]
+#
+# Usage:
+#   start = stats.start("trails")
+#   ... (e.g. trail lookup)
+#   stats.stop("trails", start)
+#
+# When disabled, HotStats(...) returns instance of _DisabledStats with no-op start(), stop() and count() (i.e. no
+# branching inside them), while call sites in the hottest loops can skip the calls altogether with "if stats.enabled:".
+
+import cProfile
+import json
+import marshal
+import os
+import signal
+import time
+
+from multiprocessing import shared_memory
+
+from settings import config
+from settings import CPU_CORES
+from settings import STATS_HISTOGRAM_BUCKETS
+from settings import STATS_SAMPLE_RATE
+from settings import USERS_DIR
+
+STATS_STAGES = ("trails", "ranges", "heuristics", "ignore", "log")
+STATS_COUNTERS = ("hot_cache_hits", "hot_cache_misses")
+STATS_PROFILE_FILE = os.path.join(USERS_DIR, "profile.{}.{}.prof")     # (Note: pid and time)
+
+_STAGE_LENGTH = 3 + STATS_HISTOGRAM_BUCKETS
+_REGION_LENGTH = len(STATS_STAGES) * _STAGE_LENGTH + len(STATS_COUNTERS)
+_profiler = None
+
+class HotStats(object):
+    def __new__(cls, enabled=None, *args, **kwargs):
+        if cls is HotStats and not (config.ENABLE_STATS if enabled is None else enabled):
+            cls = _DisabledStats
+
+        return object.__new__(cls)
+
+    def __init__(self, enabled=None, process_count=None, sample_rate=STATS_SAMPLE_RATE):
+        self.enabled = config.ENABLE_STATS if enabled is None else enabled
+        self.process_count = max(1, process_count or config.PROCESS_COUNT or CPU_CORES)
+        self.sample_rate = sample_rate
+        self.worker = 0
+        self._calls = dict((_, 0) for _ in STATS_STAGES)     # (local) calls used for sampling decision
+        self._indexes = self._get_indexes(0)
+        self._memory = None
+        self._values = None
+
+        if self.enabled:
+            self._memory = shared_memory.SharedMemory(create=True, size=self.process_count * _REGION_LENGTH * 8)
+            self._values = self._memory.buf.cast('Q')
+
+    def bind(self, worker):
+        """
+        Sets index of (current) worker process writing into stats
+        """
+
+        self.worker = worker % self.process_count
+        self._indexes = self._get_indexes(self.worker)
+
+    def _get_indexes(self, worker):
+        retval = dict((stage, worker * _REGION_LENGTH + i * _STAGE_LENGTH) for i, stage in enumerate(STATS_STAGES))
+        retval.update((counter, worker * _REGION_LENGTH + len(STATS_STAGES) * _STAGE_LENGTH + i) for i, counter in enumerate(STATS_COUNTERS))
+        return retval
+
+    def start(self, stage):
+        """
+        Returns start time (in ns) in case of sampled call, otherwise 0
+        """
+
+        self._calls[stage] += 1
+
+        return time.perf_counter_ns() if self._calls[stage] % self.sample_rate == 0 else 0
+
+    def stop(self, stage, start):
+        index = self._indexes[stage]
+        values = self._values
+        values[index] += 1
+
+        if start:
+            elapsed = time.perf_counter_ns() - start
+            values[index + 1] += 1
+            values[index + 2] += elapsed
+            values[index + 3 + min((elapsed // 1000).bit_length(), STATS_HISTOGRAM_BUCKETS - 1)] += 1
+
+    def count(self, counter, value=1):
+        self._values[self._indexes[counter]] += value
+
+    def snapshot(self):
+        """
+        Returns per-stage stats aggregated over all workers
+        """
+
+        retval = {}
+
+        if not self.enabled:
+            return retval
+
+        for i, stage in enumerate(STATS_STAGES):
+            calls = sampled = total = 0
+            buckets = [0] * STATS_HISTOGRAM_BUCKETS
+
+            for worker in range(self.process_count):
+                index = worker * _REGION_LENGTH + i * _STAGE_LENGTH
+                calls += self._values[index]
+                sampled += self._values[index + 1]
+                total += self._values[index + 2]
+                for j in range(STATS_HISTOGRAM_BUCKETS):
+                    buckets[j] += self._values[index + 3 + j]
+
+            retval[stage] = {"calls": calls, "sampled": sampled, "avg_us": total / sampled / 1000 if sampled else 0.0}
+
+            for name, ratio in (("p50_us", 0.5), ("p90_us", 0.9), ("p99_us", 0.99)):
+                count = 0
+                retval[stage][name] = 0
+                for j in range(STATS_HISTOGRAM_BUCKETS):
+                    count += buckets[j]
+                    if sampled and count >= ratio * sampled:
+                        retval[stage][name] = 1 << j    # upper bound of bucket
+                        break
+
+        for i, counter in enumerate(STATS_COUNTERS):
+            retval[counter] = sum(self._values[worker * _REGION_LENGTH + len(STATS_STAGES) * _STAGE_LENGTH + i] for worker in range(self.process_count))
+
+        return retval
+
+    def release(self):
+        """
+        Frees shared memory (to be called from parent process only)
+        """
+
+        if self._memory is not None:
+            self._values.release()
+            self._values = None
+            self._memory.close()
+            self._memory.unlink()
+            self._memory = None
+
+class _DisabledStats(HotStats):
+    def start(self, stage):
+        return 0
+
+    def stop(self, stage, start):
+        pass
+
+    def count(self, counter, value=1):
+        pass
+
+def get_stats_json(stats, memory=None):
+    """
+    Returns content for (HTTP) stats endpoint in JSON format (optionally with latest sample of core.memory.MemoryTracker)
+    """
+
+    snapshot = stats.snapshot()
+    retval = {"pid": os.getpid(), "time": int(time.time()), "stages": dict((_, snapshot[_]) for _ in STATS_STAGES if _ in snapshot), "counters": dict((_, snapshot[_]) for _ in STATS_COUNTERS if _ in snapshot)}
+
+    if memory is not None:
+        memory.refresh()
+        retval["memory"] = memory.report()
+
+    return json.dumps(retval, indent=4, sort_keys=True)
+
+def get_stats_text(stats, memory=None):
+    """
+    Returns content for (HTTP) stats endpoint in (plain) text format (optionally with latest sample of core.memory.MemoryTracker)
+    """
+
+    retval = []
+    snapshot = stats.snapshot()
+
+    if memory is not None:
+        memory.refresh()
+
+    if not snapshot:
+        return "stats disabled (ENABLE_STATS false)\n" + ("\n" + memory.format() if memory is not None else "")
+
+    retval.append("{:<12}{:>14}{:>10}{:>10}{:>10}{:>10}{:>10}".format("stage", "calls", "sampled", "avg_us", "p50_us", "p90_us", "p99_us"))
+    for stage in STATS_STAGES:
+        _ = snapshot[stage]
+        retval.append("{:<12}{:>14,}{:>10,}{:>10.2f}{:>10}{:>10}{:>10}".format(stage, _["calls"], _["sampled"], _["avg_us"], _["p50_us"], _["p90_us"], _["p99_us"]))
+
+    retval.append("")
+    for counter in STATS_COUNTERS:
+        retval.append("{:<26}{:>14,}".format(counter, snapshot[counter]))
+
+    hits, misses = snapshot["hot_cache_hits"], snapshot["hot_cache_misses"]
+    retval.append("{:<26}{:>14.1f}".format("hot_cache_hit_ratio (%)", 100.0 * hits / (hits + misses) if hits + misses else 0.0))
+
+    if memory is not None:
+        retval.append("")
+        retval.append(memory.format().rstrip("\n"))
+
+    return "\n".join(retval) + "\n"
+
+def _toggle_profile(signum, frame):
+    global _profiler
+
+    if _profiler is None:
+        _profiler = cProfile.Profile()
+        _profiler.enable()
+        print("[i] profiling started (pid {})".format(os.getpid()))
+    else:
+        _profiler.disable()
+        _profiler.create_stats()
+        path = STATS_PROFILE_FILE.format(os.getpid(), int(time.time()))
+
+        try:
+            if not os.path.isdir(USERS_DIR):
+                os.makedirs(USERS_DIR, 0o755)
+            with os.fdopen(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600), "wb") as f:     # (Note: O_EXCL not following planted symlinks)
+                marshal.dump(_profiler.stats, f)
+            print("[i] profile dumped to '{}'".format(path))
+        except (IOError, OSError) as ex:
+            print("[x] unable to dump profile to '{}' ({})".format(path, ex))
+        finally:
+            _profiler = None
+
+def install_profile_handler(signum=getattr(signal, "SIGUSR1", None)):
+    """
+    Installs signal handler toggling cProfile (first signal starts profiling, second one dumps it to STATS_PROFILE_FILE)
+    """
+
+    if signum is not None:
+        signal.signal(signum, _toggle_profile)
+
+if __name__ == "__main__":
+    import timeit
+
+    count = 1000000
+    baseline = min(timeit.repeat("pass", number=count, repeat=7))
+
+    for enabled in (False, True):
+        stats = HotStats(enabled, process_count=2)
+        stats.bind(1)
+        for name, code in (("", "_ = stats.start('trails'); stats.stop('trails', _)"), (" (guarded by 'if stats.enabled:')", "if stats.enabled:\n    _ = stats.start('trails'); stats.stop('trails', _)")):
+            elapsed = min(timeit.repeat(code, globals={"stats": stats}, number=count, repeat=7))
+            print("[i] enabled={}{}: {:.0f} ns overhead per instrumented call".format(enabled, name, (elapsed - baseline) * 1e9 / count))
+        if enabled:
+            print(get_stats_text(stats))
+        stats.release()
@@ -10,6 +10,7 @@ import re
 
 class TrailsDict(dict):
     def __init__(self):
+        self.version = 0    # incremented on each modification (e.g. for invalidation of derived caches)
         self._trails = {}
         self._infos = []
         self._reverse_infos = {}
@@ -18,14 +19,18 @@ class TrailsDict(dict):
     
     def __delitem__(self, key):
         del self._trails[key]
+        self.version += 1
     
     def __contains__(self, key):
         return key in self._trails
     
     def clear(self):
+        self.version += 1
         self._trails.clear()
         self._infos = []
+        self._reverse_infos = {}
         self._references = []
+        self._reverse_references = {}
 
     def keys(self):
         return self._trails.keys()
@@ -42,6 +47,7 @@ class TrailsDict(dict):
             return default
 
     def update(self, value):
+        self.version += 1
         if isinstance(value, TrailsDict):
             if not self._trails:
                 for attr in dir(self):
@@ -74,6 +80,7 @@ class TrailsDict(dict):
             raise KeyError(key)
     
     def __setitem__(self, key, value):
+        self.version += 1
         if isinstance(value, (tuple, list)):
             info, reference = value
             if info not in self._reverse_infos:
@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+
+"""
+Copyright (c) 2014-2019 Maltrail developers (https://github.com/stamparm/maltrail/)
+See the file 'LICENSE' for copying permission
+"""
+
+# Versioned trail distribution between UPDATE_SERVER and sensors. Server keeps (compressed) snapshots of TRAILS_FILE
+# (version being monotonic counter stored in TRAILS_SNAPSHOT_VERSION_FILE) and answers sensor's request (i.e. "<UPDATE_SERVER>?version=<local version>")
+# with delta against sensor's version, or with full snapshot if that version is not (anymore) available.
+#
+# Delta format (CSV):
+#   #version,<version>,<base version>
+#   +,<trail>,<info>,<reference>    (added)
+#   ~,<trail>,<info>,<reference>    (changed info/reference)
+#   -,<trail>                       (removed)
+#   #end,<number of rows>
+#
+# Full snapshot format (CSV):
+#   #version,<version>
+#   <trail>,<info>,<reference>
+#   #end,<number of rows>
+#
+# Trailing "#end" row allows sensor to reject truncated responses. Delta is applied (only if local version is the delta's
+# base, otherwise full snapshot is requested) in-place to live trails and appended to TRAILS_DELTA_FILE (replayed by
+# load_trails()), while TRAILS_FILE is rewritten (from memory) only once that file grows over TRAILS_DELTA_COMPACT_RATIO.
+
+import csv
+import glob
+import gzip
+import io
+import os
+import shutil
+
+from common import check_whitelisted
+from common import load_trails
+from common import retrieve_content
+from settings import trails as _trails
+from settings import TRAILS_DELTA_COMPACT_RATIO
+from settings import TRAILS_DELTA_FILE
+from settings import TRAILS_FILE
+from settings import TRAILS_SNAPSHOT_DIR
+from settings import TRAILS_SNAPSHOT_HISTORY
+from settings import TRAILS_SNAPSHOT_VERSION_FILE
+from settings import TRAILS_VERSION_FILE
+
+_delta_cache = {}     # base version -> (version, rows)
+
+def _read_rows(path):
+    with (gzip.open(path, "rt", newline="") if path.endswith(".gz") else open(path, "r", newline="")) as f:
+        for row in csv.reader(f, delimiter=',', quotechar='\"'):
+            if row and len(row) == 3:
+                yield row
+
+def _snapshot_path(version):
+    return os.path.join(TRAILS_SNAPSHOT_DIR, "{}.csv.gz".format(version))
+
+def create_snapshot(trails_file=TRAILS_FILE):
+    """
+    Stores (compressed) snapshot of current trails file (if not already stored) and returns its version
+    """
+
+    stat = os.stat(trails_file)
+    snapshots = sorted(glob.glob(os.path.join(TRAILS_SNAPSHOT_DIR, "*.csv.gz")), key=lambda _: int(os.path.basename(_).split('.')[0]))
+
+    try:
+        with open(TRAILS_SNAPSHOT_VERSION_FILE, "r") as f:
+            version, mtime, size = (int(_) for _ in f.read().split(','))
+    except (IOError, OSError, ValueError):
+        version, mtime, size = int(os.path.basename(snapshots[-1]).split('.')[0]) if snapshots else 0, None, None
+
+    if (mtime, size) == (stat.st_mtime_ns, stat.st_size) and os.path.isfile(_snapshot_path(version)):
+        return version
+
+    version += 1
+    path = _snapshot_path(version)
+
+    if not os.path.isdir(TRAILS_SNAPSHOT_DIR):
+        os.makedirs(TRAILS_SNAPSHOT_DIR, 0o755)
+
+    with open(trails_file, "rb") as f, gzip.open("{}.tmp".format(path), "wb") as g:
+        shutil.copyfileobj(f, g)
+    os.replace("{}.tmp".format(path), path)
+
+    with open("{}.tmp".format(TRAILS_SNAPSHOT_VERSION_FILE), "w") as f:
+        f.write("{},{},{}".format(version, stat.st_mtime_ns, stat.st_size))
+    os.replace("{}.tmp".format(TRAILS_SNAPSHOT_VERSION_FILE), TRAILS_SNAPSHOT_VERSION_FILE)
+
+    for _ in (snapshots + [path])[:-TRAILS_SNAPSHOT_HISTORY]:
+        os.remove(_)
+
+    return version
+
+def generate_delta(base, version):
+    """
+    Returns rows ([op, trail(, info, reference)]) transforming snapshot base into snapshot version
+    """
+
+    if _delta_cache.get(base, (None,))[0] != version:
+        old = dict((trail, (info, reference)) for trail, info, reference in _read_rows(_snapshot_path(base)))
+        retval = []
+
+        for trail, info, reference in _read_rows(_snapshot_path(version)):
+            _ = old.pop(trail, None)
+            if _ is None:
+                retval.append(['+', trail, info, reference])
+            elif _ != (info, reference):
+                retval.append(['~', trail, info, reference])
+
+        for trail in old:
+            retval.append(['-', trail])
+
+        for _ in [_ for _ in _delta_cache if _delta_cache[_][0] != version]:
+            del _delta_cache[_]
+        _delta_cache[base] = (version, retval)
+
+    return _delta_cache[base][1]
+
+def get_trails_update(base=None, trails_file=TRAILS_FILE):
+    """
+    Returns content to be served to sensor having (local) trails version base
+    """
+
+    version = create_snapshot(trails_file)
+    retval = io.StringIO()
+    writer = csv.writer(retval, delimiter=',', quotechar='\"', quoting=csv.QUOTE_MINIMAL, lineterminator='\n')
+
+    if str(base or "").isdigit() and os.path.isfile(_snapshot_path(base)):
+        rows = generate_delta(int(base), version) if int(base) != version else []
+        writer.writerow(["#version", version, base])
+        writer.writerows(rows)
+    else:
+        rows = list(_read_rows(trails_file))
+        writer.writerow(["#version", version])
+        writer.writerows(rows)
+
+    writer.writerow(["#end", len(rows)])
+
+    return retval.getvalue()
+
+def apply_delta(trails, rows):
+    """
+    Applies delta rows to (live) trails and returns number of changes
+    """
+
+    retval = 0
+
+    for row in rows:
+        if len(row) == 4 and row[0] in ('+', '~'):
+            if not check_whitelisted(row[1]):
+                trails[row[1]] = (row[2], row[3])
+                retval += 1
+        elif len(row) == 2 and row[0] == '-':
+            if row[1] in trails:
+                del trails[row[1]]
+                retval += 1
+
+    return retval
+
+def get_local_version():
+    try:
+        with open(TRAILS_VERSION_FILE, "r") as f:
+            return int(f.read().strip())
+    except (IOError, OSError, ValueError):
+        return None
+
+def save_version(version):
+    with open("{}.tmp".format(TRAILS_VERSION_FILE), "w") as f:
+        f.write(str(version))
+    os.replace("{}.tmp".format(TRAILS_VERSION_FILE), TRAILS_VERSION_FILE)
+
+def save_trails(trails, version):
+    """
+    Writes (in-memory) trails to TRAILS_FILE, dropping (then obsolete) TRAILS_DELTA_FILE
+    """
+
+    with open("{}.tmp".format(TRAILS_FILE), "w", newline="") as f:
+        writer = csv.writer(f, delimiter=',', quotechar='\"', quoting=csv.QUOTE_MINIMAL)
+        for trail in trails:
+            writer.writerow((trail,) + tuple(trails[trail]))
+    os.replace("{}.tmp".format(TRAILS_FILE), TRAILS_FILE)
+
+    if os.path.isfile(TRAILS_DELTA_FILE):
+        os.remove(TRAILS_DELTA_FILE)
+
+    save_version(version)
+
+def save_delta(trails, rows, version):
+    """
+    Appends delta rows to TRAILS_DELTA_FILE (or rewrites TRAILS_FILE from trails once that one grows too large)
+    """
+
+    if rows:
+        with open(TRAILS_DELTA_FILE, "a", newline="") as f:
+            csv.writer(f, delimiter=',', quotechar='\"', quoting=csv.QUOTE_MINIMAL).writerows(rows)
+
+        if os.path.getsize(TRAILS_DELTA_FILE) > TRAILS_DELTA_COMPACT_RATIO * os.path.getsize(TRAILS_FILE):
+            save_trails(trails, version)
+            return
+
+    save_version(version)
+
+def _parse_response(content):
+    """
+    Returns (header, rows) of (complete) server response or None
+    """
+
+    content = content.decode("utf8", "ignore") if isinstance(content, bytes) else (content or "")
+    rows = list(csv.reader(io.StringIO(content), delimiter=',', quotechar='\"'))
+
+    if not rows:
+        return None
+
+    if rows[0][:1] == ["#version"]:
+        if len(rows) < 2 or len(rows[-1]) != 2 or rows[-1][0] != "#end" or not all(_.isdigit() for _ in rows[0][1:] + rows[-1][1:]) or int(rows[-1][1]) != len(rows) - 2:
+            return None
+        return rows[0], rows[1:-1]
+
+    # (legacy) server without version support (Note: accepted only if all rows are well-formed trails)
+    if not content.endswith('\n') or any(len(_) != 3 or not _[0] or _[0].startswith('<') for _ in rows):
+        return None
+
+    return ["#version", "0"], rows
+
+def sync_trails(url, trails=None):
+    """
+    Synchronizes local trails with update server at url (returns loaded trails or None in case of failure). Delta is
+    applied in-place to given (live) trails (default: settings.trails) if those are already loaded
+    """
+
+    local = get_local_version() if os.path.isfile(TRAILS_FILE) else None
+    response = _parse_response(retrieve_content("{}{}version={}".format(url, '&' if '?' in url else '?', local or "")))
+
+    if response and len(response[0]) > 2:
+        if local is not None and int(response[0][2]) == local:
+            header, rows = response
+            retval = trails if trails is not None else _trails
+            if not retval:
+                retval = load_trails(quiet=True)
+            changes = apply_delta(retval, rows)
+            if int(header[1]) != local:
+                save_delta(retval, rows, int(header[1]))
+            print("[i] trails synchronized (version {}, {} change(s))".format(header[1], changes))
+            return retval
+
+        response = _parse_response(retrieve_content("{}{}version=".format(url, '&' if '?' in url else '?')))
+
+        if response and len(response[0]) > 2:
+            return None
+
+    if not response:
+        return None
+
+    header, rows = response
+
+    with open("{}.tmp".format(TRAILS_FILE), "w", newline="") as f:
+        csv.writer(f, delimiter=',', quotechar='\"', quoting=csv.QUOTE_MINIMAL).writerows(rows)
+    os.replace("{}.tmp".format(TRAILS_FILE), TRAILS_FILE)
+
+    if os.path.isfile(TRAILS_DELTA_FILE):
+        os.remove(TRAILS_DELTA_FILE)
+
+    save_version(header[1])
+
+    retval = load_trails(quiet=True)
+    print("[i] trails synchronized (version {}, full snapshot)".format(header[1]))
+
+    return retval
@@ -7,14 +7,12 @@ See the file 'LICENSE' for copying permission
 
 import csv
 import glob
-import inspect
 import os
 import re
 import sqlite3
 import subprocess
 import sys
 import time
-import urllib2
 
 sys.dont_write_bytecode = True
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))) # to enable calling from current directory too
@@ -28,10 +26,14 @@ from core.common import cdn_ip
 from core.common import check_whitelisted
 from core.common import load_trails
 from core.common import retrieve_content
+from core.feeds import filter_feeds
+from core.feeds import load_manifest
+from core.feeds import run_feeds
 from core.settings import config
 from core.settings import read_config
 from core.settings import read_whitelist
 from core.settings import BAD_TRAIL_PREFIXES
+from core.settings import FEEDS_MANIFEST_FILE
 from core.settings import FRESH_IPCAT_DELTA_DAYS
 from core.settings import LOW_PRIORITY_INFO_KEYWORDS
 from core.settings import HIGH_PRIORITY_INFO_KEYWORDS
@@ -42,6 +44,7 @@ from core.settings import IPCAT_URL
 from core.settings import ROOT_DIR
 from core.settings import TRAILS_FILE
 from core.settings import USERS_DIR
+from core.trailsync import sync_trails
 
 # patch for self-signed certificates (e.g. CUSTOM_TRAILS_URL)
 try:
@@ -64,6 +67,29 @@ def _fopen(filepath, mode='rb'):
         _chown(filepath)
     return retval
 
+def normalize_trails(trails):
+    """
+    Returns new trails dictionary without entries disabled by DISABLED_TRAILS_INFO_REGEX and with IDNA encoded keys
+    """
+
+    regex = re.compile(config.DISABLED_TRAILS_INFO_REGEX) if config.DISABLED_TRAILS_INFO_REGEX else None
+    retval = {}
+
+    for key, value in trails.items():
+        if regex and regex.search(value[0]):
+            continue
+
+        if not key.isascii():
+            try:
+                domain, _, path = key.partition('/')
+                key = domain.encode("idna").decode("ascii") + _ + path
+            except UnicodeError:
+                pass
+
+        retval[key] = value
+
+    return retval
+
 def update_trails(force=False, offline=False):
     """
     Update trails from feeds
@@ -75,22 +101,21 @@ def update_trails(force=False, offline=False):
 
     try:
         if not os.path.isdir(USERS_DIR):
-            os.makedirs(USERS_DIR, 0755)
+            os.makedirs(USERS_DIR, 0o755)
     except Exception as ex:
         exit("[!] something went wrong during creation of directory '{}' ({})".format(USERS_DIR, ex))
     
     _chown(USERS_DIR)
 
     # 如果配置了trails更新服务器，就从更新服务器获取trail
-    if config.UPDATE_SERVER:    # 如果配置了trails更新服务器，则从服务器读取trails并写入到TRAILS_FILE文件
+    if config.UPDATE_SERVER:    # 如果配置了trails更新服务器，则从服务器同步trails (delta或完整快照) 并写入到TRAILS_FILE文件
         print("[i] retrieving trails from provided 'UPDATE_SERVER' server...")
-        content = retrieve_content(config.UPDATE_SERVER)
-        if not content or content.count(',') < 2:
+        _ = sync_trails(config.UPDATE_SERVER)
+        if _ is None:
             print("[x] unable to retrieve data from {}".format(config.UPDATE_SERVER))
         else:
-            with _fopen(TRAILS_FILE, 'w+b') as f:
-                f.write(content)
-            trails = load_trails()
+            _chown(TRAILS_FILE)
+            trails = _
 
     # 没有配置trails更新服务器，就从当前文件中读取trails
     else:
@@ -113,67 +138,45 @@ def update_trails(force=False, offline=False):
             # 将trails目录下的所有文件名都加入到filenames列表中
             if not offline and (force or config.USE_FEED_UPDATES):
                 _ = os.path.abspath(os.path.join(ROOT_DIR, "trails", "feeds"))
-                if _ not in sys.path:
-                    sys.path.append(_)
-
                 filenames = sorted(glob.glob(os.path.join(_, "*.py")))  # glob模块查找符合特定规则的文件路径名，本例子中查找文件夹下的.py文件，返回文件路径列表
             else:
                 filenames = []
 
             _ = os.path.abspath(os.path.join(ROOT_DIR, "trails"))
-            if _ not in sys.path:
-                sys.path.append(_)
-            
             filenames += [os.path.join(_, "static")]
             filenames += [os.path.join(_, "custom")]
 
-            filenames += [_ for _ in filenames if "__init__.py" not in _]
+            filenames = [_ for _ in filenames if "__init__.py" not in _]
 
-            if config.DISABLED_FEEDS:
-                filenames = [filename for filename in filenames if os.path.splitext(os.path.split(filename)[-1])[0] not in re.split(r"[^\w]+", config.DISABLED_FEEDS)]
+            # 从feed清单中过滤掉被禁用的feed (不导入模块)
+            entries = filter_feeds(load_manifest(filenames), config.DISABLED_FEEDS, config.DISABLED_TRAILS_INFO_REGEX)
+            _chown(FEEDS_MANIFEST_FILE)
 
-            # 处理每个trail文件
-            for i in range(len(filenames)):
-                filename = filenames[i]
+            # 处理每个feed (在工作进程中按需导入)
+            for i, (entry, (url, results, error)) in enumerate(run_feeds(entries, config.DISABLED_TRAILS_INFO_REGEX)):
+                print(" [o] '{}'{}".format(url, " " * 20 if len(url or "") < 20 else ""))
+                sys.stdout.write("[?] progress: %d/%d (%d%%)\r" % (i, len(entries), i * 100 / len(entries)))
+                sys.stdout.flush()
+
+                if error:
+                    print("[x] {}".format(error))
+                    continue
 
-                # 导入.py文件
-                try:
-                    module = __import__(os.path.basename(filename).split(".py")[0])
-                except (ImportError, SyntaxError) as ex:
-                    print("[x] something went wrong during import of feed file '{}' ({})".format(filename, ex))
+                if results is None:
                     continue
 
-                for name, function in inspect.getmembers(module, inspect.isfunction):
-                    if name == 'fetch':
-                        print(" [o] '{}'{}".format(module.__url__, " " * 20 if len(module.__url__) < 20 else ""))
-                        sys.stdout.write("[?] progress: %d/%d (%d%%)\r" % (i, len(filenames), i * 100 / len(filenames)))
-                        sys.stdout.flush()
-
-                        if config.DISABLED_TRAILS_INFO_REGEX and re.search(config.DISABLED_TRAILS_INFO_REGEX, getattr(module, "__info__", "")):
-                            continue
-
-                        try:
-                            results = function()
-                            for item in results.items():
-                                if item[0].startswith("www.") and '/' not in item[0]:
-                                    item = [item[0][len("www."):], item[1]]
-                                if item[0] in trails:
-                                    if item[0] not in duplicates:
-                                        duplicates[item[0]] = set((trails[item[0]][1],))
-                                    duplicates[item[0]].add(item[1][1])
-                                if not (item[0] in trails and (any(_ in item[1][0] for _ in LOW_PRIORITY_INFO_KEYWORDS) or trails[item[0]][1] in HIGH_PRIORITY_REFERENCES)) or (item[1][1] in HIGH_PRIORITY_REFERENCES and "history" not in item[1][0]) or any(_ in item[1][0] for _ in HIGH_PRIORITY_INFO_KEYWORDS):
-                                    trails[item[0]] = item[1]
-                            if not results and "abuse.ch" not in module.__url__:
-                                print("[x] something went wrong during remote data retrieval ('{}')".format(module.__url__))
-                        except Exception as ex:
-                            print("[x] something went wrong during processing of feed file '{}' ('{}')".format(filename, ex))
-                
-                try:
-                    sys.modules.pop(module.__name__)
-                    del module
-                except Exception:
-                    pass
-            
+                for item in results.items():
+                    if item[0].startswith("www.") and '/' not in item[0]:
+                        item = [item[0][len("www."):], item[1]]
+                    if item[0] in trails:
+                        if item[0] not in duplicates:
+                            duplicates[item[0]] = set((trails[item[0]][1],))
+                        duplicates[item[0]].add(item[1][1])
+                    if not (item[0] in trails and (any(_ in item[1][0] for _ in LOW_PRIORITY_INFO_KEYWORDS) or trails[item[0]][1] in HIGH_PRIORITY_REFERENCES)) or (item[1][1] in HIGH_PRIORITY_REFERENCES and "history" not in item[1][0]) or any(_ in item[1][0] for _ in HIGH_PRIORITY_INFO_KEYWORDS):
+                        trails[item[0]] = item[1]
+                if not results and "abuse.ch" not in (url or ""):
+                    print("[x] something went wrong during remote data retrieval ('{}')".format(url))
+
             # custom trails from remote location
             if config.CUSTOM_TRAILS_URL:
                 print(" [o] '(remote custom)'{}".format(" " * 20))
@@ -224,20 +227,4 @@ def update_trails(force=False, offline=False):
                                     address += 1
                         
             # basic cleanup
-            for key in trails.keys():
-                if key not in trails:
-                    continue
-                if config.DISABLED_TRAILS_INFO_REGEX:
-                    if re.search(config.DISABLED_TRAILS_INFO_REGEX, trails[key][0]):
-                        del trails[key]
-                        continue
-                
-                try:
-                    _key = key.decode("utf8").encode("idna")
-                    if _key != key:
-                        trails[_key] = trails[key]
-                        del trails[key]
-                        key = _key
-                except:
-                    pass
-
+            trails = normalize_trails(trails)
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+
+"""
+Copyright (c) 2014-2019 Maltrail developers (https://github.com/stamparm/maltrail/)
+See the file 'LICENSE' for copying permission
+"""
+
+# Event-driven wakeup of idle worker processes (instead of fixed-sleep polling with SHORT_SENSOR_SLEEP_TIME and
+# REGULAR_SENSOR_SLEEP_TIME). Consumer drains whatever is available, (optionally) spins for WAKEUP_SPIN_COUNT polls
+# and backs off with WAKEUP_BACKOFF_COUNT sleeps of SHORT_SENSOR_SLEEP_TIME, then announces itself as sleeping (shared
+# flag), polls once more and blocks on eventfd (or pipe on platforms without it). Producer signals only when consumer
+# is sleeping, hence there is no syscall per packet while consumer is busy. WAKEUP_TIMEOUT bounds the (theoretical)
+# lost-wakeup window. (Note: both spinning and backoff are off by default, as blocking right away has been measured
+# to be both cheaper and faster to wake up than any of them)
+
+import ctypes
+import multiprocessing
+import os
+import select
+import time
+
+from settings import NO_BLOCK
+from settings import REGULAR_SENSOR_SLEEP_TIME
+from settings import SHORT_SENSOR_SLEEP_TIME
+from settings import WAKEUP_BACKOFF_COUNT
+from settings import WAKEUP_SPIN_COUNT
+from settings import WAKEUP_TIMEOUT
+
+class Wakeup(object):
+    def __init__(self, spin=WAKEUP_SPIN_COUNT, backoff=WAKEUP_BACKOFF_COUNT, timeout=WAKEUP_TIMEOUT):
+        self.spin = spin
+        self.backoff = backoff
+        self.timeout = timeout
+        self.notifications = 0
+        self.sleeps = 0
+        self._sleeping = multiprocessing.RawValue(ctypes.c_int, 0)
+
+        if hasattr(os, "eventfd"):
+            self._read_fd = self._write_fd = os.eventfd(0, os.EFD_NONBLOCK | os.EFD_CLOEXEC)
+        else:
+            self._read_fd, self._write_fd = os.pipe()
+            os.set_blocking(self._read_fd, False)
+            os.set_blocking(self._write_fd, False)
+
+    def notify(self, force=False):
+        """
+        Wakes up (sleeping) consumer (called by producer after each write, with force on close)
+        """
+
+        if self._sleeping.value or force:
+            self._sleeping.value = 0
+            self.notifications += 1
+            try:
+                os.write(self._write_fd, b"\x01\x00\x00\x00\x00\x00\x00\x00")
+            except BlockingIOError:     # (Note: wakeup is already pending)
+                pass
+
+    def _drain(self):
+        try:
+            os.read(self._read_fd, 4096)
+        except BlockingIOError:
+            pass
+
+    def wait(self, poll):
+        """
+        Returns first result of poll() other than NO_BLOCK (spinning first, then backing off with sleeps and finally
+        blocking until notified)
+        """
+
+        for _ in range(max(1, self.spin)):     # (Note: always draining available data before backing off)
+            retval = poll()
+            if retval is not NO_BLOCK:
+                return retval
+
+        for _ in range(self.backoff):
+            time.sleep(SHORT_SENSOR_SLEEP_TIME)
+            retval = poll()
+            if retval is not NO_BLOCK:
+                return retval
+
+        while True:
+            self._sleeping.value = 1
+
+            retval = poll()     # (Note: re-check after announcing sleep, as producer could have written in between)
+            if retval is not NO_BLOCK:
+                self._sleeping.value = 0
+                return retval
+
+            self.sleeps += 1
+            select.select([self._read_fd], [], [], self.timeout)
+            self._sleeping.value = 0
+            self._drain()
+
+            retval = poll()
+            if retval is not NO_BLOCK:
+                return retval
+
+    def close(self):
+        os.close(self._read_fd)
+        if self._write_fd != self._read_fd:
+            os.close(self._write_fd)
+
+if __name__ == "__main__":
+    import struct
+
+    from ringbuffer import RingBuffer
+    from settings import END_BLOCK
+
+    duration = 2
+    rates = (0, 100, 1000, 10000)
+
+    def _consume(ring, wakeup, results):
+        latencies = []
+        start = time.process_time()
+
+        while True:
+            _ = ring.read(0)        # (Note: draining ring, while waiting only when it's empty)
+            if _ is NO_BLOCK:
+                if wakeup is not None:
+                    _ = wakeup.wait(lambda: ring.read(0))
+                else:
+                    time.sleep(REGULAR_SENSOR_SLEEP_TIME)
+                    continue
+            if _ is END_BLOCK:
+                break
+            latencies.append(time.perf_counter() - struct.unpack("d", _[3][:8])[0])
+
+        latencies.sort()
+        results[0] = time.process_time() - start
+        results[1] = latencies[len(latencies) // 2] if latencies else 0
+        results[2] = latencies[int(len(latencies) * 0.99)] if latencies else 0
+
+    for name in ("sleep polling", "eventfd wakeup"):
+        for rate in rates:
+            ring = RingBuffer(16 * 1024 * 1024, 1)
+            wakeup = Wakeup() if name != "sleep polling" else None
+            results = multiprocessing.RawArray(ctypes.c_double, 3)
+            process = multiprocessing.Process(target=_consume, args=(ring, wakeup, results))
+            process.start()
+
+            start = time.perf_counter()
+            sent = 0
+            while time.perf_counter() - start < duration:
+                if rate and sent < rate * (time.perf_counter() - start):
+                    ring.write(0, 0, 0, 14, struct.pack("d", time.perf_counter()) + b"\x00" * 56)
+                    if wakeup is not None:
+                        wakeup.notify()
+                    sent += 1
+                else:
+                    time.sleep(min(0.001, 1.0 / rate) if rate else 0.01)
+
+            ring.close()
+            if wakeup is not None:
+                wakeup.notify(True)
+            process.join()
+
+            print("[i] {:<16}{:>7,} pps: consumer CPU {:5.1f}%, latency p50 {:8.1f}us, p99 {:8.1f}us".format(name, rate, 100.0 * results[0] / duration, results[1] * 1e6, results[2] * 1e6))